@@ -1,4 +1,6 @@
 # NRD 2019 Column Specifications
+# Fallback only: files with a FileSpecifications_*.TXT spec take their columns from the registry;
+# these lists cover spec-less files (see hcup_spec.fallback_columns)
 
 # Core File Columns
 core_columns = [
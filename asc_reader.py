@@ -0,0 +1,267 @@
+import os
+import numpy as np
+import pandas as pd
+
+from compression import compression_of, open_input, skip_bytes
+from filters import filter_columns, filter_mask, normalize_filters
+from hcup_spec import SENTINEL_DIGITS, TEXT_SENTINELS, schema_for_file
+from memory_budget import chunk_rows
+
+SPACE = ord(' ')
+DOT = ord('.')
+MINUS = ord('-')
+ZERO, NINE = ord('0'), ord('9')
+SENTINEL_BYTES = np.array([ord(digit) for digit in SENTINEL_DIGITS], dtype=np.uint8)
+
+
+def get_record_stride(asc_path, record_length):
+    """Return bytes per record including the line terminator (CRLF, LF or none)"""
+    with open_input(asc_path, threaded=False) as f:
+        head = f.read(record_length + 2)
+
+    if head[record_length:record_length + 2] == b'\r\n':
+        return record_length + 2
+    if head[record_length:record_length + 1] == b'\n':
+        return record_length + 1
+    return record_length
+
+
+def _parse_numeric(values, blank):
+    """Parse right-justified numeric text, treating blank (or sentinel-coded) fields as NaN"""
+    if not blank.any():
+        return values.astype(np.float64)
+
+    # Parse them as 0 and mask them afterwards
+    values = values.copy()
+    values[blank] = b'0'
+    parsed = values.astype(np.float64)
+    parsed[blank] = np.nan
+    return parsed
+
+
+def _sentinel_mask(block, decimals=0):
+    """Records whose field bytes hold an HCUP sentinel: a minus sign and a run of one sentinel digit filling the
+    field (-99 in a 3-wide field, -99.99 in a 6-wide one with two decimals, or -9999 with the point implied)
+    """
+    # Codes fill the field, so only records signed in its first byte are inspected
+    rows = np.flatnonzero(block[:, 0] == MINUS)
+    if not len(rows):
+        return None
+
+    run = block[rows, 1:]
+    first = run[:, 0]
+    allowed = run == first[:, None]
+    if decimals and run.shape[1] > decimals + 1:
+        # An explicit point can only sit before the last `decimals` digits
+        allowed[:, -decimals - 1] |= run[:, -decimals - 1] == DOT
+    coded = np.isin(first, SENTINEL_BYTES) & allowed.all(axis=1)
+
+    mask = np.zeros(len(block), dtype=bool)
+    mask[rows[coded]] = True
+    return mask
+
+
+def _drop_text_sentinels(decoded):
+    """Null the invl/incn codes of a decoded Char field"""
+    if isinstance(decoded.dtype, pd.CategoricalDtype):
+        # Only the (few) categories need checking; dropping one nulls every record coded with it
+        coded = [value for value in decoded.cat.categories if value.lower() in TEXT_SENTINELS]
+        return decoded.cat.remove_categories(coded) if coded else decoded
+    decoded[decoded.str.lower().isin(TEXT_SENTINELS).fillna(False)] = None
+    return decoded
+
+
+def decode_field(records, field):
+    """Decode one fixed-width field from a (n_records, stride) uint8 array
+
+    Blanks and the sentinel codes the field's rule covers decode to nulls: NaN for floats, masked entries
+    for nullable ints and categories.
+    """
+    width = field['width']
+    block = np.ascontiguousarray(records[:, field['start'] - 1:field['end']])
+    values = block.view(f'S{width}').ravel()
+    blank = (block == SPACE).all(axis=1)
+    dtype = field.get('dtype')
+    rule = field.get('sentinels')
+
+    if field['type'] != 'Num':
+        decoded = pd.Series(np.char.strip(values)).str.decode('ascii')
+        decoded[blank] = None
+        if dtype == 'category':
+            decoded = decoded.astype('category')
+        if rule == 'text':
+            decoded = _drop_text_sentinels(decoded)
+        return decoded if dtype == 'category' else decoded.to_numpy()
+
+    # Sentinels are masked from the raw bytes, in the same pass that finds blanks
+    if rule == 'numeric':
+        coded = _sentinel_mask(block, field['decimals'])
+        if coded is not None:
+            blank = blank | coded
+
+    parsed = _parse_numeric(values, blank)
+
+    # Decimals are implied when the field carries no explicit decimal point
+    if field['decimals']:
+        implied = ~(block == DOT).any(axis=1)
+        parsed[implied] /= 10 ** field['decimals']
+
+    if dtype is None:
+        return parsed
+    if dtype.startswith('int'):
+        return pd.arrays.IntegerArray(np.where(blank, 0, parsed).astype(dtype), blank)
+    return parsed.astype(dtype)
+
+
+def decode_records(records, fields):
+    """Decode a block of raw fixed-width records into a DataFrame"""
+    return pd.DataFrame({field['name']: decode_field(records, field) for field in fields})
+
+
+def decode_matching(records, fields, filters, filter_fields, first_record=0):
+    """
+    Decode the records that match filters, labelled with their record numbers.
+
+    Only the predicate fields are decoded for every record; the other
+    fields are decoded for matching records alone.
+    """
+    head = decode_records(records, filter_fields)
+    rows = np.flatnonzero(filter_mask(head, filters))
+    decoded = {field['name'] for field in filter_fields}
+    rest = decode_records(records[rows], [field for field in fields if field['name'] not in decoded])
+    df = pd.concat([head.iloc[rows].reset_index(drop=True), rest], axis=1)[[field['name'] for field in fields]]
+    df.index = rows + first_record
+    return df
+
+
+def _predicate_fields(asc_path, fields, filters):
+    """Spec fields a filter reads, which need not be among the fields being output"""
+    by_name = {field['name']: field for field in fields}
+    columns = filter_columns(filters)
+    if all(col in by_name for col in columns):
+        return [by_name[col] for col in columns]
+    return project_fields(schema_for_file(asc_path), columns)
+
+
+def read_asc_chunks(asc_path, fields, record_length, chunk_size=100000, start_record=0, filters=None):
+    """Yield DataFrames of chunk_size records (a count or a ChunkSizer) sliced at the spec's byte offsets
+
+    With filters, each chunk holds only the matching records, labelled with their record numbers.
+    """
+    stride = get_record_stride(asc_path, record_length)
+    filters = normalize_filters(filters)
+    filter_fields = _predicate_fields(asc_path, fields, filters) if filters else None
+    record = start_record
+
+    with open_input(asc_path) as f:
+        # Fixed-length records make any record's offset computable; compressed input is read past
+        skip_bytes(f, start_record * stride)
+        while True:
+            raw = f.read(chunk_rows(chunk_size) * stride)
+            if not raw:
+                break
+
+            # The final record may be missing its line terminator
+            remainder = len(raw) % stride
+            if remainder:
+                raw += b' ' * (stride - remainder)
+
+            records = np.frombuffer(raw, dtype=np.uint8).reshape(-1, stride)
+            if filters is None:
+                yield decode_records(records, fields)
+            else:
+                yield decode_matching(records, fields, filters, filter_fields, record)
+            record += len(records)
+
+
+def project_fields(schema, columns=None):
+    """Spec fields for the requested columns, in the requested order (all fields for None)"""
+    if columns is None:
+        return schema['fields']
+
+    by_name = schema['by_name']
+    missing = [col for col in columns if col not in by_name]
+    if missing:
+        raise KeyError(f"Columns not in {schema['name']} spec: {missing}")
+    return [by_name[col] for col in columns]
+
+
+def read_asc(asc_path, schema=None, chunk_size=100000, columns=None, filters=None):
+    """Yield DataFrame chunks of an ASC file using the layout from the schema registry
+
+    Only the bytes of the requested columns are decoded, and only for records matching filters.
+    """
+    schema = schema or schema_for_file(asc_path)
+    if schema is None:
+        raise ValueError(f"No FileSpecifications file found for {asc_path}")
+    return read_asc_chunks(asc_path, project_fields(schema, columns), schema['header']['record_length'], chunk_size,
+                           filters=filters)
+
+
+def count_asc_records(asc_path, record_length):
+    """Number of records in a fixed-width file, computed from its size"""
+    stride = get_record_stride(asc_path, record_length)
+    if compression_of(asc_path):
+        # The uncompressed size is only known by decompressing
+        with open_input(asc_path) as f:
+            size = sum(len(block) for block in iter(lambda: f.read(16 * 1024 * 1024), b''))
+    else:
+        size = os.path.getsize(asc_path)
+    # The last record may be missing its line terminator
+    return (size + stride - record_length) // stride
+
+
+class AscDataset:
+    """Memory-mapped view of a fixed-length ASC file with O(1) record access"""
+
+    def __init__(self, asc_path, schema=None):
+        self.path = asc_path
+        self.schema = schema or schema_for_file(asc_path)
+        if self.schema is None:
+            raise ValueError(f"No FileSpecifications file found for {asc_path}")
+        if compression_of(asc_path):
+            raise ValueError(f"{asc_path} is compressed; memory mapping needs the extracted ASC file")
+
+        self.record_length = self.schema['header']['record_length']
+        self.stride = get_record_stride(asc_path, self.record_length)
+        self.n_records = count_asc_records(asc_path, self.record_length)
+
+        # Rows are views into the mapped file; nothing is read until a field is decoded
+        data = np.memmap(asc_path, dtype=np.uint8, mode='r')
+        self.records = np.lib.stride_tricks.as_strided(
+            data, shape=(self.n_records, self.record_length), strides=(self.stride, 1), writeable=False
+        )
+
+    def __len__(self):
+        return self.n_records
+
+    def __getitem__(self, index):
+        """Decode one record (as a dict) or a slice of records (as a DataFrame)"""
+        if isinstance(index, slice):
+            return decode_records(self.records[index], self.schema['fields'])
+        return self.record(index)
+
+    def _fields(self, columns):
+        return project_fields(self.schema, columns)
+
+    def record(self, n, columns=None):
+        """Decode record n by seeking straight to its byte offset"""
+        if n < 0:
+            n += self.n_records
+        if not 0 <= n < self.n_records:
+            raise IndexError(f"Record {n} out of range for {self.n_records:,} records")
+
+        row = decode_records(self.records[n:n + 1], self._fields(columns))
+        return {col: row[col].iloc[0] for col in row.columns}
+
+    def columns(self, columns, start=0, stop=None, filters=None):
+        """Decode only the bytes of the requested fields for records [start, stop), optionally only matching ones"""
+        if not filters:
+            return decode_records(self.records[start:stop], self._fields(columns))
+        return decode_matching(self.records[start:stop], self._fields(columns), filters,
+                               self._fields(filter_columns(filters)), start)
+
+    def iter_chunks(self, columns=None, chunk_size=100000, filters=None):
+        """Yield DataFrames of chunk_size records, decoding only the requested columns of matching records"""
+        for start in range(0, self.n_records, chunk_size):
+            yield self.columns(columns, start, min(start + chunk_size, self.n_records), filters)
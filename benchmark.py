@@ -0,0 +1,274 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from checkpoint import checkpoint_path
+from compression import COMPRESSION_CHOICES
+from hcup_spec import get_schema
+from memory_budget import DEFAULT_MEMORY_BUDGET
+from output_formats import OUTPUT_FORMATS, clear_output, path_size
+from row_counts import count_rows
+from run_pipeline import plan_pipeline
+from synthetic_data import DEFAULT_MISSING_RATE, generate_dataset, parse_rows
+
+# resource gives peak RSS on Linux/macOS; psutil (optional) covers Windows and sums workers running side by side
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Core and DX_PR_GRPS have specs; Severity comes from NIS_Columns and carries APRDRG for the charge model
+BENCHMARK_FILES = ['NIS_2019_Core', 'NIS_2019_DX_PR_GRPS', 'NIS_2019_Severity']
+STAGE_KINDS = ['convert', 'interpolate', 'merge', 'post_merge_interpolate', 'modified_charges']
+MANIFEST_FILE = 'synthetic_manifest.json'
+
+
+def peak_rss_bytes():
+    """Peak resident memory of this process plus its largest finished worker, or None where it can't be measured"""
+    if resource is not None:
+        # RUSAGE_CHILDREN holds the peak of the largest child reaped so far, e.g. a joined pool worker
+        peak = sum(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    return None
+
+
+def _tree_rss(process):
+    """Resident memory of a process and every live descendant"""
+    total = 0
+    for proc in [process] + process.children(recursive=True):
+        try:
+            total += proc.memory_info().rss
+        except psutil.Error:
+            # Workers can exit between listing and reading
+            pass
+    return total
+
+
+class RssSampler:
+    """Tracks the summed RSS of this process and its workers while they run side by side (needs psutil)"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        process = psutil.Process()
+        while True:
+            self.peak = max(self.peak, _tree_rss(process))
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        if psutil is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def _run_measured(stage):
+    """Run one stage in this (fresh) process and report its wall time and the peak memory of it and its workers"""
+    start = time.perf_counter()
+    with RssSampler() as sampler:
+        result = stage.func(**stage.kwargs)
+    seconds = time.perf_counter() - start
+    peaks = [peak for peak in (peak_rss_bytes(), sampler.peak) if peak]
+    return {'seconds': seconds, 'ok': result is not False, 'peak_rss': max(peaks) if peaks else None}
+
+
+def benchmark_stage(stage):
+    """Time one stage in its own process so its peak RSS is its own (and its workers')"""
+    for path in stage.outputs:
+        clear_output(path)
+        if os.path.exists(checkpoint_path(path)):
+            os.remove(checkpoint_path(path))
+
+    input_bytes = sum(path_size(path) for path in stage.inputs)
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        measured = pool.submit(_run_measured, stage).result()
+    rows = count_rows(stage.outputs[0]) if measured['ok'] else 0
+    seconds = measured['seconds']
+    return {
+        'name': stage.name,
+        'kind': stage.kind,
+        'ok': measured['ok'],
+        'seconds': round(seconds, 3),
+        'rows': rows,
+        'input_mb': round(input_bytes / 1024 ** 2, 2),
+        'rows_per_s': round(rows / seconds, 1) if seconds else None,
+        'mb_per_s': round(input_bytes / 1024 ** 2 / seconds, 2) if seconds else None,
+        'peak_rss_mb': round(measured['peak_rss'] / 1024 ** 2, 1) if measured['peak_rss'] else None,
+    }
+
+
+def summarize(results):
+    """Totals per stage kind: summed time, rows and input, and the largest peak RSS"""
+    summary = {}
+    for kind in STAGE_KINDS:
+        stages = [result for result in results if result['kind'] == kind]
+        if not stages:
+            continue
+        seconds = sum(result['seconds'] for result in stages)
+        rows = sum(result['rows'] for result in stages)
+        input_mb = sum(result['input_mb'] for result in stages)
+        peaks = [result['peak_rss_mb'] for result in stages if result['peak_rss_mb'] is not None]
+        summary[kind] = {
+            'stages': len(stages),
+            'seconds': round(seconds, 3),
+            'rows': rows,
+            'input_mb': round(input_mb, 2),
+            'rows_per_s': round(rows / seconds, 1) if seconds else None,
+            'mb_per_s': round(input_mb / seconds, 2) if seconds else None,
+            'peak_rss_mb': max(peaks) if peaks else None,
+        }
+    return summary
+
+
+def environment():
+    """Machine and library versions, so results from different setups aren't compared blindly"""
+    try:
+        import pyarrow
+        pyarrow_version = pyarrow.__version__
+    except ImportError:
+        pyarrow_version = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(),
+            'cpu_count': os.cpu_count(), 'pandas': pd.__version__, 'numpy': np.__version__,
+            'pyarrow': pyarrow_version}
+
+
+def prepare_data(data_dir, rows, files, seed, missing_rate):
+    """Generate the synthetic inputs, reusing them when an earlier run made the same ones"""
+    manifest_path = os.path.join(data_dir, MANIFEST_FILE)
+    wanted = {'rows': rows, 'files': files, 'seed': seed, 'missing_rate': missing_rate}
+    try:
+        with open(manifest_path, 'r') as f:
+            if json.load(f) == wanted:
+                print(f"Reusing synthetic data in {data_dir}")
+                return
+    except (OSError, ValueError):
+        pass
+
+    if os.path.isdir(data_dir):
+        for file in os.listdir(data_dir):
+            clear_output(os.path.join(data_dir, file))
+    # Spec'd files are fixed-width like real HCUP deliveries; the rest are CSVs, as the pipeline expects
+    for name in files:
+        generate_dataset(data_dir, rows, [name], ['asc'] if get_schema(name) else ['csv'], seed, missing_rate)
+    with open(manifest_path, 'w') as f:
+        json.dump(wanted, f)
+
+
+def run_benchmark(rows, work_dir='benchmark_data', files=None, seed=0, missing_rate=DEFAULT_MISSING_RATE,
+                  memory_budget=DEFAULT_MEMORY_BUDGET, output_format='csv', compression=None, kinds=None):
+    """Generate synthetic NIS files and time every pipeline stage over them, one stage at a time"""
+    files = files or BENCHMARK_FILES
+    family, year = files[0].split('_')[:2]
+    data_dir = os.path.join(work_dir, 'data')
+    processed_dir = os.path.join(work_dir, 'processed')
+
+    generate_start = time.perf_counter()
+    prepare_data(os.path.join(data_dir, f'{family}_{year}'), rows, files, seed, missing_rate)
+    generate_seconds = time.perf_counter() - generate_start
+
+    stages = plan_pipeline([family], int(year), data_dir, processed_dir, output_format, None, compression,
+                           None, memory_budget)
+    stages = [stage for stage in stages if kinds is None or stage.kind in kinds]
+    started_at = datetime.now().isoformat(timespec='seconds')
+
+    results = []
+    for stage in stages:
+        print(f"Running {stage.name}...")
+        result = benchmark_stage(stage)
+        results.append(result)
+        print(f"  {result['seconds']:.1f}s, {result['rows_per_s'] or 0:,.0f} rows/s, "
+              f"{result['mb_per_s'] or 0:.1f} MB/s, peak RSS {result['peak_rss_mb']} MB")
+        if not result['ok']:
+            logging.error(f"{stage.name} failed; later stages would read stale inputs, stopping")
+            break
+
+    return {
+        'started_at': started_at,
+        'config': {'rows': rows, 'files': files, 'seed': seed, 'missing_rate': missing_rate,
+                   'memory_budget': memory_budget, 'format': output_format, 'compression': compression},
+        'environment': environment(),
+        'generate_seconds': round(generate_seconds, 3),
+        'total_seconds': round(sum(result['seconds'] for result in results), 3),
+        'stages': results,
+        'by_kind': summarize(results),
+    }
+
+
+def compare(baseline, current):
+    """Per-kind table of seconds, throughput and memory between two benchmark results"""
+    lines = [f"{'stage':<24}{'before s':>10}{'after s':>10}{'speedup':>9}{'rows/s':>14}{'peak MB':>18}"]
+    for kind in STAGE_KINDS:
+        before = baseline['by_kind'].get(kind)
+        after = current['by_kind'].get(kind)
+        if not before or not after:
+            continue
+        speedup = before['seconds'] / after['seconds'] if after['seconds'] else float('inf')
+        memory = f"{before['peak_rss_mb']} -> {after['peak_rss_mb']}"
+        lines.append(f"{kind:<24}{before['seconds']:>10.1f}{after['seconds']:>10.1f}{speedup:>8.2f}x"
+                     f"{after['rows_per_s'] or 0:>14,.0f}{memory:>18}")
+    if baseline['config']['rows'] != current['config']['rows']:
+        lines.append(f"Note: row counts differ ({baseline['config']['rows']:,} vs {current['config']['rows']:,})")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on synthetic HCUP data")
+    parser.add_argument('--rows', default='1M', help="Discharge records to generate, e.g. 1M, 7M or 50M")
+    parser.add_argument('--work-dir', default='benchmark_data', help="Folder for synthetic inputs and stage outputs")
+    parser.add_argument('--files', nargs='*', default=None,
+                        help=f"Files to generate and run through the pipeline (default: {' '.join(BENCHMARK_FILES)})")
+    parser.add_argument('--stages', nargs='*', choices=STAGE_KINDS, default=None,
+                        help="Only time these stage kinds (their inputs must already exist)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for the synthetic data")
+    parser.add_argument('--missing-rate', type=float, default=DEFAULT_MISSING_RATE,
+                        help="Typical share of missing values per field")
+    parser.add_argument('--memory-budget', default=DEFAULT_MEMORY_BUDGET,
+                        help="Memory each stage may size its chunks against, e.g. 512MB or 8GB")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help="Stage output format")
+    parser.add_argument('--compression', choices=COMPRESSION_CHOICES, default=None, help="Stage output codec")
+    parser.add_argument('--output', default=None,
+                        help="Results JSON (default: benchmark_results/benchmark_<rows>_<timestamp>.json)")
+    parser.add_argument('--compare', default=None, help="Earlier results JSON to compare this run against")
+    args = parser.parse_args()
+
+    rows = parse_rows(args.rows)
+    results = run_benchmark(rows, args.work_dir, args.files, args.seed, args.missing_rate, args.memory_budget,
+                            args.format, args.compression, args.stages)
+
+    output = args.output or os.path.join(
+        'benchmark_results', f"benchmark_{args.rows}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nTotal {results['total_seconds']:.1f}s; results saved to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print(compare(json.load(f), results))
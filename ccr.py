@@ -1,18 +1,31 @@
 import pandas as pd
 import numpy as np
 
-def analyze_ccr_data():
+import argparse
+
+from hcup_spec import lookup_dtypes
+from hcup_store import HcupStore, table_name_for
+
+# The only hospital file columns the analysis uses
+CCR_COLUMNS = ['HOSP_BEDSIZE', 'H_CONTRL', 'HOSP_URCAT4', 'HOSP_UR_TEACH',
+               'N_DISC_U', 'N_HOSP_U', 'S_DISC_U', 'S_HOSP_U', 'TOTAL_DISC']
+
+def analyze_ccr_data(store_path=None):
     try:
-        # Read the hospital file
-        df = pd.read_csv('data/NIS_2019/NIS_2019_HOSPITAL.CSV')
+        hospital_file = 'data/NIS_2019/NIS_2019_HOSPITAL.CSV'
+        if store_path:
+            # Load once into the local store; later runs reuse the table while the file is unchanged
+            with HcupStore(store_path) as store:
+                store.load(hospital_file)
+                df = store.table(table_name_for(hospital_file), CCR_COLUMNS)
+        else:
+            # Read the hospital file, parsing only the analysed columns
+            df = pd.read_csv(hospital_file, usecols=CCR_COLUMNS, dtype=lookup_dtypes(CCR_COLUMNS))
         
         print("\n=== Hospital Data Analysis ===")
         
         # Convert columns to numeric where possible
-        numeric_columns = ['HOSP_BEDSIZE', 'H_CONTRL', 'HOSP_URCAT4', 'HOSP_UR_TEACH', 
-                         'N_DISC_U', 'N_HOSP_U', 'S_DISC_U', 'S_HOSP_U', 'TOTAL_DISC']
-        
-        for col in numeric_columns:
+        for col in CCR_COLUMNS:
             df[col] = pd.to_numeric(df[col], errors='coerce')
         
         # Hospital Size Analysis
@@ -65,4 +78,9 @@ def analyze_ccr_data():
         print(f"An error occurred: {str(e)}")
 
 if __name__ == "__main__":
-    analyze_ccr_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Summarise NIS hospital characteristics")
+    parser.add_argument('--store', default=None,
+                        help="Read through a local HCUP store (e.g. hcup_store.db) instead of the CSV")
+    args = parser.parse_args()
+
+    analyze_ccr_data(args.store)
\ No newline at end of file
@@ -0,0 +1,131 @@
+import json
+import os
+import logging
+
+from output_formats import clear_output
+
+
+def checkpoint_path(output_path):
+    """Manifest file that tracks committed work for an output"""
+    return output_path.rstrip('/\\') + '.checkpoint.json'
+
+
+def input_signature(input_path):
+    """Cheap identity of an input file (or dataset directory): size and modification time"""
+    if os.path.isdir(input_path):
+        stats = [os.stat(os.path.join(root, file))
+                 for root, _, files in os.walk(input_path) for file in files]
+        return {'size': sum(s.st_size for s in stats), 'mtime': max((s.st_mtime for s in stats), default=0)}
+    stat = os.stat(input_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+class Checkpoint:
+    """
+    Durable record of completed chunks (or ranges) for a resumable run.
+
+    State is rewritten atomically after each commit, so an interrupted run
+    resumes from the last committed chunk instead of from zero. A checkpoint
+    is only reused when the input and run parameters are unchanged.
+    """
+
+    def __init__(self, output_path, input_path, params=None):
+        self.output_path = output_path
+        self.path = checkpoint_path(output_path)
+        self.key = {'input': os.path.abspath(input_path), 'signature': input_signature(input_path),
+                    'params': params or {}}
+        self.state = {'key': self.key, 'chunks_done': 0, 'rows_done': 0, 'output_bytes': 0, 'units': {}}
+        self.resumed = False
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                saved = None
+
+            if saved and saved.get('key') == json.loads(json.dumps(self.key)):
+                self.state = saved
+                self.resumed = True
+            else:
+                logging.info(f"Ignoring stale checkpoint for {output_path}")
+
+    @property
+    def rows_done(self):
+        return self.state['rows_done']
+
+    @property
+    def carried(self):
+        """State saved with the last commit for the rows after it, if any"""
+        return self.state.get('carried') if self.state['chunks_done'] else None
+
+    def _save(self):
+        """Write the manifest to a temp file and rename it into place"""
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def commit(self, writer, position=None, carried=None):
+        """Record everything the writer has flushed so far as done
+
+        position is where reading resumes when it differs from the rows written,
+        e.g. when filters drop input rows. carried is any JSON-serializable state
+        the rows after it depend on, e.g. values carried across chunks.
+        """
+        self.state['chunks_done'] = writer.n_chunks
+        self.state['rows_done'] = writer.rows_written
+        self.state['position'] = writer.rows_written if position is None else position
+        if carried is not None:
+            self.state['carried'] = carried
+        if writer.output_format == 'csv' and os.path.exists(self.output_path):
+            self.state['output_bytes'] = os.path.getsize(self.output_path)
+        self._save()
+
+    def restore(self, writer):
+        """Roll the output back to the last commit and continue the writer from there"""
+        if not self.resumed or self.state['chunks_done'] == 0:
+            return 0
+
+        if writer.output_format == 'csv':
+            # Drop any partially appended chunk written after the last commit
+            with open(self.output_path, 'r+b') as f:
+                f.truncate(self.state['output_bytes'])
+        else:
+            # Parquet chunk files are numbered; remove any beyond the last commit
+            for root, _, files in os.walk(self.output_path):
+                for file in files:
+                    number = file.split('part-')[-1].split('-')[0]
+                    if number.isdigit() and int(number) >= self.state['chunks_done']:
+                        os.remove(os.path.join(root, file))
+
+        # Offsets of the chunks written before the crash are gone; the row index is rebuilt on demand
+        writer.row_offsets = None
+        writer.n_chunks = self.state['chunks_done']
+        writer.rows_written = self.state['rows_done']
+        writer.overwrite = False
+        logging.info(f"Resuming {self.output_path} after {self.rows_done:,} committed rows")
+        return self.state.get('position', self.rows_done)
+
+    def unit_done(self, unit_id):
+        """True if an independent unit (e.g. a byte range) was committed"""
+        return str(unit_id) in self.state['units']
+
+    def commit_unit(self, unit_id, **info):
+        """Record an independent unit of work as done"""
+        self.state['units'][str(unit_id)] = info
+        self._save()
+
+    def complete(self):
+        """Remove the manifest once the output is whole"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def discard(self):
+        """Start over: remove the manifest and any partial output"""
+        self.complete()
+        clear_output(self.output_path)
+        self.state = {'key': self.key, 'chunks_done': 0, 'rows_done': 0, 'output_bytes': 0, 'units': {}}
+        self.resumed = False
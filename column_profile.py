@@ -0,0 +1,378 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from global_impute import QuantileSketch, _value_counts, can_split
+from hcup_spec import lookup_dtypes, lookup_fields, sentinel_code, sentinel_kind
+from imputation import _python_value
+from memory_budget import DEFAULT_MEMORY_BUDGET, ChunkSizer, estimate_row_bytes, parse_memory_budget
+from output_formats import frame_columns, read_frames
+from row_index import load_row_index, read_row_range, split_row_ranges
+from stage_cache import file_fingerprint, spec_version
+
+# Bump when profiles change shape, so older sidecars are recomputed
+PROFILE_VERSION = 2
+# 2**12 one-byte HyperLogLog registers per column: distinct counts within about 1.6%
+HLL_PRECISION = 12
+# Text columns count this many distinct values exactly; past it only the commonest are kept
+MAX_TRACKED_VALUES = 4096
+# Most frequent values reported per column
+TOP_K = 10
+HISTOGRAM_BINS = 20
+# How a column was parsed, narrowest first; a column that reads differently across chunks takes the widest
+KINDS = ['bool', 'integer', 'float', 'text']
+
+
+def profile_path(path):
+    """Sidecar holding a file's column profile"""
+    return path.rstrip('/\\') + '.profile.json'
+
+
+def _kind(dtype):
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'bool'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'integer'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'float'
+    return 'text'
+
+
+class HyperLogLog:
+    """Mergeable distinct count in 2**HLL_PRECISION bytes"""
+
+    def __init__(self, registers=None):
+        self.registers = np.zeros(1 << HLL_PRECISION, dtype=np.uint8) if registers is None else registers
+
+    def add(self, values):
+        """Count an array of values; repeats don't change the count, so passing each value once is enough"""
+        if not len(values):
+            return
+        # pandas' hashes are stable across processes, so worker registers can be merged
+        hashes = pd.util.hash_array(np.asarray(values))
+        width = 64 - HLL_PRECISION
+        index = (hashes >> np.uint64(width)).astype(np.int64)
+        rest = hashes & np.uint64((1 << width) - 1)
+        # The register keeps the highest position of the first set bit in what follows the index bits
+        length = np.zeros(len(rest), dtype=np.int64)
+        set_bits = rest > 0
+        length[set_bits] = np.floor(np.log2(rest[set_bits].astype(np.float64))).astype(np.int64) + 1
+        # log2 of a value just under a power of two can round up to it
+        shift = np.where(set_bits, length - 1, 0).astype(np.uint64)
+        length[set_bits & (np.left_shift(np.uint64(1), shift) > rest)] -= 1
+        np.maximum.at(self.registers, index, (width - length + 1).astype(np.uint8))
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        empty = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and empty:
+            # Small counts are more accurate from the share of registers never hit
+            estimate = m * np.log(m / empty)
+        return int(round(estimate))
+
+    def as_dict(self):
+        return base64.b64encode(self.registers.tobytes()).decode('ascii')
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(np.frombuffer(base64.b64decode(data), dtype=np.uint8).copy())
+
+
+class ColumnProfile:
+    """
+    Mergeable profile of one column.
+
+    Counts nulls and HCUP sentinel codes; numbers otherwise get their range,
+    mean and standard deviation and a QuantileSketch for their histogram and
+    commonest values, text gets value counts. Sentinels are kept out of the
+    numeric statistics so -9s don't drag a mean down.
+    """
+
+    def __init__(self, field=None):
+        # The column's spec field, which says how wide its sentinel codes are
+        self.field = field
+        self.kind = None
+        self.rows = 0
+        self.nulls = 0
+        self.sentinels = {}
+        # Running count, mean and sum of squared deviations, merged as Chan et al. do
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.whole = True
+        self.sketch = QuantileSketch()
+        self.counts = {}
+        self.truncated = False
+        self.hll = HyperLogLog()
+
+    def add(self, series):
+        kind = _kind(series.dtype)
+        self.kind = kind if self.kind is None else max(self.kind, kind, key=KINDS.index)
+        self.rows += len(series)
+        if kind in ('integer', 'float'):
+            self._add_numbers(series)
+        else:
+            self._add_values(series)
+
+    def _add_numbers(self, series):
+        values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        null = np.isnan(values)
+        self.nulls += int(null.sum())
+        values = values[~null & np.isfinite(values)]
+        if not len(values):
+            return
+        values, counts = _value_counts(values)
+
+        sentinel = np.zeros(len(values), dtype=bool)
+        # Check codes in the precision they were read in, so a float32 -99.99 is recognised
+        precision = np.float32 if series.dtype in (np.float32, pd.Float32Dtype()) else np.float64
+        for i in np.flatnonzero(values < 0):
+            code = sentinel_code(precision(values[i]), self.field)
+            if code is not None:
+                sentinel[i] = True
+                self.sentinels[code] = self.sentinels.get(code, 0) + int(counts[i])
+        values, counts = values[~sentinel], counts[~sentinel]
+        if not len(values):
+            return
+
+        n = int(counts.sum())
+        mean = float(np.dot(values, counts) / n)
+        m2 = float(np.dot((values - mean) ** 2, counts))
+        self._merge_moments(n, mean, m2)
+        self.min = float(values[0]) if self.min is None else min(self.min, float(values[0]))
+        self.max = float(values[-1]) if self.max is None else max(self.max, float(values[-1]))
+        self.whole = self.whole and bool((values == np.floor(values)).all())
+        self.sketch.add_counts(values, counts)
+        self.hll.add(values)
+
+    def _add_values(self, series):
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes = series.array.codes
+            counts = np.bincount(codes[codes >= 0], minlength=len(series.cat.categories))
+            seen = np.flatnonzero(counts)
+            values, counts = series.cat.categories[seen].tolist(), counts[seen].tolist()
+        else:
+            counted = series.value_counts(sort=False)
+            values, counts = [_python_value(value) for value in counted.index], counted.tolist()
+        self.nulls += len(series) - sum(counts)
+
+        kept = []
+        for value, count in zip(values, counts):
+            code = sentinel_code(value)
+            if code is not None:
+                self.sentinels[code] = self.sentinels.get(code, 0) + count
+                continue
+            self.counts[value] = self.counts.get(value, 0) + count
+            kept.append(value)
+        self.hll.add(np.array([str(value) for value in kept], dtype=object))
+        self._prune()
+
+    def _merge_moments(self, n, mean, m2):
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+
+    def _prune(self):
+        if len(self.counts) > MAX_TRACKED_VALUES:
+            # Rare values are dropped, so the counts of what's left are lower bounds
+            top = sorted(self.counts.items(), key=lambda item: -item[1])[:MAX_TRACKED_VALUES]
+            self.counts = dict(top)
+            self.truncated = True
+
+    def merge(self, other):
+        if other.kind is not None:
+            self.kind = other.kind if self.kind is None else max(self.kind, other.kind, key=KINDS.index)
+        self.rows += other.rows
+        self.nulls += other.nulls
+        for code, count in other.sentinels.items():
+            self.sentinels[code] = self.sentinels.get(code, 0) + count
+        if other.count:
+            self._merge_moments(other.count, other.mean, other.m2)
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+            self.whole = self.whole and other.whole
+            self.sketch.merge(other.sketch)
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        self.truncated = self.truncated or other.truncated
+        self._prune()
+        self.hll.merge(other.hll)
+
+    def _histogram(self):
+        pairs = self.sketch._sorted_counts()
+        values = np.array([value for value, _ in pairs], dtype=np.float64)
+        weights = np.array([count for _, count in pairs], dtype=np.float64)
+        # Bucketed values stand for their bucket and can fall just outside the true range
+        counts, edges = np.histogram(np.clip(values, self.min, self.max), bins=HISTOGRAM_BINS,
+                                     range=(self.min, self.max), weights=weights)
+        return {'edges': edges.tolist(), 'counts': counts.astype(np.int64).tolist()}
+
+    def summary(self):
+        """The profile as reported and saved"""
+        summary = {'kind': self.kind, 'rows': self.rows, 'nulls': self.nulls,
+                   'sentinels': {code: {'kind': sentinel_kind(code), 'count': count}
+                                 for code, count in sorted(self.sentinels.items())}}
+        if self.count:
+            exact = not self.sketch.bucketed
+            counts = self.sketch.exact if exact else {}
+            summary.update(min=self.min, max=self.max, mean=self.mean,
+                           std=float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else 0.0,
+                           whole=self.whole, histogram=self._histogram())
+        else:
+            exact = not self.truncated
+            counts = self.counts
+        summary['distinct'] = len(counts) if exact else self.hll.estimate()
+        summary['distinct_exact'] = exact
+        top = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))[:TOP_K]
+        summary['top'] = [[value, count] for value, count in top]
+        return summary
+
+
+def _merge_profiles(profiles, other):
+    for col, profile in other.items():
+        if col in profiles:
+            profiles[col].merge(profile)
+        else:
+            profiles[col] = profile
+
+
+def profile_frames(frames, profiles=None):
+    """Add every column of a stream of chunks to {column: ColumnProfile}"""
+    profiles = {} if profiles is None else profiles
+    for chunk in frames:
+        new = [col for col in chunk.columns if col not in profiles]
+        if new:
+            fields = lookup_fields(new)
+            for col in new:
+                profiles[col] = ColumnProfile(fields.get(col))
+        for col in chunk.columns:
+            profiles[col].add(chunk[col])
+    return profiles
+
+
+def _profile_range(path, start, stop, dtypes, chunk_size):
+    """Worker: profiles of rows [start, stop) of a CSV"""
+    index = load_row_index(path, build=False)
+    return profile_frames(read_row_range(path, start, stop, chunk_size, index, dtype=dtypes, low_memory=False))
+
+
+def compute_profile(path, workers=1, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Profile every column of a CSV file or Parquet dataset in one pass.
+
+    Plain CSVs are split into row ranges profiled side by side with
+    workers > 1; compressed CSVs and Parquet datasets are read as one stream.
+    Columns are read with the spec dtypes the pipeline stages use.
+    """
+    columns = frame_columns(path)
+    dtypes = lookup_dtypes(columns, float_numeric=True)
+    workers = max(workers, 1)
+    profiles = {}
+
+    if workers == 1 or not can_split(path):
+        sizer = ChunkSizer(memory_budget, estimate_row_bytes(columns, dtypes), in_flight=2)
+        frames = sizer.track(read_frames(path, chunk_size=sizer, dtype=dtypes, low_memory=False))
+        with tqdm(unit='rows', desc="Profiling columns") as pbar:
+            for chunk in frames:
+                profile_frames([chunk], profiles)
+                pbar.update(len(chunk))
+    else:
+        index = load_row_index(path)
+        # Several ranges per worker keep the pool busy when ranges finish unevenly
+        ranges = split_row_ranges(index, workers * 4)
+        chunk_size = ChunkSizer(parse_memory_budget(memory_budget) / workers, estimate_row_bytes(columns, dtypes),
+                                in_flight=2)()
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                tqdm(total=index['n_rows'], unit='rows', desc="Profiling columns") as pbar:
+            futures = [executor.submit(_profile_range, path, start, stop, dtypes, chunk_size)
+                       for start, stop in ranges]
+            # Merged in file order, so columns keep the order they were first seen in
+            for (start, stop), future in zip(ranges, futures):
+                _merge_profiles(profiles, future.result())
+                pbar.update(stop - start)
+
+    rows = max((profile.rows for profile in profiles.values()), default=0)
+    return {'rows': rows, 'columns': {col: profile.summary() for col, profile in profiles.items()}}
+
+
+def load_profile(path, workers=1, memory_budget=DEFAULT_MEMORY_BUDGET, refresh=False):
+    """
+    Column profile of a file, read from its sidecar while the file and specs
+    are unchanged and computed (then saved) otherwise.
+    """
+    key = json.loads(json.dumps({'fingerprint': file_fingerprint(path), 'spec': spec_version(),
+                                 'version': PROFILE_VERSION}))
+    sidecar = profile_path(path)
+    if not refresh:
+        try:
+            with open(sidecar, 'r') as f:
+                saved = json.load(f)
+            if saved.get('key') == key:
+                logging.info(f"Reusing column profile from {sidecar}")
+                return saved['profile']
+        except (OSError, ValueError):
+            pass
+
+    logging.info(f"Profiling columns of {path}")
+    profile = compute_profile(path, workers, memory_budget)
+    temp_path = f'{sidecar}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump({'key': key, 'profile': profile}, f)
+        os.replace(temp_path, sidecar)
+    except OSError as e:
+        # A read-only data folder only costs us the cache
+        logging.debug(f"Could not save the column profile of {path}: {e}")
+    return profile
+
+
+def format_profile(profile):
+    """One line per column: kind, nulls, sentinels, distinct values and range"""
+    rows = profile['rows'] or 1
+    lines = [f"{'column':<28}{'kind':>8}{'null %':>8}{'sentinels':>11}{'distinct':>11}{'min':>14}{'max':>14}"]
+    for col, summary in profile['columns'].items():
+        sentinels = sum(sentinel['count'] for sentinel in summary['sentinels'].values())
+        distinct = f"{summary['distinct']:,}" + ('' if summary['distinct_exact'] else '~')
+        low = f"{summary['min']:.6g}" if 'min' in summary else ''
+        high = f"{summary['max']:.6g}" if 'max' in summary else ''
+        lines.append(f"{col:<28}{summary['kind']:>8}{100 * summary['nulls'] / rows:>8.2f}{sentinels:>11,}"
+                     f"{distinct:>11}{low:>14}{high:>14}")
+    return '\n'.join(lines)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+
+    parser = argparse.ArgumentParser(description="Profile every column of a converted HCUP file in one pass")
+    parser.add_argument('input', help="CSV file or Parquet dataset")
+    parser.add_argument('--workers', type=int, default=1, help="Processes profiling row ranges of a plain CSV")
+    parser.add_argument('--memory-budget', default=DEFAULT_MEMORY_BUDGET,
+                        help="Memory to size chunks against, e.g. 512MB or 8GB")
+    parser.add_argument('--refresh', action='store_true', help="Profile again even if a saved profile is current")
+    parser.add_argument('--json', action='store_true', help="Print the full profile as JSON")
+    args = parser.parse_args()
+
+    profile = load_profile(args.input, args.workers, args.memory_budget, args.refresh)
+    print(json.dumps(profile, indent=2) if args.json else format_profile(profile))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import gzip
+import io
+import os
+import queue
+import threading
+import zipfile
+
+# zstandard is only needed for .zst inputs and outputs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd', '.zip': 'zip'}
+# Codecs we can write: each appended chunk becomes its own gzip member or zstd frame
+CSV_CODECS = {'gzip': '.gz', 'zstd': '.zst'}
+COMPRESSION_CHOICES = ['none', 'gzip', 'zstd']
+
+
+def require_zstandard():
+    """Fail with an install hint when a .zst file is used without zstandard"""
+    if zstandard is None:
+        raise ImportError("Reading or writing .zst files requires zstandard. Please run: pip install zstandard")
+
+
+def compression_of(path):
+    """Codec implied by a file's extension ('gzip', 'zstd', 'zip'), or None for plain files"""
+    return CODEC_EXTENSIONS.get(os.path.splitext(path.rstrip('/\\'))[1].lower())
+
+
+def zip_member(path):
+    """Name of the data file inside an HCUP zip archive (the largest member)"""
+    with zipfile.ZipFile(path) as archive:
+        members = [info for info in archive.infolist() if not info.is_dir()]
+    if not members:
+        raise ValueError(f"{path} is an empty archive")
+    return max(members, key=lambda info: info.file_size).filename
+
+
+def strip_compression(path):
+    """Logical data file name behind a compressed file, e.g. NIS_2019_Core.ASC.gz -> NIS_2019_Core.ASC"""
+    codec = compression_of(path)
+    if codec is None:
+        return path
+    if codec == 'zip' and os.path.exists(path):
+        return os.path.join(os.path.dirname(path), os.path.basename(zip_member(path)))
+    return os.path.splitext(path)[0]
+
+
+def _open_decompressor(path):
+    """Unbuffered decompressing binary stream for a compressed file"""
+    codec = compression_of(path)
+    if codec == 'gzip':
+        return gzip.open(path, 'rb')
+    if codec == 'zstd':
+        require_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    if codec == 'zip':
+        archive = zipfile.ZipFile(path)
+        return _ZipMemberStream(archive, archive.open(zip_member(path)))
+    return open(path, 'rb')
+
+
+class _ZipMemberStream(io.RawIOBase):
+    """Zip member stream that also closes its archive"""
+
+    def __init__(self, archive, member):
+        self._archive = archive
+        self._member = member
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._member.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._member.close()
+            self._archive.close()
+        super().close()
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Read a stream ahead on a background thread.
+
+    Decompression runs while the consumer parses the previous block; at most
+    `depth` blocks are held in memory.
+    """
+
+    def __init__(self, raw, block_size=4 * 1024 * 1024, depth=8):
+        self._raw = raw
+        self._block_size = block_size
+        self._queue = queue.Queue(maxsize=depth)
+        self._block = memoryview(b'')
+        self._eof = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._stopped.is_set():
+                block = self._raw.read(self._block_size)
+                self._queue.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            # Surface decompression errors in the reading thread
+            self._queue.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not len(self._block) and not self._eof:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            self._eof = not item
+            self._block = memoryview(item)
+
+        n = min(len(b), len(self._block))
+        b[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stopped.set()
+            # Unblock the producer if it is waiting on a full queue
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._raw.close()
+        super().close()
+
+
+def open_input(path, threaded=True, block_size=4 * 1024 * 1024):
+    """
+    Open a data file for binary streaming, decompressing .gz, .zst and .zip on the fly.
+
+    Plain files are returned as ordinary (seekable) files. Compressed files are
+    decompressed on a background thread unless threaded=False.
+    """
+    if compression_of(path) is None:
+        return open(path, 'rb')
+    raw = _open_decompressor(path)
+    if threaded:
+        raw = ThreadedReader(raw, block_size)
+    return io.BufferedReader(raw, buffer_size=block_size)
+
+
+def open_text(path):
+    """Text stream over a possibly compressed CSV"""
+    return io.TextIOWrapper(open_input(path, threaded=False), newline='')
+
+
+def skip_bytes(f, n_bytes, block_size=16 * 1024 * 1024):
+    """Advance a stream that may not be seekable"""
+    if f.seekable():
+        f.seek(n_bytes, os.SEEK_CUR)
+        return
+    while n_bytes > 0:
+        skipped = len(f.read(min(block_size, n_bytes)))
+        if not skipped:
+            break
+        n_bytes -= skipped
+
+
+def with_codec_extension(path, compression):
+    """Append the extension for a CSV output codec ('none' or None leaves the path alone)"""
+    if compression in (None, 'none'):
+        return path
+    if compression not in CSV_CODECS:
+        raise ValueError(f"Unknown compression '{compression}'; expected one of {COMPRESSION_CHOICES}")
+    return path + CSV_CODECS[compression]
+
+
+def compress_bytes(data, path, level=None):
+    """Compress a small block (e.g. a header line) as a standalone member for path's codec"""
+    codec = compression_of(path)
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=9 if level is None else level)
+    if codec == 'zstd':
+        require_zstandard()
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    return data
+
+
+def csv_compression_options(path, level=None):
+    """pandas to_csv compression argument for an output path"""
+    codec = compression_of(path)
+    if codec is None:
+        return None
+    if codec == 'zip':
+        raise ValueError("Zip archives can't be appended to; write .gz or .zst output instead")
+    if codec == 'zstd':
+        require_zstandard()
+        return {'method': 'zstd', 'level': level} if level is not None else {'method': 'zstd'}
+    return {'method': 'gzip', 'compresslevel': level} if level is not None else {'method': 'gzip'}
@@ -1,8 +1,22 @@
+import argparse
 import os
+import queue
+import shutil
 import pandas as pd
 import sys
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import Manager
 from tqdm import tqdm
 
+from asc_reader import AscDataset, project_fields, read_asc_chunks, get_record_stride
+from checkpoint import Checkpoint, checkpoint_path
+from compression import COMPRESSION_CHOICES, compress_bytes, compression_of, csv_compression_options, strip_compression
+from filters import parse_filters
+from hcup_spec import schema_for_file, without_sentinels
+from memory_budget import DEFAULT_MEMORY_BUDGET, ChunkSizer, estimate_row_bytes, parse_memory_budget
+from output_formats import ChunkWriter, OUTPUT_FORMATS, clear_output, output_path_for, read_csv_chunks
+from stage_cache import run_cached, stage_code_files
+
 def get_delimiter(file_path, chunk_size=1024):
     """Detect the delimiter by reading the first chunk of the file"""
     with open(file_path, 'r') as f:
@@ -15,17 +29,218 @@ def get_delimiter(file_path, chunk_size=1024):
     
     return most_common[0] if most_common[1] > 0 else None
 
-def convert_asc_to_csv():
+def fields_row_bytes(fields):
+    """Estimated bytes per decoded record, before any chunk has been measured"""
+    dtypes = {field['name']: field.get('dtype') or ('float64' if field['type'] == 'Num' else 'object')
+              for field in fields}
+    return estimate_row_bytes(list(dtypes), dtypes)
+
+def convert_fixed_width_file(asc_path, csv_path, schema, memory_budget=DEFAULT_MEMORY_BUDGET, output_format='csv',
+                             partition_cols=None, resume=True, compression=None, compression_level=None,
+                             columns=None, filters=None):
+    """Convert a fixed-width HCUP ASC file (plain, .gz, .zst or .zip) to CSV or Parquet using its spec schema
+
+    columns limits the output to those fields; the bytes of the other fields are never decoded.
+    filters keeps only matching records, decoding just the predicate fields of the rest.
+    """
+    fields = project_fields(schema, columns)
+    record_length = schema['header']['record_length']
+    stride = get_record_stride(asc_path, record_length)
+    if compression_of(asc_path):
+        # Progress is measured in uncompressed bytes, which the spec's observation count gives us
+        file_size = (schema['header'].get('n_observations') or 0) * stride or None
+    else:
+        file_size = os.path.getsize(asc_path)
+
+    print(f"\nProcessing {os.path.basename(asc_path)} with spec {os.path.basename(schema['spec_path'])} "
+          f"({len(fields)} fields, record length {record_length})")
+
+    writer = ChunkWriter(csv_path, output_format, partition_cols, compression, compression_level)
+
+    # Each chunk is committed to a checkpoint; a rerun seeks past the committed records.
+    # Chunk boundaries don't change the output, so the budget is not part of the key
+    # Masked and raw sentinel codes must not be mixed in one output
+    checkpoint = Checkpoint(csv_path, asc_path, {'format': output_format, 'partition_cols': partition_cols,
+                                                 'columns': columns, 'filters': filters,
+                                                 'sentinels': any(field.get('sentinels') for field in fields)})
+    if not resume:
+        checkpoint.discard()
+    start_record = checkpoint.restore(writer)
+    position = start_record
+
+    # The raw block, its decoded chunk and the chunk's CSV text are alive together
+    sizer = ChunkSizer(memory_budget, fields_row_bytes(fields), in_flight=3)
+
+    with tqdm(total=file_size, initial=start_record * stride, unit='B', unit_scale=True, desc="Converting") as pbar:
+        for chunk in sizer.track(read_asc_chunks(asc_path, fields, record_length, sizer, start_record, filters)):
+            if filters is None:
+                position += len(chunk)
+            elif len(chunk):
+                # Filtered chunks are labelled with their record numbers
+                position = int(chunk.index[-1]) + 1
+            else:
+                continue
+            writer.write(chunk)
+            checkpoint.commit(writer, position)
+            pbar.update((min(position * stride, file_size) if file_size else position * stride) - pbar.n)
+
+    if writer.n_chunks == 0:
+        # Nothing matched; still leave a header (or schema) behind
+        writer.write(pd.DataFrame(columns=[field['name'] for field in fields]))
+    checkpoint.complete()
+    return writer.close()
+
+def split_record_ranges(n_records, n_parts):
+    """Split record indices into contiguous [start, stop) ranges, one per part"""
+    n_parts = max(1, min(n_parts, n_records))
+    bounds = [n_records * i // n_parts for i in range(n_parts + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(n_parts)]
+
+def _convert_record_range(asc_path, part_path, schema, start, stop, chunk_size, progress,
+                          output_format='csv', partition_cols=None, part_prefix='', compression=None,
+                          compression_level=None, columns=None, filters=None):
+    """Worker: decode records [start, stop) into a headerless CSV part or Parquet dataset files; returns rows kept"""
+    rows = 0
+    dataset = AscDataset(asc_path, schema)
+
+    if output_format == 'parquet':
+        # Clear leftovers of this range from an interrupted run before rewriting it
+        remove_range_files(part_path, part_prefix)
+        # Each range writes its own prefixed files straight into the shared dataset directory
+        writer = ChunkWriter(part_path, 'parquet', partition_cols, compression, compression_level,
+                             part_prefix=part_prefix, overwrite=False)
+        for chunk_start in range(start, stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            chunk = dataset.columns(columns, chunk_start, chunk_stop, filters)
+            if len(chunk):
+                writer.write(chunk)
+            rows += len(chunk)
+            progress.put(chunk_stop - chunk_start)
+        return rows
+
+    # Write under a temporary name so a part file only exists once it is complete.
+    # Compressed parts hold whole gzip members / zstd frames, so they concatenate cleanly
+    csv_compression = csv_compression_options(part_path, compression_level)
+    with open(part_path + '.tmp', 'wb') as f:
+        for chunk_start in range(start, stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            chunk = dataset.columns(columns, chunk_start, chunk_stop, filters)
+            chunk.to_csv(f, index=False, header=False, compression=csv_compression)
+            rows += len(chunk)
+            progress.put(chunk_stop - chunk_start)
+    os.replace(part_path + '.tmp', part_path)
+    return rows
+
+def remove_range_files(dataset_path, part_prefix):
+    """Delete the Parquet files one range wrote into a dataset directory"""
+    if not os.path.isdir(dataset_path):
+        return
+    for root, _, files in os.walk(dataset_path):
+        for file in files:
+            if file.startswith(part_prefix):
+                os.remove(os.path.join(root, file))
+
+def stitch_parts(part_paths, output_path, header_line=None, buffer_size=16 * 1024 * 1024, compression_level=None):
+    """Concatenate part files in order into output_path with large block copies"""
+    with open(output_path, 'wb') as out:
+        if header_line is not None:
+            out.write(compress_bytes(header_line.encode(), output_path, compression_level))
+        for part_path in part_paths:
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, out, buffer_size)
+
+def convert_fixed_width_file_parallel(asc_path, csv_path, schema, workers, memory_budget=DEFAULT_MEMORY_BUDGET,
+                                      output_format='csv', partition_cols=None, resume=True, compression=None,
+                                      compression_level=None, columns=None, filters=None):
+    """Convert an ASC file using a process pool over record-aligned byte ranges"""
+    if compression_of(asc_path):
+        # Workers need random access to their ranges, which a compressed stream can't give
+        print(f"\n{os.path.basename(asc_path)} is compressed; converting it in a single stream")
+        return convert_fixed_width_file(asc_path, csv_path, schema, memory_budget, output_format, partition_cols,
+                                        resume, compression, compression_level, columns, filters)
+
+    dataset = AscDataset(asc_path, schema)
+    n_records = len(dataset)
+    fields = project_fields(schema, columns)
+
+    # Several ranges per worker keep the pool busy when ranges finish unevenly
+    ranges = split_record_ranges(n_records, workers * 4)
+
+    # Finished ranges are recorded in a checkpoint so a rerun only redoes the rest
+    checkpoint = Checkpoint(csv_path, asc_path, {'ranges': ranges, 'format': output_format,
+                                                 'partition_cols': partition_cols, 'columns': columns,
+                                                 'filters': filters,
+                                                 'sentinels': any(field.get('sentinels') for field in fields)})
+    if not resume:
+        checkpoint.discard()
+
+    if output_format == 'parquet':
+        # Range files land directly in the dataset; prefixes keep them in record order
+        if not checkpoint.resumed:
+            clear_output(csv_path)
+        parts_dir = None
+        part_paths = [csv_path] * len(ranges)
+    else:
+        parts_dir = csv_path + '.parts'
+        os.makedirs(parts_dir, exist_ok=True)
+        # Parts carry the output's codec extension so they are compressed the same way
+        suffix = csv_path[len(strip_compression(csv_path)):]
+        part_paths = [os.path.join(parts_dir, f'part_{i:05d}.csv{suffix}') for i in range(len(ranges))]
+
+    # Workers share the budget; each decodes fixed-size chunks of its range
+    chunk_size = ChunkSizer(parse_memory_budget(memory_budget) / workers, fields_row_bytes(fields), in_flight=3)()
+
+    todo = [i for i in range(len(ranges)) if not checkpoint.unit_done(i)]
+    done_rows = sum(stop - start for i, (start, stop) in enumerate(ranges) if i not in todo)
+
+    print(f"\nProcessing {os.path.basename(asc_path)} with {workers} workers "
+          f"({len(todo)} of {len(ranges)} ranges to do, {n_records:,} records)")
+
+    with Manager() as manager, ProcessPoolExecutor(max_workers=workers) as executor:
+        progress = manager.Queue()
+        pending = {
+            executor.submit(_convert_record_range, asc_path, part_paths[i], schema, ranges[i][0], ranges[i][1],
+                            chunk_size, progress, output_format, partition_cols, f'range-{i:05d}-',
+                            compression, compression_level, columns, filters): i
+            for i in todo
+        }
+
+        # Workers report rows per chunk through a shared queue
+        with tqdm(total=n_records, initial=done_rows, unit='rows', desc="Converting") as pbar:
+            while pending:
+                done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rows = future.result()
+                    checkpoint.commit_unit(pending.pop(future), rows=rows)
+                while True:
+                    try:
+                        pbar.update(progress.get_nowait())
+                    except queue.Empty:
+                        break
+
+    if parts_dir:
+        header_line = ','.join(field['name'] for field in fields) + '\n'
+        stitch_parts(part_paths, csv_path, header_line, compression_level=compression_level)
+        shutil.rmtree(parts_dir)
+
+    checkpoint.complete()
+    # Ranges report the rows they kept, which filters may make fewer than the records scanned
+    return sum(unit['rows'] for unit in checkpoint.state['units'].values())
+
+def convert_asc_to_csv(folder=r'C:\analysis\data\KID_2019', workers=1, output_format='csv', partition_cols=None,
+                       resume=True, use_cache=True, compression=None, compression_level=None,
+                       memory_budget=DEFAULT_MEMORY_BUDGET, columns=None, filters=None, keep_sentinels=False):
     # Path to KID_2019 folder using absolute path
-    kid_folder = r'C:\analysis\data\KID_2019'
+    kid_folder = folder
     
     # Check if folder exists
     if not os.path.exists(kid_folder):
         print(f"Error: {kid_folder} directory not found")
         return
     
-    # Get all .ASC files in the directory
-    asc_files = [f for f in os.listdir(kid_folder) if f.endswith('.ASC')]
+    # Get all .ASC files in the directory, including ones still in .gz/.zst/.zip archives
+    asc_files = [f for f in os.listdir(kid_folder)
+                 if os.path.isfile(os.path.join(kid_folder, f)) and strip_compression(os.path.join(kid_folder, f)).endswith('.ASC')]
     
     if not asc_files:
         print(f"No .ASC files found in {kid_folder}")
@@ -37,13 +252,43 @@ def convert_asc_to_csv():
     
     for asc_file in asc_files:
         asc_path = os.path.join(kid_folder, asc_file)
-        csv_filename = os.path.splitext(asc_file)[0] + '.csv'
-        csv_path = os.path.join(kid_folder, csv_filename)
+        csv_path = output_path_for(strip_compression(asc_path), output_format, compression)
+        csv_filename = os.path.basename(csv_path)
         
         try:
+            # HCUP ASC files are fixed-width; prefer the spec layout when one is available
+            schema = schema_for_file(asc_path)
+            if schema:
+                if keep_sentinels:
+                    # Write -9/-99/invl codes as they appear instead of leaving the fields empty
+                    schema = without_sentinels(schema)
+                if workers > 1:
+                    convert = lambda: convert_fixed_width_file_parallel(asc_path, csv_path, schema, workers,
+                                                                        memory_budget, output_format, partition_cols,
+                                                                        resume,
+                                                                        compression, compression_level, columns,
+                                                                        filters)
+                else:
+                    convert = lambda: convert_fixed_width_file(asc_path, csv_path, schema, memory_budget,
+                                                               output_format, partition_cols, resume,
+                                                               compression, compression_level, columns,
+                                                               filters)
+                if use_cache:
+                    # Worker count and chunk sizes do not change the output, so they are left out of the cache key
+                    total_rows = run_cached('convert', [asc_path], [csv_path], convert,
+                                            params={'format': output_format,
+                                                    'partition_cols': partition_cols, 'compression': compression,
+                                                    'compression_level': compression_level, 'columns': columns,
+                                                    'filters': filters, 'keep_sentinels': keep_sentinels},
+                                            code_files=stage_code_files('convert'))
+                else:
+                    total_rows = convert()
+                print(f"Successfully converted {asc_file} to {csv_filename}")
+                print(f"Total rows processed: {total_rows:,}")
+                continue
+
             # Get file size for progress bar
             file_size = os.path.getsize(asc_path)
-            chunk_size = 100000  # Adjust chunk size based on your memory constraints
             
             # Detect delimiter
             delimiter = get_delimiter(asc_path)
@@ -53,14 +298,15 @@ def convert_asc_to_csv():
                 
             print(f"\nProcessing {asc_file} with delimiter '{delimiter}'")
             
-            # Read and process the file in chunks
-            chunks = pd.read_csv(
+            # Read and process the file in chunks sized to the memory budget
+            sizer = ChunkSizer(memory_budget, in_flight=2)
+            chunks = sizer.track(read_csv_chunks(
                 asc_path,
+                sizer,
                 delimiter=delimiter,
-                chunksize=chunk_size,
                 low_memory=False,
                 on_bad_lines='warn'
-            )
+            ))
             
             # Process first chunk to get headers
             first_chunk = True
@@ -84,9 +330,37 @@ def convert_asc_to_csv():
             
         except Exception as e:
             print(f"Error converting {asc_file}: {str(e)}")
-            # Remove partially created CSV file if conversion failed
-            if os.path.exists(csv_path):
-                os.remove(csv_path)
+            if os.path.exists(checkpoint_path(csv_path)):
+                # Keep committed work so a rerun resumes instead of starting over
+                print(f"Partial output kept for {csv_filename}; rerun to resume from the last checkpoint")
+            else:
+                # Remove partially created output if conversion failed
+                clear_output(csv_path)
 
 if __name__ == "__main__":
-    convert_asc_to_csv() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Convert HCUP ASC files to CSV")
+    parser.add_argument('--folder', default=r'C:\analysis\data\KID_2019', help="Folder containing .ASC files")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes per file (1 = serial)")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help="Output format")
+    parser.add_argument('--partition-by', nargs='*', default=None,
+                        help="Columns to partition Parquet output by, e.g. HOSP_DIVISION DQTR")
+    parser.add_argument('--restart', action='store_true', help="Ignore checkpoints and convert from scratch")
+    parser.add_argument('--no-cache', action='store_true', help="Re-run even if inputs and parameters are unchanged")
+    parser.add_argument('--compression', choices=COMPRESSION_CHOICES, default=None,
+                        help="Output codec (CSV gets a .gz/.zst extension; Parquet defaults to zstd)")
+    parser.add_argument('--compression-level', type=int, default=None, help="Codec compression level")
+    parser.add_argument('--memory-budget', default=DEFAULT_MEMORY_BUDGET,
+                        help="Memory to size chunks against, e.g. 512MB or 8GB")
+    parser.add_argument('--columns', nargs='*', default=None,
+                        help="Only decode and write these spec columns, e.g. KEY_NIS HOSP_NIS TOTCHG")
+    parser.add_argument('--filter', action='append', default=None, dest='filters',
+                        help="Keep only matching records, e.g. 'HOSP_DIVISION == 3' or 'AGE between 18,64' "
+                             "(repeat to AND several)")
+    parser.add_argument('--keep-sentinels', action='store_true',
+                        help="Write HCUP missing/invalid codes (-9, -88, invl) as read instead of as empty fields")
+    args = parser.parse_args()
+
+    convert_asc_to_csv(args.folder, args.workers, args.format, args.partition_by, not args.restart,
+                       use_cache=not args.no_cache, compression=args.compression,
+                       compression_level=args.compression_level, memory_budget=args.memory_budget,
+                       columns=args.columns, filters=parse_filters(args.filters), keep_sentinels=args.keep_sentinels) 
\ No newline at end of file
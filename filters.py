@@ -0,0 +1,141 @@
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+
+# Row filters are in disjunctive normal form, like pyarrow's read filters:
+# [(col, op, value), ...] is an AND of terms, and a list of such lists is an OR of them.
+FILTER_OPS = ['==', '!=', '<', '<=', '>', '>=', 'in', 'not in']
+
+FILTER_COMPARE = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+                  '>': operator.gt, '>=': operator.ge}
+_FILTER_RE = re.compile(r'^\s*(\w+)\s*(==|=|!=|<=|>=|<|>|not\s+in\b|in\b|between\b)\s*(.+?)\s*$', re.IGNORECASE)
+
+
+def _parse_value(text):
+    """
+    Number if it looks like one and reads back as the same text, otherwise the
+    text without surrounding quotes. Tokens like 01 or 0016070 stay as typed,
+    so Char codes keep their leading zeros; numeric columns compare them as
+    numbers (see filter_number).
+    """
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in '"\'':
+        return text[1:-1]
+    for cast in (int, float):
+        try:
+            value = cast(text)
+        except ValueError:
+            continue
+        return value if str(value) == text else text
+    return text
+
+
+def filter_number(value):
+    """A filter value to compare with a numeric column: text that parses as a number becomes one"""
+    if isinstance(value, str):
+        for cast in (int, float):
+            try:
+                return cast(value)
+            except ValueError:
+                pass
+    return value
+
+
+def filter_value(value, text):
+    """A filter value (or list of them, for 'in') for a Char column if text, otherwise a numeric one"""
+    if isinstance(value, (list, tuple, set)):
+        return [filter_value(v, text) for v in value]
+    return str(value) if text else filter_number(value)
+
+
+def parse_filter(text):
+    """
+    Parse one command-line filter into AND terms.
+
+    Accepts e.g. "HOSP_DIVISION == 3", "AGE >= 65", "APRDRG in 139,140,720"
+    and "DQTR between 2,3" (both ends inclusive).
+    """
+    match = _FILTER_RE.match(text)
+    if not match:
+        raise ValueError(f"Can't parse filter '{text}'; expected e.g. 'AGE >= 65' or 'APRDRG in 139,140'")
+    col, op, value = match.group(1), ' '.join(match.group(2).lower().split()), match.group(3)
+    if op == '=':
+        op = '=='
+    if op in ('in', 'not in'):
+        return [(col, op, [_parse_value(v) for v in value.split(',') if v.strip()])]
+    if op == 'between':
+        low, high = (_parse_value(v) for v in value.split(',', 1))
+        return [(col, '>=', low), (col, '<=', high)]
+    return [(col, op, _parse_value(value))]
+
+
+def parse_filters(texts):
+    """AND together the terms of several command-line filters; None when there are none"""
+    if not texts:
+        return None
+    return [[term for text in texts for term in parse_filter(text)]]
+
+
+def normalize_filters(filters):
+    """Filters as a list of AND-lists, whether given as one AND-list or already in DNF"""
+    if not filters:
+        return None
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+    for conjunction in filters:
+        for col, op, _ in conjunction:
+            if op not in FILTER_OPS:
+                raise ValueError(f"Unknown filter operator '{op}' on {col}; expected one of {FILTER_OPS}")
+    return [list(conjunction) for conjunction in filters]
+
+
+def filter_columns(filters):
+    """Columns a filter reads, in first-use order"""
+    columns = []
+    for conjunction in normalize_filters(filters) or []:
+        for col, _, _ in conjunction:
+            if col not in columns:
+                columns.append(col)
+    return columns
+
+
+def _is_text(series):
+    return not pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+
+
+def _term_mask(series, op, value):
+    """Rows of one column that satisfy a term; missing values never match"""
+    text = _is_text(series)
+    if text:
+        series = series.astype('object')
+    value = filter_value(value, text)
+
+    if op == 'in':
+        mask = series.isin(value)
+    elif op == 'not in':
+        mask = ~series.isin(value)
+    else:
+        mask = FILTER_COMPARE[op](series, value)
+    return np.asarray(mask.fillna(False), dtype=bool) & series.notna().to_numpy()
+
+
+def filter_mask(df, filters):
+    """Boolean array of the rows of df that match the filters"""
+    filters = normalize_filters(filters)
+    if filters is None:
+        return np.ones(len(df), dtype=bool)
+
+    missing = [col for col in filter_columns(filters) if col not in df.columns]
+    if missing:
+        raise KeyError(f"Filter columns not in the data: {missing}")
+
+    mask = np.zeros(len(df), dtype=bool)
+    for conjunction in filters:
+        matched = np.ones(len(df), dtype=bool)
+        for col, op, value in conjunction:
+            matched &= _term_mask(df[col], op, value)
+        mask |= matched
+    return mask
+
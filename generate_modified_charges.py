@@ -10,10 +10,23 @@ except ImportError as e:
     print("pip install pandas numpy scikit-learn tqdm")
     exit(1)
 
+import argparse
 import logging
 from datetime import datetime
 import os
 
+from compression import COMPRESSION_CHOICES
+from hcup_spec import lookup_dtypes
+from filters import parse_filters
+from memory_budget import DEFAULT_MEMORY_BUDGET, ChunkSizer, estimate_row_bytes
+from row_counts import count_rows
+from stage_cache import run_cached, stage_code_files
+from output_formats import (ChunkWriter, OUTPUT_FORMATS, is_parquet, output_path_for, read_frames, read_line_blocks,
+                            frame_columns)
+
+# The only columns the model reads; the rest are passed through to the output
+CHARGE_COLUMNS = ['LOS', 'APRDRG', 'PAY1', 'TOTCHG']
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO,
@@ -24,24 +37,49 @@ logging.basicConfig(
     ]
 )
 
+def append_columns_to_lines(input_file, writer, output_df, pbar):
+    """Write the kept rows of a CSV verbatim with output_df's columns appended, without parsing them"""
+    header = pd.DataFrame(columns=frame_columns(input_file) + list(output_df.columns)).to_csv(index=False).encode()
+    kept = output_df.index.to_numpy()
+    newline = os.linesep.encode()
+    done = 0
+    for first, lines in read_line_blocks(input_file):
+        # Rows of this block that survived, and the appended values for each
+        stop = done + np.searchsorted(kept[done:], first + len(lines))
+        rows = kept[done:stop] - first
+        suffixes = output_df.iloc[done:stop].to_csv(header=False, index=False, lineterminator='\n').encode()
+        data = newline.join(lines[row].rstrip(b'\r\n') + b',' + suffix
+                            for row, suffix in zip(rows, suffixes.split(b'\n')))
+        writer.write_lines(data + newline if len(rows) else b'', len(rows), header)
+        done = stop
+        pbar.update(len(lines))
+    if writer.n_chunks == 0:
+        writer.write_lines(b'', 0, header)
+
+def append_columns_to_frames(input_file, writer, output_df, memory_budget, pbar, filters=None):
+    """Join output_df's columns onto the kept rows of a Parquet dataset (or CSV) chunk by chunk"""
+    columns = frame_columns(input_file)
+    dtypes = lookup_dtypes(columns, float_numeric=True)
+    sizer = ChunkSizer(memory_budget, estimate_row_bytes(columns, dtypes), in_flight=2)
+    # Read with the same filters so rows line up with output_df's index
+    for chunk in sizer.track(read_frames(input_file, chunk_size=sizer, dtype=dtypes, filters=filters,
+                                         low_memory=False)):
+        writer.write(chunk.join(output_df, how='inner'))
+        pbar.update(len(chunk))
+
 def add_random_factors(df, n_factors=3):
     """Add random error factors for additional variation"""
     for i in range(n_factors):
         df[f'random_factor_{i}'] = np.random.normal(0, 1, size=len(df))
     return df
 
-def count_rows(file_path, chunk_size=100000):
-    """Count total rows in CSV file"""
-    print("Counting total rows (this may take a moment)...")
-    total_rows = 0
-    for chunk in pd.read_csv(file_path, chunksize=chunk_size, usecols=[0]):
-        total_rows += len(chunk)
-    return total_rows
-
-def generate_modified_charges(input_file, output_file):
+def generate_modified_charges(input_file, output_file, output_format='csv', partition_cols=None, compression=None,
+                              compression_level=None, memory_budget=DEFAULT_MEMORY_BUDGET, filters=None):
     """
     Generate modified total charges using multiple linear regression
-    with controlled variation between 15-55% of original amounts
+    with controlled variation between 15-55% of original amounts.
+    Input and output may be CSV files (optionally .gz/.zst) or Parquet datasets.
+    filters limits the model and the output to matching rows.
     """
     try:
         print("Starting to read the input file...")
@@ -51,17 +89,20 @@ def generate_modified_charges(input_file, output_file):
         total_rows = count_rows(input_file)
         print(f"Total rows to process: {total_rows:,}")
         
-        # Process in chunks with progress bar
+        # Only the model's columns are parsed; everything else is carried through untouched
         chunks = []
-        chunk_size = 100000
+        dtypes = lookup_dtypes(CHARGE_COLUMNS, float_numeric=True)
+        sizer = ChunkSizer(memory_budget, estimate_row_bytes(CHARGE_COLUMNS, dtypes))
         
         with tqdm(total=total_rows, desc="Reading data", unit="rows") as pbar:
-            for chunk in pd.read_csv(input_file, chunksize=chunk_size, low_memory=False):
+            for chunk in sizer.track(read_frames(input_file, columns=CHARGE_COLUMNS, chunk_size=sizer, dtype=dtypes,
+                                                 filters=filters, low_memory=False)):
                 chunks.append(chunk)
                 pbar.update(len(chunk))
         
         print("Combining chunks...")
-        df = pd.concat(chunks, ignore_index=True)
+        # Chunks keep their file row numbers, which say which rows survive into the output
+        df = pd.concat(chunks)
         print(f"Successfully read {len(df):,} rows")
         
         print("Processing data...")
@@ -105,18 +146,20 @@ def generate_modified_charges(input_file, output_file):
         variation_direction = np.random.choice([-1, 1], size=len(df))
         modified_charges = df['TOTCHG'] * (1 + variation_factors * variation_direction)
         
-        print("Preparing output dataframe...")
-        output_df = df.copy()
-        output_df['TOTCHG_ORIGINAL'] = df['TOTCHG']
-        output_df['TOTCHG_MODIFIED'] = modified_charges
-        output_df['MODIFICATION_PCT'] = ((modified_charges - df['TOTCHG']) / df['TOTCHG'] * 100).round(2)
-        
-        # Remove temporary random factors
-        for i in range(3):
-            output_df = output_df.drop(f'random_factor_{i}', axis=1)
+        print("Preparing output columns...")
+        output_df = pd.DataFrame({
+            'TOTCHG_ORIGINAL': df['TOTCHG'],
+            'TOTCHG_MODIFIED': modified_charges,
+            'MODIFICATION_PCT': ((modified_charges - df['TOTCHG']) / df['TOTCHG'] * 100).round(2),
+        })
         
         print("Saving results...")
-        output_df.to_csv(output_file, index=False)
+        with ChunkWriter(output_file, output_format, partition_cols, compression, compression_level) as writer:
+            with tqdm(total=total_rows, desc="Writing", unit="rows") as pbar:
+                if output_format == 'csv' and not is_parquet(input_file):
+                    append_columns_to_lines(input_file, writer, output_df, pbar)
+                else:
+                    append_columns_to_frames(input_file, writer, output_df, memory_budget, pbar, filters)
         
         # Log summary statistics
         print("\nSummary Statistics:")
@@ -131,7 +174,8 @@ def generate_modified_charges(input_file, output_file):
         print(f"Error: {str(e)}")
         return False
 
-def main():
+def main(output_format='csv', partition_cols=None, use_cache=True, compression=None, compression_level=None,
+         memory_budget=DEFAULT_MEMORY_BUDGET, filters=None):
     # Use the specific processed file
     input_file = r"C:\analysis\data\NRD_2019\processed\NRD_2019_Core_processed.csv"
     output_file = r"C:\analysis\data\NRD_2019\processed\NRD_2019_Modified_Charges.csv"
@@ -141,7 +185,17 @@ def main():
     logging.info(f"Output file: {output_file}")
     
     # Generate modified charges from the processed file
-    success = generate_modified_charges(input_file, output_file)
+    output_file = output_path_for(output_file, output_format, compression)
+    run = lambda: generate_modified_charges(input_file, output_file, output_format, partition_cols, compression,
+                                            compression_level, memory_budget, filters)
+    if use_cache:
+        success = run_cached('modified_charges', [input_file], [output_file], run,
+                             params={'format': output_format, 'partition_cols': partition_cols,
+                                     'compression': compression, 'compression_level': compression_level,
+                                     'filters': filters},
+                             code_files=stage_code_files('modified_charges'))
+    else:
+        success = run()
     
     if success:
         logging.info("Charge modification completed successfully")
@@ -150,4 +204,20 @@ def main():
         logging.error("Charge modification process failed")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate modified total charges")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help="Output format")
+    parser.add_argument('--partition-by', nargs='*', default=None, help="Columns to partition Parquet output by")
+    parser.add_argument('--no-cache', action='store_true', help="Re-run even if inputs and parameters are unchanged")
+    parser.add_argument('--compression', choices=COMPRESSION_CHOICES, default=None,
+                        help="Output codec (CSV gets a .gz/.zst extension; Parquet defaults to zstd)")
+    parser.add_argument('--compression-level', type=int, default=None, help="Codec compression level")
+    parser.add_argument('--memory-budget', default=DEFAULT_MEMORY_BUDGET,
+                        help="Memory to size chunks against, e.g. 512MB or 8GB")
+    parser.add_argument('--filter', action='append', default=None, dest='filters',
+                        help="Keep only matching rows, e.g. 'APRDRG in 139,140' or 'AGE >= 65' "
+                             "(repeat to AND several)")
+    args = parser.parse_args()
+
+    main(args.format, args.partition_by, use_cache=not args.no_cache, compression=args.compression,
+         compression_level=args.compression_level, memory_budget=args.memory_budget,
+         filters=parse_filters(args.filters)) 
\ No newline at end of file
@@ -0,0 +1,814 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import queue
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import Manager
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from checkpoint import Checkpoint
+from compression import compression_of, csv_compression_options, strip_compression
+from convert_asc_to_csv import remove_range_files, stitch_parts
+from filters import filter_mask, normalize_filters
+from hcup_spec import lookup_dtypes, restore_integers
+from imputation import DEFAULT_MAX_PENDING, ImputationPlan, Imputer, StreamingImputer, _python_value
+from memory_budget import DEFAULT_MEMORY_BUDGET, ChunkSizer, estimate_row_bytes, parse_memory_budget
+from output_formats import (ChunkWriter, clear_output, dedupe_columns, frame_columns, is_parquet, read_frames,
+                            require_pyarrow, unify_parquet_schema)
+from row_index import load_row_index, read_row_range, split_row_ranges
+from stage_cache import file_fingerprint, spec_version
+
+# pyarrow is only needed to spill compressed CSVs and Parquet datasets for parallel imputation
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Bump when the statistics change shape, so older sidecars are recomputed
+FILL_STATS_VERSION = 3
+# Rows per segment of inputs without a row index, the units they are imputed in parallel by
+SPILL_SEGMENT_ROWS = 200000
+# Numeric columns keep exact value counts until they have more distinct values than this
+MAX_EXACT_VALUES = 4096
+# Relative error of medians taken from the log-bucket sketch
+SKETCH_ACCURACY = 0.005
+# Whole numbers below this are counted with bincount instead of a sort
+SMALL_INTEGERS = 1 << 16
+
+
+def fill_stats_path(path):
+    """Sidecar holding a file's fill statistics"""
+    return path.rstrip('/\\') + '.fillstats.json'
+
+
+def can_split(path):
+    """True for inputs that can be read in row ranges: plain, uncompressed CSVs"""
+    return not is_parquet(path) and not compression_of(path)
+
+
+def can_parallelize(path):
+    """True for inputs impute_file_parallel takes: plain CSVs, or anything else once pyarrow can spill it"""
+    return can_split(path) or pyarrow is not None
+
+
+def _value_counts(values):
+    """Distinct values of a float array and how often each occurs"""
+    if values.min() >= 0 and values.max() < SMALL_INTEGERS and (values == np.floor(values)).all():
+        # HCUP codes, flags and counts are small whole numbers
+        counts = np.bincount(values.astype(np.int64))
+        present = np.flatnonzero(counts)
+        return present.astype(np.float64), counts[present]
+    return np.unique(values, return_counts=True)
+
+
+class QuantileSketch:
+    """
+    Mergeable median of a numeric column in bounded memory.
+
+    Values are counted exactly until a column has more than MAX_EXACT_VALUES
+    distinct ones, so codes, flags, ages and lengths of stay get their exact
+    median. Past that (charges, weights) they are counted in logarithmic
+    buckets as DDSketch does, which keeps the median within SKETCH_ACCURACY
+    of the true value.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.exact = {}
+        # Bucket counts for positive and negative values once there are too many distinct ones
+        self.positive = None
+        self.negative = None
+        self.zeros = 0
+
+    @property
+    def bucketed(self):
+        return self.positive is not None
+
+    def _log_gamma(self):
+        return np.log((1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY))
+
+    def add(self, values):
+        """Count a float array of finite values"""
+        if len(values):
+            self.add_counts(*_value_counts(values))
+
+    def add_counts(self, values, counts):
+        """Count distinct finite values occurring counts times each"""
+        self.count += int(counts.sum())
+        if self.bucketed:
+            self._add_buckets(values, counts)
+            return
+        for value, count in zip(values.tolist(), counts.tolist()):
+            self.exact[value] = self.exact.get(value, 0) + count
+        if len(self.exact) > MAX_EXACT_VALUES:
+            self._to_buckets()
+
+    def _to_buckets(self):
+        self.positive, self.negative = {}, {}
+        values = np.fromiter(self.exact, dtype=np.float64, count=len(self.exact))
+        counts = np.fromiter(self.exact.values(), dtype=np.int64, count=len(self.exact))
+        self.exact = {}
+        self._add_buckets(values, counts)
+
+    def _add_buckets(self, values, counts):
+        self.zeros += int(counts[values == 0].sum())
+        for buckets, sign in ((self.positive, 1), (self.negative, -1)):
+            side = values * sign > 0
+            if not side.any():
+                continue
+            keys = np.ceil(np.log(values[side] * sign) / self._log_gamma()).astype(np.int64)
+            keys, inverse = np.unique(keys, return_inverse=True)
+            totals = np.bincount(inverse, weights=counts[side]).astype(np.int64)
+            for key, total in zip(keys.tolist(), totals.tolist()):
+                buckets[key] = buckets.get(key, 0) + total
+
+    def merge(self, other):
+        """Add another sketch's counts to this one"""
+        self.count += other.count
+        if not self.bucketed and not other.bucketed:
+            for value, count in other.exact.items():
+                self.exact[value] = self.exact.get(value, 0) + count
+            if len(self.exact) > MAX_EXACT_VALUES:
+                self._to_buckets()
+            return
+        if not self.bucketed:
+            self._to_buckets()
+        if not other.bucketed:
+            values = np.fromiter(other.exact, dtype=np.float64, count=len(other.exact))
+            self._add_buckets(values, np.fromiter(other.exact.values(), dtype=np.int64, count=len(other.exact)))
+            return
+        self.zeros += other.zeros
+        for buckets, others in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in others.items():
+                buckets[key] = buckets.get(key, 0) + count
+
+    def _sorted_counts(self):
+        """(value, count) pairs in ascending order of value"""
+        if not self.bucketed:
+            return sorted(self.exact.items())
+        gamma = np.exp(self._log_gamma())
+        # A bucket stands for the value with the least relative error to anything in it
+        middle = lambda key: float(2 * gamma ** key / (gamma + 1))
+        pairs = [(-middle(key), self.negative[key]) for key in sorted(self.negative, reverse=True)]
+        pairs += [(0.0, self.zeros)] if self.zeros else []
+        return pairs + [(middle(key), self.positive[key]) for key in sorted(self.positive)]
+
+    def median(self):
+        """Median as Series.median() takes it (the mean of the middle two for an even count); None if empty"""
+        if not self.count:
+            return None
+        lower, upper = (self.count - 1) // 2, self.count // 2
+        seen = 0
+        low = None
+        for value, count in self._sorted_counts():
+            seen += count
+            if low is None and seen > lower:
+                low = value
+            if seen > upper:
+                return low if value == low else (low + value) / 2
+
+    def as_dict(self):
+        if not self.bucketed:
+            return {'count': self.count, 'exact': [[value, count] for value, count in self.exact.items()]}
+        return {'count': self.count, 'zeros': self.zeros,
+                'positive': [[key, count] for key, count in self.positive.items()],
+                'negative': [[key, count] for key, count in self.negative.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls()
+        sketch.count = data['count']
+        if 'exact' in data:
+            sketch.exact = {value: count for value, count in data['exact']}
+        else:
+            sketch.zeros = data['zeros']
+            sketch.positive = {key: count for key, count in data['positive']}
+            sketch.negative = {key: count for key, count in data['negative']}
+        return sketch
+
+
+class ColumnStats:
+    """Whole-file counts behind one column's fill values: value counts for text, sum and median for numbers"""
+
+    def __init__(self, numeric):
+        self.numeric = numeric
+        self.present = 0
+        self.missing = 0
+        self.total = 0.0
+        self.sketch = QuantileSketch() if numeric else None
+        self.counts = {}
+
+    @classmethod
+    def for_dtype(cls, dtype):
+        return cls(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype))
+
+    def add(self, series):
+        if self.numeric:
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+            present = values[~np.isnan(values)]
+            self.total += float(present.sum())
+            self.sketch.add(present[np.isfinite(present)])
+        elif isinstance(series.dtype, pd.CategoricalDtype):
+            codes = series.array.codes
+            present = codes[codes >= 0]
+            counts = np.bincount(present, minlength=len(series.cat.categories))
+            seen = np.flatnonzero(counts)
+            for value, count in zip(series.cat.categories[seen].tolist(), counts[seen].tolist()):
+                self.counts[value] = self.counts.get(value, 0) + count
+        else:
+            present = series.dropna()
+            for value, count in present.value_counts(sort=False).items():
+                value = _python_value(value)
+                self.counts[value] = self.counts.get(value, 0) + int(count)
+        self.present += len(present)
+        self.missing += len(series) - len(present)
+
+    def merge(self, other):
+        self.present += other.present
+        self.missing += other.missing
+        if self.numeric:
+            self.total += other.total
+            self.sketch.merge(other.sketch)
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+
+    def mode(self):
+        """Most frequent value, the smallest among ties as Series.mode()[0] takes it; None if empty"""
+        if self.numeric:
+            counts = self.sketch.exact if not self.sketch.bucketed else {}
+        else:
+            counts = self.counts
+        if not counts:
+            return None
+        top = max(counts.values())
+        return min(value for value, count in counts.items() if count == top)
+
+    def mean(self):
+        return self.total / self.present if self.present else None
+
+    def median(self):
+        return self.sketch.median() if self.numeric else None
+
+    def as_dict(self):
+        data = {'numeric': self.numeric, 'present': self.present, 'missing': self.missing}
+        if self.numeric:
+            data.update(total=self.total, sketch=self.sketch.as_dict())
+        else:
+            data['counts'] = [[value, count] for value, count in self.counts.items()]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data['numeric'])
+        stats.present, stats.missing = data['present'], data['missing']
+        if stats.numeric:
+            stats.total = data['total']
+            stats.sketch = QuantileSketch.from_dict(data['sketch'])
+        else:
+            stats.counts = {value: count for value, count in data['counts']}
+        return stats
+
+
+def _group_key(series):
+    """Key column values as groups are matched on: floats for numbers, Python objects for codes"""
+    if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)
+    return series.astype(object).to_numpy()
+
+
+def _key_index(key_values):
+    return pd.MultiIndex.from_arrays(key_values) if len(key_values) > 1 else pd.Index(key_values[0])
+
+
+def _accumulate(total, part):
+    """Add counts indexed by group, keeping groups only one side has"""
+    if total is None or part is None:
+        return part if total is None else total
+    return total.add(part, fill_value=0)
+
+
+class GroupStats:
+    """
+    Per-group counts of some columns, keyed by group columns such as HOSP_NIS
+    or APRDRG and APRDRG_Severity: sums and counts for numbers, value counts
+    for text.
+
+    Only groups and values that occur are kept, so the table stays small
+    next to the rows it summarizes. fill_values() joins rows to their group's
+    mean or mode through an index lookup on the key values, without a
+    groupby over the chunk being filled.
+    """
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.sums = None
+        self.counts = None
+        self.values = {}
+        self._table = None
+
+    @classmethod
+    def from_frame(cls, df, keys, cols):
+        stats = cls(keys)
+        stats.add(df, cols)
+        return stats
+
+    def add(self, df, cols):
+        key_values = [_group_key(df[key]) for key in self.keys]
+        numeric = [col for col in cols if ColumnStats.for_dtype(df[col].dtype).numeric]
+        if numeric:
+            grouped = df[numeric].astype(np.float64).groupby(key_values, dropna=True)
+            self.sums = _accumulate(self.sums, grouped.sum())
+            self.counts = _accumulate(self.counts, grouped.count())
+        for col in cols:
+            if col not in numeric:
+                counts = df[col].groupby(key_values + [df[col].astype(object).to_numpy()], dropna=True).size()
+                self.values[col] = _accumulate(self.values.get(col), counts)
+        self._table = None
+
+    def merge(self, other):
+        self.sums = _accumulate(self.sums, other.sums)
+        self.counts = _accumulate(self.counts, other.counts)
+        for col, counts in other.values.items():
+            self.values[col] = _accumulate(self.values.get(col), counts)
+        self._table = None
+
+    def table(self):
+        """Fill value of every column per group: the mean for numbers, the mode (smallest among ties) for text"""
+        if self._table is None:
+            parts = []
+            if self.sums is not None:
+                parts.append(self.sums / self.counts.where(self.counts > 0))
+            n_keys = len(self.keys)
+            for col, counts in self.values.items():
+                if not len(counts):
+                    continue
+                frame = counts.rename('n').reset_index()
+                frame.columns = list(range(n_keys)) + ['value', 'n']
+                frame = frame.sort_values(['n', 'value'], ascending=[False, True], kind='stable')
+                modes = frame.drop_duplicates(list(range(n_keys))).set_index(list(range(n_keys)))['value']
+                modes.index.names = [None] * n_keys
+                parts.append(modes.rename(col))
+            self._table = pd.concat(parts, axis=1) if parts else pd.DataFrame()
+        return self._table
+
+    def fill_values(self, df, cols):
+        """Each row's group value for cols, as arrays aligned with df; NaN where the group is unknown"""
+        table = self.table()
+        rows = table.index.get_indexer(_key_index([_group_key(df[key]) for key in self.keys]))
+        known = rows >= 0
+        fills = {}
+        for col in cols:
+            values = table[col].to_numpy() if col in table.columns else np.array([], dtype=np.float64)
+            fills[col] = np.full(len(df), np.nan, dtype=object if values.dtype == object else np.float64)
+            if col in table.columns:
+                fills[col][known] = values[rows[known]]
+        return fills
+
+    def as_dict(self):
+        records = lambda frame: {'index': [list(key) if isinstance(key, tuple) else [key] for key in frame.index],
+                                 'columns': list(frame.columns), 'data': frame.to_numpy().tolist()}
+        return {'keys': self.keys,
+                'sums': records(self.sums) if self.sums is not None else None,
+                'counts': records(self.counts) if self.counts is not None else None,
+                'values': {col: [list(key) + [int(count)] for key, count in counts.items()]
+                           for col, counts in self.values.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data['keys'])
+        n_keys = len(stats.keys)
+        index = lambda keys: _key_index([[key[i] for key in keys] for i in range(n_keys)])
+        frame = lambda records: pd.DataFrame(records['data'], columns=records['columns'], index=index(records['index']),
+                                             dtype=np.float64)
+        if data['sums'] is not None:
+            stats.sums, stats.counts = frame(data['sums']), frame(data['counts'])
+        for col, rows in data['values'].items():
+            if rows:
+                stats.values[col] = pd.Series([row[-1] for row in rows], dtype=np.int64,
+                                              index=pd.MultiIndex.from_tuples([tuple(row[:-1]) for row in rows]))
+        return stats
+
+
+class FillStats:
+    """
+    Whole-file fill statistics gathered in one streaming pass.
+
+    Besides per-column counts, the file is split into segments (the row
+    index's stretches of rows, or runs of chunk_rows-row chunks for inputs
+    without one); each records the first and last value of every column in
+    it and how many rows it kept. That is all a worker imputing a row range
+    needs to continue from the rows before its range and close gaps that
+    run past its end. Columns that dataset_patterns fill by group also get
+    a GroupStats table per set of key columns.
+    """
+
+    def __init__(self, columns=None, segments=None, groups=None, dataset_patterns=None, chunk_rows=None):
+        self.columns = columns or {}
+        self.segments = segments or []
+        self.groups = groups or {}
+        self.dataset_patterns = dataset_patterns
+        self.chunk_rows = chunk_rows
+
+    def fill_value(self, col, statistic):
+        """Whole-file 'mode', 'mean' or 'median' of a column; None if unknown"""
+        stats = self.columns.get(col)
+        return getattr(stats, statistic)() if stats is not None else None
+
+    def group_table(self, keys):
+        """GroupStats for a set of key columns; None if they weren't grouped on"""
+        return self.groups.get(tuple(keys))
+
+    def add_segment(self, start, frames):
+        """Count the chunks of one segment, which starts at file row `start`"""
+        segment = {'start': start, 'rows': 0, 'chunks': 0, 'first': {}, 'last': {}}
+        for chunk in frames:
+            for col in chunk.columns:
+                if col not in self.columns:
+                    self.columns[col] = ColumnStats.for_dtype(chunk[col].dtype)
+                self.columns[col].add(chunk[col])
+            # The grouped columns follow from the patterns and the chunk's dtypes
+            for keys, cols in ImputationPlan(chunk.columns, chunk.dtypes, self.dataset_patterns).groups.items():
+                self.groups.setdefault(keys, GroupStats(keys)).add(chunk, cols)
+
+            present = chunk.notna().to_numpy()
+            seen = present.any(axis=0)
+            first = present.argmax(axis=0)
+            last = len(chunk) - 1 - present[::-1].argmax(axis=0)
+            for j in np.flatnonzero(seen):
+                col = chunk.columns[j]
+                if col not in segment['first']:
+                    segment['first'][col] = [segment['rows'] + int(first[j]), _python_value(chunk.iat[first[j], j])]
+                segment['last'][col] = [segment['rows'] + int(last[j]), _python_value(chunk.iat[last[j], j])]
+            segment['rows'] += len(chunk)
+            segment['chunks'] += 1
+        self.segments.append(segment)
+
+    def merge(self, other):
+        """Append the statistics of the segments that follow this one's"""
+        for col, stats in other.columns.items():
+            if col in self.columns:
+                self.columns[col].merge(stats)
+            else:
+                self.columns[col] = stats
+        for keys, stats in other.groups.items():
+            if keys in self.groups:
+                self.groups[keys].merge(stats)
+            else:
+                self.groups[keys] = stats
+        self.segments.extend(other.segments)
+
+    def without_segments(self):
+        """The fill values alone, which is all an imputer needs"""
+        return FillStats(self.columns, groups=self.groups)
+
+    def context(self, first, stop):
+        """
+        StreamingImputer state at the start of segments [first, stop), and the
+        value following them for each column, as its flush() takes them.
+        """
+        offsets = np.cumsum([0] + [segment['rows'] for segment in self.segments])
+        carried = {}
+        for i in range(first):
+            for col, (row, value) in self.segments[i]['last'].items():
+                carried[col] = [value, int(offsets[first] - offsets[i] - row), True]
+        following = {}
+        for i in range(len(self.segments) - 1, stop - 1, -1):
+            for col, (row, value) in self.segments[i]['first'].items():
+                following[col] = [value, int(offsets[i] + row - offsets[stop] + 1), True]
+        return {'rows': int(offsets[first]), 'carried': carried}, following
+
+    def as_dict(self):
+        return {'columns': {col: stats.as_dict() for col, stats in self.columns.items()},
+                'groups': [stats.as_dict() for stats in self.groups.values()],
+                'segments': self.segments, 'chunk_rows': self.chunk_rows}
+
+    @classmethod
+    def from_dict(cls, data):
+        groups = [GroupStats.from_dict(stats) for stats in data['groups']]
+        return cls({col: ColumnStats.from_dict(stats) for col, stats in data['columns'].items()}, data['segments'],
+                   {tuple(stats.keys): stats for stats in groups}, chunk_rows=data['chunk_rows'])
+
+
+def _filtered(frames, filters):
+    for chunk in frames:
+        yield chunk[filter_mask(chunk, filters)] if filters else chunk
+
+
+def _scan_segments(path, segments, dtypes, filters, chunk_size, dataset_patterns=None):
+    """Worker: fill statistics for consecutive (start, stop) row segments of a CSV"""
+    stats = FillStats(dataset_patterns=dataset_patterns)
+    index = load_row_index(path, build=False)
+    for start, stop in segments:
+        stats.add_segment(start, _filtered(read_row_range(path, start, stop, chunk_size, index, dtype=dtypes,
+                                                          low_memory=False), filters))
+    return stats
+
+
+def compute_fill_stats(path, workers=1, memory_budget=DEFAULT_MEMORY_BUDGET, filters=None, dataset_patterns=None):
+    """
+    First pass: fill statistics for a CSV file or Parquet dataset.
+
+    Plain CSVs are scanned by their row index segments, in parallel with
+    workers > 1; compressed CSVs and Parquet datasets are read in a single
+    stream of fixed-size chunks, grouped into segments of about
+    SPILL_SEGMENT_ROWS rows. dataset_patterns decides which columns get
+    per-group tables.
+    """
+    filters = normalize_filters(filters)
+    columns = frame_columns(path)
+    dtypes = lookup_dtypes(columns, float_numeric=True)
+    workers = max(workers, 1)
+    # Workers share the budget; each reads fixed-size chunks of its segments
+    chunk_size = ChunkSizer(parse_memory_budget(memory_budget) / workers, estimate_row_bytes(columns, dtypes),
+                            in_flight=2)()
+
+    stats = FillStats(dataset_patterns=dataset_patterns)
+    if not can_split(path):
+        # The chunks stay a fixed size so a parallel second pass reads the same segments back
+        stats.chunk_rows = chunk_size
+        frames = iter(read_frames(path, chunk_size=chunk_size, dtype=dtypes, filters=filters, low_memory=False))
+        n_chunks = max(1, SPILL_SEGMENT_ROWS // chunk_size)
+        start = 0
+        with tqdm(unit='rows', desc="Gathering fill statistics") as pbar:
+            for chunk in frames:
+                stats.add_segment(start, itertools.chain([chunk], itertools.islice(frames, n_chunks - 1)))
+                start += stats.segments[-1]['rows']
+                pbar.update(stats.segments[-1]['rows'])
+        return stats
+
+    index = load_row_index(path)
+    starts = index['rows']
+    segments = [(start, stop) for start, stop in zip(starts, starts[1:] + [index['n_rows']]) if start < stop]
+    # Several batches of segments per worker keep the pool busy when batches finish unevenly
+    n_batches = min(len(segments), workers * 4) or 1
+    bounds = [len(segments) * i // n_batches for i in range(n_batches + 1)]
+    batches = [segments[bounds[i]:bounds[i + 1]] for i in range(n_batches)]
+
+    with tqdm(total=index['n_rows'], unit='rows', desc="Gathering fill statistics") as pbar:
+        if workers == 1:
+            for batch in batches:
+                stats.merge(_scan_segments(path, batch, dtypes, filters, chunk_size, dataset_patterns))
+                pbar.update(sum(stop - start for start, stop in batch))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # map hands results back in file order, which the segments must keep
+                n = len(batches)
+                for batch, batch_stats in zip(batches, executor.map(_scan_segments, [path] * n, batches, [dtypes] * n,
+                                                                    [filters] * n, [chunk_size] * n,
+                                                                    [dataset_patterns] * n)):
+                    stats.merge(batch_stats)
+                    pbar.update(sum(stop - start for start, stop in batch))
+    return stats
+
+
+def load_fill_stats(path, workers=1, memory_budget=DEFAULT_MEMORY_BUDGET, filters=None, dataset_patterns=None):
+    """
+    Fill statistics for a file, read from its sidecar when the file, filters,
+    patterns and specs are unchanged and gathered (then saved) otherwise.
+    """
+    key = {'fingerprint': file_fingerprint(path), 'filters': normalize_filters(filters), 'spec': spec_version(),
+           'patterns': dataset_patterns, 'version': FILL_STATS_VERSION}
+    if can_split(path):
+        # Segments follow the row index, which a rebuild may lay out differently
+        key['segments'] = hashlib.sha256(json.dumps(load_row_index(path)['rows']).encode()).hexdigest()
+    key = json.loads(json.dumps(key))
+    sidecar = fill_stats_path(path)
+    try:
+        with open(sidecar, 'r') as f:
+            saved = json.load(f)
+        if saved.get('key') == key:
+            logging.info(f"Reusing fill statistics from {sidecar}")
+            return FillStats.from_dict(saved['stats'])
+    except (OSError, ValueError):
+        pass
+
+    logging.info(f"Gathering fill statistics for {path}")
+    stats = compute_fill_stats(path, workers, memory_budget, filters, dataset_patterns)
+    temp_path = f'{sidecar}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump({'key': key, 'stats': stats.as_dict()}, f)
+        os.replace(temp_path, sidecar)
+    except OSError as e:
+        # A read-only data folder only costs us the cache
+        logging.debug(f"Could not save fill statistics for {path}: {e}")
+    return stats
+
+
+def _spill_segment(chunks, spill_dir, i):
+    """Write one segment's chunks to Feather files for a worker to read back, returning their paths"""
+    paths = []
+    for j, chunk in enumerate(chunks):
+        path = os.path.join(spill_dir, f'segment_{i:05d}_{j:05d}.feather')
+        # Feather keeps the dtypes, categoricals included, but not a non-default index
+        chunk.reset_index(drop=True).to_feather(path)
+        paths.append(path)
+    return paths
+
+
+def _impute_row_range(input_file, part_path, start, stop, state, following, stats, dataset_patterns, max_pending,
+                      dtypes, filters, chunk_size, progress, output_format='csv', partition_cols=None,
+                      part_prefix='', compression=None, compression_level=None, spill_paths=None):
+    """Worker: impute rows [start, stop) into a headerless CSV part or Parquet dataset files
+
+    spill_paths, when given, hold the range's (already filtered) chunks as
+    Feather files, which are read and removed instead of the input.
+    Returns the rows written, the imputer's per-strategy timings, the
+    worker's process id and the seconds it spent.
+    """
+    began = time.perf_counter()
+    imputer = StreamingImputer(dataset_patterns, max_pending, state, stats)
+
+    def read_chunks():
+        if spill_paths is not None:
+            for path in spill_paths:
+                chunk = pd.read_feather(path)
+                os.remove(path)
+                progress.put(len(chunk))
+                yield chunk
+            return
+        index = load_row_index(input_file, build=False)
+        for chunk in read_row_range(input_file, start, stop, chunk_size, index, dtype=dtypes, low_memory=False):
+            progress.put(len(chunk))
+            yield chunk[filter_mask(chunk, filters)] if filters else chunk
+
+    def imputed_chunks():
+        for chunk in read_chunks():
+            yield imputer(chunk)
+        # Gaps running past the range are closed by the values after it
+        tail = imputer.flush(following)
+        if tail is not None:
+            yield tail
+
+    rows = 0
+    if output_format == 'parquet':
+        # Clear leftovers of this range from an interrupted run before rewriting it
+        remove_range_files(part_path, part_prefix)
+        writer = ChunkWriter(part_path, 'parquet', partition_cols, compression, compression_level,
+                             part_prefix=part_prefix, overwrite=False)
+        for chunk in imputed_chunks():
+            if len(chunk):
+                writer.write(chunk)
+            rows += len(chunk)
+        return rows, imputer.stats, os.getpid(), time.perf_counter() - began
+
+    # Written under a temporary name so a part only exists once it is complete
+    csv_compression = csv_compression_options(part_path, compression_level)
+    with open(part_path + '.tmp', 'wb') as f:
+        for chunk in imputed_chunks():
+            restore_integers(chunk).to_csv(f, index=False, header=False, compression=csv_compression)
+            rows += len(chunk)
+    os.replace(part_path + '.tmp', part_path)
+    return rows, imputer.stats, os.getpid(), time.perf_counter() - began
+
+
+def impute_file_parallel(input_file, output_file, stats, workers, dataset_patterns=None, fill_values=True,
+                         max_pending=DEFAULT_MAX_PENDING, output_format='csv', partition_cols=None, resume=True,
+                         compression=None, compression_level=None, memory_budget=DEFAULT_MEMORY_BUDGET,
+                         filters=None):
+    """
+    Second pass: impute a file with a process pool, one output part per range of rows.
+
+    Plain CSVs are split by their row index and each worker reads its own
+    range. Compressed CSVs and Parquet datasets can only be read as one
+    stream, so this process reads them in the first pass's segments and
+    spills each segment to Feather files for a worker, with at most two
+    segments per worker waiting on disk. Either way a range starts from the
+    values its preceding segments ended with and closes its trailing gaps
+    with the values after it, both taken from stats, so the output is the
+    same as a single StreamingImputer's; parts are joined in row order.
+    fill_values=False keeps mode, mean and median fills per chunk.
+    Returns the rows written and an Imputer holding the summed timings.
+    """
+    filters = normalize_filters(filters)
+    columns = frame_columns(input_file)
+    dtypes = lookup_dtypes(columns, float_numeric=True)
+    split = can_split(input_file)
+    if split:
+        index = load_row_index(input_file)
+        # Several ranges per worker keep the pool busy when ranges finish unevenly
+        ranges = split_row_ranges(index, workers * 4)
+        segment_of = {segment['start']: i for i, segment in enumerate(stats.segments)}
+        bounds = [(segment_of[start], segment_of.get(stop, len(stats.segments))) for start, stop in ranges]
+        total_rows = index['n_rows']
+        layout = {'ranges': ranges}
+    else:
+        require_pyarrow()
+        # One range per segment, read back in the chunks the first pass counted
+        ranges = [(segment['start'], segment['start'] + segment['rows']) for segment in stats.segments]
+        bounds = [(i, i + 1) for i in range(len(ranges))]
+        total_rows = sum(segment['rows'] for segment in stats.segments)
+        layout = {'segments': [segment['chunks'] for segment in stats.segments], 'chunk_rows': stats.chunk_rows}
+
+    checkpoint = Checkpoint(output_file, input_file, dict(layout, format=output_format, partition_cols=partition_cols,
+                                                          filters=filters, max_pending=max_pending,
+                                                          fill_values=fill_values, dataset_patterns=dataset_patterns))
+    if not resume:
+        checkpoint.discard()
+
+    if output_format == 'parquet':
+        # Range files land directly in the dataset; prefixes keep them in row order
+        if not checkpoint.resumed:
+            clear_output(output_file)
+        parts_dir = None
+        part_paths = [output_file] * len(ranges)
+    else:
+        parts_dir = output_file + '.parts'
+        os.makedirs(parts_dir, exist_ok=True)
+        # Parts carry the output's codec extension so they are compressed the same way
+        suffix = output_file[len(strip_compression(output_file)):]
+        part_paths = [os.path.join(parts_dir, f'part_{i:05d}.csv{suffix}') for i in range(len(ranges))]
+    spill_dir = None
+    if not split:
+        spill_dir = output_file.rstrip('/\\') + '.spill'
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        os.makedirs(spill_dir)
+
+    chunk_size = ChunkSizer(parse_memory_budget(memory_budget) / workers, estimate_row_bytes(columns, dtypes),
+                            in_flight=3)()
+    fill_stats = stats.without_segments() if fill_values else None
+    imputer = Imputer(dataset_patterns)
+    throughput = {}
+
+    todo = [i for i in range(len(ranges)) if not checkpoint.unit_done(i)]
+    done_rows = sum(stop - start for i, (start, stop) in enumerate(ranges) if i not in todo)
+    logging.info(f"Imputing {os.path.basename(input_file)} with {workers} workers "
+                 f"({len(todo)} of {len(ranges)} ranges to do)")
+
+    with Manager() as manager, ProcessPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=total_rows, initial=done_rows, unit='rows', desc="Processing") as pbar:
+        progress = manager.Queue()
+        pending = {}
+
+        def submit(i, spill_paths=None):
+            start, stop = ranges[i]
+            state, following = stats.context(*bounds[i])
+            # Spilled chunks were filtered as they were read
+            future = executor.submit(_impute_row_range, input_file, part_paths[i], start, stop, state, following,
+                                     fill_stats, dataset_patterns, max_pending, dtypes,
+                                     None if spill_paths else filters, chunk_size, progress, output_format,
+                                     partition_cols, f'range-{i:05d}-', compression, compression_level, spill_paths)
+            pending[future] = i
+
+        def collect(limit):
+            """Record finished ranges until no more than limit are left running"""
+            while len(pending) > limit:
+                done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rows, timings, pid, seconds = future.result()
+                    for strategy, timing in timings.items():
+                        imputer._record(strategy, timing['seconds'], timing['cells'])
+                    worker = throughput.setdefault(pid, {'ranges': 0, 'rows': 0, 'seconds': 0.0})
+                    worker['ranges'] += 1
+                    worker['rows'] += rows
+                    worker['seconds'] += seconds
+                    checkpoint.commit_unit(pending.pop(future), rows=rows)
+                # Workers report rows per chunk through a shared queue
+                while True:
+                    try:
+                        pbar.update(progress.get_nowait())
+                    except queue.Empty:
+                        break
+
+        if split:
+            for i in todo:
+                submit(i)
+        else:
+            frames = iter(read_frames(input_file, chunk_size=stats.chunk_rows, dtype=dtypes, filters=filters,
+                                      low_memory=False))
+            for i, segment in enumerate(stats.segments):
+                chunks = itertools.islice(frames, segment['chunks'])
+                if i not in todo:
+                    for _ in chunks:
+                        pass
+                    continue
+                # Wait for a free slot first so spilled segments don't pile up on disk
+                collect(workers * 2 - 1)
+                submit(i, _spill_segment(chunks, spill_dir, i))
+        collect(0)
+
+    for n, (pid, worker) in enumerate(sorted(throughput.items()), 1):
+        rate = worker['rows'] / worker['seconds'] if worker['seconds'] else 0
+        logging.info(f"Worker {n} (pid {pid}): {worker['ranges']} ranges, {worker['rows']:,} rows in "
+                     f"{worker['seconds']:.1f}s ({rate:,.0f} rows/s)")
+
+    if parts_dir:
+        # The header a sequential run writes, repeated columns renamed as read_csv renames them
+        header_line = pd.DataFrame(columns=dedupe_columns(columns)).to_csv(index=False)
+        stitch_parts(part_paths, output_file, header_line, compression_level=compression_level)
+        shutil.rmtree(parts_dir)
+    else:
+        # Ranges decide on their own whether a column's values are whole enough to store as ints
+        unify_parquet_schema(output_file, compression or 'zstd', compression_level)
+    if spill_dir:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    checkpoint.complete()
+    return sum(unit['rows'] for unit in checkpoint.state['units'].values()), imputer
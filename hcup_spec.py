@@ -0,0 +1,376 @@
+import csv
+import importlib
+import json
+import os
+import re
+
+import numpy as np
+
+from compression import strip_compression
+
+# Column layout of the FileSpecifications_*.TXT files themselves (1-based, inclusive),
+# taken from the "Columns / Description" block at the top of every spec file
+SPEC_LAYOUT = {
+    'database': (1, 3),
+    'year': (5, 8),
+    'file_name': (10, 35),
+    'element_number': (37, 40),
+    'name': (42, 70),
+    'start': (72, 75),
+    'end': (77, 80),
+    'decimals': (82, 82),
+    'type': (84, 87),
+    'label': (89, 188),
+}
+
+HEADER_FIELDS = {
+    'Data Set Name': 'data_set_name',
+    'Number of Observations': 'n_observations',
+    'Total Record Length': 'record_length',
+    'Total Number of Data Elements': 'n_elements',
+}
+
+
+def _slice(line, key):
+    """Return the stripped text of a spec line between the columns for key"""
+    start, end = SPEC_LAYOUT[key]
+    return line[start - 1:end].strip()
+
+
+def parse_spec_file(spec_path):
+    """Parse an HCUP FileSpecifications TXT file into header info and a field list"""
+    header = {}
+    fields = []
+
+    with open(spec_path, 'r') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+
+            # Header lines look like "Total Record Length: 647"
+            if ':' in line and not fields:
+                key, _, value = line.partition(':')
+                if key.strip() in HEADER_FIELDS:
+                    value = value.strip()
+                    header[HEADER_FIELDS[key.strip()]] = int(value) if value.isdigit() else value
+                    continue
+
+            # Data element lines start with the database name and have a numeric start column
+            start = _slice(line, 'start')
+            end = _slice(line, 'end')
+            if not (start.isdigit() and end.isdigit() and _slice(line, 'element_number').isdigit()):
+                continue
+
+            decimals = _slice(line, 'decimals')
+            fields.append({
+                'name': _slice(line, 'name'),
+                'start': int(start),
+                'end': int(end),
+                'width': int(end) - int(start) + 1,
+                'decimals': int(decimals) if decimals.isdigit() else 0,
+                'type': _slice(line, 'type'),
+                'label': _slice(line, 'label'),
+            })
+            header.setdefault('database', _slice(line, 'database'))
+            header.setdefault('year', _slice(line, 'year'))
+            header.setdefault('file_name', _slice(line, 'file_name'))
+
+    if not fields:
+        raise ValueError(f"No data elements found in spec file: {spec_path}")
+
+    # Older spec files may omit the record length; derive it from the last field
+    header.setdefault('record_length', max(field['end'] for field in fields))
+    return header, fields
+
+
+def find_spec_file(data_file, spec_dir=None):
+    """Find the FileSpecifications TXT matching an HCUP data file such as NIS_2019_Core.ASC"""
+    # Look next to the data file first, then alongside these scripts
+    search_dirs = [spec_dir] if spec_dir else [
+        os.path.dirname(os.path.abspath(data_file)),
+        os.path.dirname(os.path.abspath(__file__)),
+    ]
+    # Compressed inputs are matched on the file inside, e.g. NIS_2019_Core.ASC.gz
+    stem = os.path.splitext(os.path.basename(strip_compression(data_file)))[0].upper()
+
+    for directory in search_dirs:
+        if not os.path.isdir(directory):
+            continue
+
+        candidates = []
+        for file in os.listdir(directory):
+            match = re.match(r'FileSpecifications_(.+?)(_V\d+)?\.TXT$', file, re.IGNORECASE)
+            if match and match.group(1).upper() == stem:
+                candidates.append(file)
+
+        # Prefer the latest version of the spec (e.g. _V2 over _V1)
+        if candidates:
+            return os.path.join(directory, sorted(candidates)[-1])
+
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Sentinel codes
+# ---------------------------------------------------------------------------
+
+# Num fields code missing, invalid, unavailable, inconsistent and not-applicable values as a negative run
+# of one digit as wide as the field (-9, -99, -999.99); Char fields spell invalid and inconsistent out
+SENTINEL_DIGITS = {'9': 'missing', '8': 'invalid', '7': 'unavailable', '6': 'inconsistent', '5': 'not_applicable'}
+TEXT_SENTINELS = {'invl': 'invalid', 'incn': 'inconsistent'}
+
+
+def sentinel_code(value, field=None):
+    """
+    The HCUP sentinel a parsed value stands for, as text ('-99', 'invl'), or None for real values.
+
+    A numeric code is a run of one digit as wide as the value's spec field:
+    -99 in a 3-wide field, -99.99 in a 6-wide field with two decimals (or
+    5-wide with the point implied). Without a field only whole numbers can
+    be codes, so an imputed -5.5 is never taken for one.
+    """
+    if isinstance(value, str):
+        text = value.strip().lower()
+        return text if text in TEXT_SENTINELS else None
+    if not isinstance(value, (int, float, np.number)) or isinstance(value, (bool, np.bool_)) or not value < 0:
+        return None
+    # Shortest text that round-trips in the value's own precision, so float32 -99.99 reads as 99.99
+    digits = np.format_float_positional(value if isinstance(value, np.floating) else float(value), trim='-')[1:]
+    if len(set(digits.replace('.', ''))) != 1 or digits[0] not in SENTINEL_DIGITS:
+        return None
+    whole, _, fraction = digits.partition('.')
+    if field is None:
+        return None if fraction else '-' + digits
+    if field['type'] != 'Num' or len(fraction) != field['decimals']:
+        return None
+    # The sign takes one place, and an explicit decimal point another
+    run = len(whole) + len(fraction)
+    if run != field['width'] - 1 and not (fraction and run == field['width'] - 2):
+        return None
+    return '-' + digits
+
+
+def sentinel_kind(code):
+    """'missing', 'invalid', 'unavailable', 'inconsistent' or 'not_applicable' for a sentinel_code()"""
+    return TEXT_SENTINELS.get(code) or SENTINEL_DIGITS[code[1]]
+
+
+def sentinel_rule(field):
+    """How the ASC reader spots a field's sentinels: 'numeric', 'text', or None for fields too narrow to hold one"""
+    if field['type'] == 'Num':
+        # A sentinel needs the minus sign and at least one digit
+        return 'numeric' if field['width'] >= 2 else None
+    return 'text' if field['width'] >= min(len(code) for code in TEXT_SENTINELS) else None
+
+
+def without_sentinels(schema):
+    """Copy of a compiled schema whose fields keep their sentinel codes as read"""
+    fields = [dict(field, sentinels=None) for field in schema['fields']]
+    return dict(schema, fields=fields, by_name={field['name']: field for field in fields})
+
+
+# ---------------------------------------------------------------------------
+# Schema registry
+# ---------------------------------------------------------------------------
+
+SCHEMA_CACHE_FILE = '.hcup_schema_cache.json'
+
+# Largest unsigned value each integer dtype can hold, narrowest first
+INT_DTYPES = [('int8', 127), ('int16', 32767), ('int32', 2147483647), ('int64', 9223372036854775807)]
+
+_registry = {}
+
+
+def narrowest_dtype(field):
+    """Pick the smallest dtype that holds every value the field's width allows"""
+    if field['type'] != 'Num':
+        return 'category'
+
+    if field['decimals']:
+        # One character goes to the decimal point; float32 keeps about 7 significant digits
+        return 'float32' if field['width'] - 1 <= 7 else 'float64'
+
+    max_value = 10 ** field['width'] - 1
+    for dtype, limit in INT_DTYPES:
+        if max_value <= limit:
+            return dtype
+    return 'float64'
+
+
+def compile_schema(header, fields):
+    """Attach dtypes and sentinel rules to the parsed spec and index fields by name"""
+    for field in fields:
+        field['dtype'] = narrowest_dtype(field)
+        field['sentinels'] = sentinel_rule(field)
+
+    return {
+        'name': header.get('file_name') or header.get('data_set_name'),
+        'header': header,
+        'fields': fields,
+        'by_name': {field['name']: field for field in fields},
+    }
+
+
+def _spec_key(spec_path):
+    """Identify a spec file version by name, size and modification time"""
+    stat = os.stat(spec_path)
+    return f"{os.path.basename(spec_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def load_registry(spec_dir=None, refresh=False):
+    """Parse every FileSpecifications_*.TXT in spec_dir once and cache the compiled schemas"""
+    spec_dir = os.path.abspath(spec_dir or os.path.dirname(os.path.abspath(__file__)))
+    if spec_dir in _registry and not refresh:
+        return _registry[spec_dir]
+
+    cache_path = os.path.join(spec_dir, SCHEMA_CACHE_FILE)
+    cached = {}
+    if os.path.exists(cache_path) and not refresh:
+        try:
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+
+    schemas = {}
+    cache = {}
+    for file in sorted(os.listdir(spec_dir)):
+        match = re.match(r'FileSpecifications_(.+?)(_V\d+)?\.TXT$', file, re.IGNORECASE)
+        if not match:
+            continue
+
+        spec_path = os.path.join(spec_dir, file)
+        key = _spec_key(spec_path)
+        if key in cached:
+            header, fields = cached[key]['header'], cached[key]['fields']
+        else:
+            header, fields = parse_spec_file(spec_path)
+
+        schema = compile_schema(header, fields)
+        schema['spec_path'] = spec_path
+        schema['spec_key'] = key
+        # Later versions sort last and replace earlier ones
+        schemas[match.group(1).upper()] = schema
+        cache[key] = {'header': header, 'fields': fields}
+
+    if cache != cached:
+        try:
+            with open(cache_path, 'w') as f:
+                json.dump(cache, f)
+        except OSError:
+            pass
+
+    _registry[spec_dir] = schemas
+    return schemas
+
+
+def get_schema(name, spec_dir=None):
+    """Look up a compiled schema by file stem, e.g. 'NIS_2019_Core' or 'NIS_2019_Core.ASC'"""
+    stem = os.path.splitext(os.path.basename(strip_compression(name)))[0].upper()
+    for prefix in ('PROCESSED_', ''):
+        if stem.startswith(prefix) and stem[len(prefix):] in load_registry(spec_dir):
+            return load_registry(spec_dir)[stem[len(prefix):]]
+    return None
+
+
+def column_names(name, spec_dir=None):
+    """Column names of a data file in spec order"""
+    schema = get_schema(name, spec_dir)
+    if schema is None:
+        raise KeyError(f"No spec file registered for {name}")
+    return [field['name'] for field in schema['fields']]
+
+
+def fallback_columns(name):
+    """
+    Column names for a file with no registered spec, from the hand-kept list
+    for its file type in the <FAMILY>_Columns module (e.g. NIS_Columns for
+    NIS_2019_Severity); None when there is none. Only for spec-less files:
+    file_columns always prefers the spec.
+    """
+    stem = os.path.splitext(os.path.basename(strip_compression(name)))[0]
+    if stem.upper().startswith('PROCESSED_'):
+        stem = stem[len('PROCESSED_'):]
+    family, _, file_type = (stem.split('_', 2) + ['', ''])[:3]
+    try:
+        module = importlib.import_module(f'{family.upper()}_Columns')
+        lists = getattr(module, f'{family.lower()}_file_columns')
+    except (ImportError, AttributeError):
+        return None
+
+    file_type = file_type.lower()
+    for key, columns in lists.items():
+        # NEDS ships e.g. NEDS_2019_DX_PR for what the column module calls dx_pr_grps
+        if file_type and (key == file_type or key.startswith(file_type) or file_type.startswith(key)):
+            return columns
+    return None
+
+
+def file_columns(name, spec_dir=None):
+    """Column names of a data file: its spec's if registered, else fallback_columns (None if neither)"""
+    schema = get_schema(name, spec_dir)
+    if schema is not None:
+        return [field['name'] for field in schema['fields']]
+    return fallback_columns(name)
+
+
+def pandas_dtype(field, float_numeric=False):
+    """pandas dtype for a field; nullable ints, or exact-width floats when float_numeric is set"""
+    dtype = field['dtype']
+    if dtype.startswith('int'):
+        if float_numeric:
+            # float32 represents every integer up to 2**24 exactly
+            return 'float32' if field['width'] <= 7 else 'float64'
+        return dtype.capitalize()
+    return dtype
+
+
+def lookup_fields(columns, spec_dir=None):
+    """Map column names to their spec fields across every registered schema"""
+    known = {}
+    for schema in load_registry(spec_dir).values():
+        for name, field in schema['by_name'].items():
+            known.setdefault(name, field)
+
+    return {col: known[col] for col in columns if col in known}
+
+
+def lookup_dtypes(columns, spec_dir=None, float_numeric=False):
+    """Map column names to spec dtypes across every registered schema"""
+    return {col: pandas_dtype(field, float_numeric) for col, field in lookup_fields(columns, spec_dir).items()}
+
+
+def restore_integers(df, spec_dir=None):
+    """Cast float columns of integer spec fields back to nullable ints wherever every value is whole
+
+    Stages read integer fields as floats so imputed fractions fit; this writes keys and codes such as
+    KEY_NIS or DQTR as 100000000 and 3 again rather than 100000000.0 and 3.0.
+    """
+    fields = lookup_fields(set(df.columns), spec_dir)
+    restored = df
+    # Positions rather than names, since merged frames can repeat a column such as HOSP_NIS
+    for i, col in enumerate(df.columns):
+        field = fields.get(col)
+        if field is None or not field['dtype'].startswith('int') or df.dtypes.iloc[i].kind != 'f':
+            continue
+        values = df.iloc[:, i].to_numpy()
+        if np.array_equal(values, np.round(values), equal_nan=True):
+            # The caller's frame keeps its floats; stages carry chunks over into later imputation
+            if restored is df:
+                restored = df.copy(deep=False)
+            restored.isetitem(i, df.iloc[:, i].astype(pandas_dtype(field)))
+    return restored
+
+
+def csv_dtypes(csv_path, spec_dir=None, float_numeric=False):
+    """dtype mapping for pd.read_csv based on the CSV header and the registry"""
+    with open(csv_path, 'r', newline='') as f:
+        columns = next(csv.reader(f), [])
+    return lookup_dtypes(columns, spec_dir, float_numeric)
+
+
+def schema_for_file(data_file, spec_dir=None):
+    """Compiled schema for an HCUP data file, searching next to the file and then these scripts"""
+    spec_path = find_spec_file(data_file, spec_dir)
+    if spec_path is None:
+        return None
+    return get_schema(data_file, os.path.dirname(spec_path))
@@ -0,0 +1,353 @@
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from asc_reader import read_asc
+from column_profile import load_profile
+from compression import strip_compression
+from filters import filter_value, normalize_filters, parse_filters
+from hcup_spec import lookup_dtypes, lookup_fields, schema_for_file
+from memory_budget import DEFAULT_MEMORY_BUDGET, ChunkSizer, estimate_row_bytes
+from output_formats import frame_columns, read_frames
+from row_counts import count_rows
+from stage_cache import file_fingerprint
+
+# DuckDB is optional; SQLite ships with Python
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+STORE_ENGINES = ['sqlite', 'duckdb']
+DEFAULT_STORE = 'hcup_store.db'
+# Columns analyses join and group on get an index once a table is loaded
+INDEXED_COLUMNS = re.compile(r'^(KEY_\w+|HOSP_\w+|APRDRG|DRG)$')
+SOURCES_TABLE = 'hcup_sources'
+
+SQL_TYPES = {
+    'sqlite': {'int8': 'INTEGER', 'int16': 'INTEGER', 'int32': 'INTEGER', 'int64': 'INTEGER',
+               'float32': 'REAL', 'float64': 'REAL', 'text': 'TEXT', 'bool': 'INTEGER'},
+    'duckdb': {'int8': 'TINYINT', 'int16': 'SMALLINT', 'int32': 'INTEGER', 'int64': 'BIGINT',
+               'float32': 'FLOAT', 'float64': 'DOUBLE', 'text': 'VARCHAR', 'bool': 'BOOLEAN'},
+}
+SQL_OPS = {'==': '=', '!=': '<>', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+
+
+def require_duckdb():
+    """Fail with an install hint when a DuckDB store is requested without duckdb"""
+    if duckdb is None:
+        raise ImportError("DuckDB stores require duckdb. Please run: pip install duckdb")
+
+
+def quote(name):
+    """Quote an identifier for SQLite and DuckDB alike"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def table_name_for(path):
+    """Default table name for a data file, e.g. NIS_2019_Core.csv.gz -> NIS_2019_Core"""
+    stem = os.path.splitext(os.path.basename(strip_compression(path.rstrip('/\\'))))[0]
+    return re.sub(r'\W', '_', stem)
+
+
+def engine_for(db_path):
+    """DuckDB for .duckdb files, SQLite for everything else"""
+    return 'duckdb' if db_path.lower().endswith('.duckdb') else 'sqlite'
+
+
+def column_type(col, dtype, engine, summary=None):
+    """
+    SQL type for a column: the spec's width where the field is known, else
+    what its column profile summary saw across the file, else the parsed dtype.
+    """
+    types = SQL_TYPES[engine]
+    field = lookup_fields([col]).get(col)
+    if field is not None:
+        return types['text'] if field['dtype'] == 'category' else types[field['dtype']]
+    if summary is not None:
+        # Whole numbers parsed as floats only because some chunks had gaps are still integers
+        if summary['kind'] == 'float' and not summary.get('whole', True):
+            return types['float64']
+        return types['int64'] if summary['kind'] in ('integer', 'float') else types[summary['kind']]
+    if pd.api.types.is_bool_dtype(dtype):
+        return types['bool']
+    if pd.api.types.is_integer_dtype(dtype):
+        return types['int64']
+    if pd.api.types.is_float_dtype(dtype):
+        return types['float64']
+    return types['text']
+
+
+def _is_integer_type(sql_type):
+    return sql_type in ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT')
+
+
+def _has_fractions(series):
+    values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+    values = values[np.isfinite(values)]
+    return bool(len(values)) and bool((values != np.round(values)).any())
+
+
+class HcupStore:
+    """
+    Local analytical store for converted HCUP tables.
+
+    Loads CSV, Parquet or ASC files into SQLite (built in) or DuckDB
+    (optional, faster for scans and aggregations) with column types taken
+    from the spec files, indexes the key, hospital and DRG columns, and
+    answers queries as DataFrames. Each table remembers the fingerprint of
+    the file it came from, so reloading an unchanged file is a no-op.
+    """
+
+    def __init__(self, db_path=DEFAULT_STORE, engine=None):
+        self.db_path = db_path
+        self.engine = engine or engine_for(db_path)
+        if self.engine not in STORE_ENGINES:
+            raise ValueError(f"Unknown store engine '{self.engine}'; expected one of {STORE_ENGINES}")
+
+        if self.engine == 'duckdb':
+            require_duckdb()
+            self.conn = duckdb.connect(db_path)
+        else:
+            # Transactions are managed explicitly so a failed load leaves the old table in place
+            self.conn = sqlite3.connect(db_path, isolation_level=None)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS {SOURCES_TABLE} (table_name VARCHAR PRIMARY KEY, '
+                          'source VARCHAR, fingerprint VARCHAR, params VARCHAR, n_rows BIGINT, loaded_at VARCHAR)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def query(self, sql, params=None):
+        """Run a query and return the result as a DataFrame"""
+        if self.engine == 'duckdb':
+            return self.conn.execute(sql, params or []).df()
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def tables(self):
+        """Loaded tables with the file, row count and load time of each"""
+        return self.query(f'SELECT table_name, source, n_rows, loaded_at FROM {SOURCES_TABLE} ORDER BY table_name')
+
+    def has_table(self, table):
+        return not self.query(f'SELECT 1 FROM {SOURCES_TABLE} WHERE table_name = ?', [table]).empty
+
+    def columns(self, table):
+        """Column names and SQL types of a table, in table order"""
+        if self.engine == 'duckdb':
+            info = self.query('SELECT column_name AS name, data_type AS type FROM information_schema.columns '
+                              'WHERE table_name = ? ORDER BY ordinal_position', [table])
+        else:
+            info = self.query('SELECT name, type FROM pragma_table_info(?)', [table])
+        return dict(zip(info['name'], info['type']))
+
+    def table(self, table, columns=None, filters=None, limit=None):
+        """
+        Read a table, or some of its columns and rows, as a DataFrame.
+
+        filters takes the same DNF terms as the readers, e.g.
+        [('HOSP_DIVISION', '==', 3), ('AGE', '>=', 65)], and is evaluated by
+        the database so only matching rows leave it.
+        """
+        types = self.columns(table)
+        if not types:
+            raise KeyError(f"No table {table} in {self.db_path}")
+        # SQLite would read an unknown quoted column as a string literal rather than fail
+        missing = [col for col in columns or [] if col not in types]
+        if missing:
+            raise KeyError(f"Columns not in {table}: {missing}")
+        select = ', '.join(quote(col) for col in columns) if columns else '*'
+        where, params = self._where(filters, types)
+        sql = f'SELECT {select} FROM {quote(table)}{where}'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return self.query(sql, params)
+
+    def _where(self, filters, types):
+        """WHERE clause and parameters for DNF filters"""
+        filters = normalize_filters(filters)
+        if filters is None:
+            return '', []
+
+        params = []
+        disjuncts = []
+        for conjunction in filters:
+            terms = []
+            for col, op, value in conjunction:
+                if col not in types:
+                    raise KeyError(f"Filter column {col} not in the table")
+                text = types[col].upper() in ('TEXT', 'VARCHAR')
+                values = filter_value(value if op in ('in', 'not in') else [value], text)
+                params.extend(values)
+                if op in ('in', 'not in'):
+                    placeholders = ', '.join('?' * len(values))
+                    terms.append(f"{quote(col)} {op.upper()} ({placeholders})")
+                else:
+                    terms.append(f"{quote(col)} {SQL_OPS[op]} ?")
+            disjuncts.append('(' + ' AND '.join(terms) + ')')
+        return ' WHERE ' + ' OR '.join(disjuncts), params
+
+    def load(self, data_file, table=None, columns=None, filters=None, memory_budget=DEFAULT_MEMORY_BUDGET,
+             replace=False):
+        """
+        Load a converted HCUP file into a table, replacing any earlier load of it.
+
+        Skips the load when the table already holds this file unchanged
+        (same fingerprint, columns and filters) unless replace is set.
+        Returns the number of rows in the table.
+        """
+        table = table or table_name_for(data_file)
+        fingerprint = file_fingerprint(data_file)
+        params = json.dumps({'columns': columns, 'filters': filters}, sort_keys=True)
+
+        loaded = self.query(f'SELECT source, fingerprint, params, n_rows FROM {SOURCES_TABLE} WHERE table_name = ?',
+                            [table])
+        if not replace and not loaded.empty:
+            source = loaded.iloc[0]
+            if (source['source'], source['fingerprint'], source['params']) == (os.path.abspath(data_file),
+                                                                             fingerprint, params):
+                logging.info(f"{table} is up to date with {data_file} ({int(source['n_rows']):,} rows)")
+                return int(source['n_rows'])
+
+        print(f"Loading {data_file} into {table}...")
+        all_columns = columns or self._file_columns(data_file)
+        dtypes = lookup_dtypes(all_columns, float_numeric=True)
+        sizer = ChunkSizer(memory_budget, estimate_row_bytes(all_columns, dtypes), in_flight=2)
+        profile = None
+        if strip_compression(data_file).upper().endswith('.ASC'):
+            chunks = read_asc(data_file, schema_for_file(data_file), sizer, columns=columns, filters=filters)
+        else:
+            chunks = read_frames(data_file, columns=columns, chunk_size=sizer, dtype=dtypes, filters=filters,
+                                 low_memory=False)
+            if any(col not in dtypes for col in all_columns):
+                # Columns the specs don't cover are typed from the whole file, not from its first chunk
+                profile = load_profile(data_file, memory_budget=memory_budget)
+
+        n_rows = 0
+        self.conn.execute('BEGIN TRANSACTION')
+        try:
+            self.conn.execute(f'DROP TABLE IF EXISTS {quote(table)}')
+            types = None
+            with tqdm(total=count_rows(data_file), desc=f"Loading {table}", unit="rows") as pbar:
+                for chunk in sizer.track(chunks):
+                    if types is None:
+                        types = self._create_table(table, chunk, profile)
+                    self._insert(table, chunk, types)
+                    n_rows += len(chunk)
+                    pbar.update(len(chunk))
+            if types is None:
+                # Nothing matched; still leave a typed, empty table behind
+                types = self._create_table(table, pd.DataFrame(columns=all_columns), profile)
+            self._create_indexes(table, types)
+            self.conn.execute(f'DELETE FROM {SOURCES_TABLE} WHERE table_name = ?', [table])
+            self.conn.execute(f'INSERT INTO {SOURCES_TABLE} VALUES (?, ?, ?, ?, ?, ?)',
+                              [table, os.path.abspath(data_file), fingerprint, params, n_rows,
+                               datetime.now().isoformat(timespec='seconds')])
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+
+        logging.info(f"Loaded {n_rows:,} rows from {data_file} into {table}")
+        return n_rows
+
+    def _file_columns(self, data_file):
+        if strip_compression(data_file).upper().endswith('.ASC'):
+            return [field['name'] for field in schema_for_file(data_file)['fields']]
+        return frame_columns(data_file)
+
+    def _create_table(self, table, chunk, profile=None):
+        summaries = profile['columns'] if profile is not None else {}
+        types = {col: column_type(col, chunk[col].dtype, self.engine, summaries.get(col)) for col in chunk.columns}
+        columns = ', '.join(f'{quote(col)} {sql_type}' for col, sql_type in types.items())
+        self.conn.execute(f'CREATE TABLE {quote(table)} ({columns})')
+        return types
+
+    def _insert(self, table, chunk, types):
+        if self.engine == 'sqlite':
+            # INTEGER affinity stores whole floats as integers and keeps imputed fractions as REAL
+            rows = chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None)
+            placeholders = ', '.join('?' * len(chunk.columns))
+            self.conn.executemany(f'INSERT INTO {quote(table)} VALUES ({placeholders})', rows)
+            return
+
+        # DuckDB would round imputed fractions in integer columns; widen those columns instead
+        for col, sql_type in types.items():
+            if _is_integer_type(sql_type) and _has_fractions(chunk[col]):
+                self.conn.execute(f'ALTER TABLE {quote(table)} ALTER {quote(col)} TYPE DOUBLE')
+                types[col] = 'DOUBLE'
+        self.conn.register('hcup_chunk', chunk)
+        try:
+            select = ', '.join(quote(col) for col in chunk.columns)
+            self.conn.execute(f'INSERT INTO {quote(table)} SELECT {select} FROM hcup_chunk')
+        finally:
+            self.conn.unregister('hcup_chunk')
+
+    def _create_indexes(self, table, types):
+        for col in types:
+            if INDEXED_COLUMNS.match(col):
+                self.conn.execute(f'CREATE INDEX {quote(f"{table}_{col}")} ON {quote(table)} ({quote(col)})')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+
+    parser = argparse.ArgumentParser(description="Load converted HCUP files into a local analytical store and query it")
+    parser.add_argument('--db', default=DEFAULT_STORE, help="Store file (.duckdb uses DuckDB, anything else SQLite)")
+    parser.add_argument('--engine', choices=STORE_ENGINES, default=None, help="Override the engine implied by --db")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help="Load CSV, Parquet or ASC files, one table each")
+    load.add_argument('files', nargs='+', help="Converted HCUP files")
+    load.add_argument('--table', default=None, help="Table name (only with a single file; default: file stem)")
+    load.add_argument('--columns', nargs='*', default=None, help="Only load these columns")
+    load.add_argument('--filter', action='append', default=None, dest='filters',
+                      help="Only load matching rows, e.g. 'AGE >= 65' (repeat to AND several)")
+    load.add_argument('--memory-budget', default=DEFAULT_MEMORY_BUDGET,
+                      help="Memory to size chunks against, e.g. 512MB or 8GB")
+    load.add_argument('--replace', action='store_true', help="Reload even if the file is unchanged")
+
+    query = commands.add_parser('query', help="Run SQL and print or save the result")
+    query.add_argument('sql', help="Query to run")
+    query.add_argument('--output', default=None, help="Save the result to this CSV instead of printing it")
+
+    commands.add_parser('tables', help="List loaded tables")
+    args = parser.parse_args()
+
+    with HcupStore(args.db, args.engine) as store:
+        if args.command == 'load':
+            if args.table and len(args.files) > 1:
+                parser.error("--table needs a single file")
+            for data_file in args.files:
+                store.load(data_file, args.table, args.columns, parse_filters(args.filters), args.memory_budget,
+                           args.replace)
+        elif args.command == 'query':
+            result = store.query(args.sql)
+            if args.output:
+                result.to_csv(args.output, index=False)
+                print(f"Saved {len(result):,} rows to {args.output}")
+            else:
+                print(result.to_string(index=False))
+        else:
+            print(store.tables().to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,642 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from hcup_spec import lookup_fields
+
+# Fill value for text columns with no values at all in a chunk
+UNKNOWN_CATEGORY = 'Unknown'
+# Numeric columns are interpolated in blocks of about this many cells, bounding the float64 working arrays
+BLOCK_CELLS = 1 << 21
+
+# Longest gap (in rows) a StreamingImputer holds rows back for; longer gaps are forward filled
+DEFAULT_MAX_PENDING = 100000
+
+DEFAULT_NUMERIC_METHOD = 'linear'
+DEFAULT_CATEGORICAL_METHOD = 'mode'
+
+# Strategies filled with ndarray passes, and those left to pandas column by column
+BLOCK_STRATEGIES = ('linear', 'pad', 'mode', 'forward')
+# Fills from the rows of the same group (e.g. hospital or DRG), joined on the group's key columns
+GROUP_STRATEGIES = ('group_mean', 'group_mode')
+SERIES_STRATEGIES = ('linear_series', 'pad_series', 'mode_series', 'mean', 'median', 'time', 'polynomial')
+# Fills that average a column, which key and code columns never take
+AVERAGING_STRATEGIES = ('mean', 'median', 'group_mean')
+# Fills that come from neighbouring rows, which a StreamingImputer carries across chunks
+STREAMED_STRATEGIES = ('linear', 'pad', 'forward')
+# Integer spec fields that measure an amount (ages, stays, charges, counts), so interpolating or averaging
+# them gives a sensible value; every other integer field (keys, DRGs, payers, quarters, regions, flags) is a code
+MEASURE_COLUMNS = ('AGE', 'LOS', 'TOTCHG', 'I10_NDX', 'I10_NPR', 'N_DISC_U', 'N_HOSP_U', 'S_DISC_U', 'S_HOSP_U',
+                   'TOTAL_DISC')
+# Prefixes of numbered measure fields, e.g. PRDAY1-PRDAY25 (days from admission to each procedure)
+MEASURE_PREFIXES = ('PRDAY',)
+
+
+def fill_with_mode(series, mode_value=None):
+    """Fill missing values with the column mode (or a given one), or 'Unknown' if the column is empty"""
+    if mode_value is None:
+        mode = series.mode()
+        mode_value = mode[0] if not mode.empty else UNKNOWN_CATEGORY
+
+    # Spec Char columns are read as categoricals, which only accept known categories
+    if isinstance(series.dtype, pd.CategoricalDtype) and mode_value not in series.cat.categories:
+        series = series.cat.add_categories([mode_value])
+    return series.fillna(mode_value)
+
+
+def column_pattern(col, dataset_patterns=None):
+    """
+    The dataset pattern for a column: the one keyed by its full name (e.g.
+    'TOTCHG'), else the one for its prefix (the part before its first '_',
+    '' for names without one), else {}.
+    """
+    patterns = dataset_patterns or {}
+    if col in patterns:
+        return patterns[col] or {}
+    prefix = col.split('_')[0] if '_' in col else ''
+    return patterns.get(prefix) or {}
+
+
+def code_columns(columns, dataset_patterns=None):
+    """
+    Columns holding keys or codes, which interpolating or averaging would turn into values that don't
+    exist (a DRG of 190.4, a quarter of 1.67): the group_by columns of every pattern, and integer spec
+    fields that are not measures (see MEASURE_COLUMNS) and that no pattern names by their full name.
+    """
+    patterns = dataset_patterns or {}
+    keys = {key for pattern in patterns.values() if pattern for key in pattern.get('group_by') or ()}
+    integers = {col for col, field in lookup_fields(columns).items()
+                if field['dtype'].startswith('int') and not is_measure(col)}
+    return {col for col in columns if col in keys or (col in integers and col not in patterns)}
+
+
+def is_measure(col):
+    """Whether an integer spec field measures an amount rather than holding a code"""
+    return col in MEASURE_COLUMNS or any(col.startswith(p) and col[len(p):].isdigit() for p in MEASURE_PREFIXES)
+
+
+def parse_patterns(text):
+    """Dataset patterns from a --patterns option: inline JSON or the path of a JSON file"""
+    if os.path.isfile(text):
+        with open(text, 'r') as f:
+            return json.load(f)
+    return json.loads(text)
+
+
+def column_strategy(col, dtype, dataset_patterns=None, code=False):
+    """
+    How a column is imputed, from its dtype and any dataset pattern for its name or prefix.
+
+    Numeric columns are interpolated ('linear', 'time', 'polynomial') and
+    then padded from their neighbours, or take their 'mean' or 'median'; an
+    unknown numeric method only pads.
+    Other columns take their mode or are padded ('forward'); an unknown
+    categorical method leaves them alone. 'group_mean' and 'group_mode' take
+    the mean or mode of the rows sharing the pattern's 'group_by' columns,
+    e.g. {'numeric_method': 'group_mean', 'group_by': ['APRDRG', 'APRDRG_Severity']}.
+    Key and code columns (code, see code_columns) are padded instead of
+    interpolated and take their mode instead of any average. Columns that cannot hold missing values (numpy ints and
+    bools) get 'none'.
+    """
+    pattern = column_pattern(col, dataset_patterns)
+    is_numpy = isinstance(dtype, np.dtype)
+
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'none' if is_numpy else 'mode_series'
+    if pd.api.types.is_numeric_dtype(dtype):
+        if is_numpy and dtype.kind in 'iu':
+            return 'none'
+        method = pattern.get('numeric_method', DEFAULT_NUMERIC_METHOD)
+        if code and method in AVERAGING_STRATEGIES:
+            return 'mode_series'
+        if code:
+            return 'pad' if is_numpy else 'pad_series'
+        if method == 'linear':
+            return 'linear' if is_numpy else 'linear_series'
+        if method in ('time', 'polynomial', 'mean', 'median', 'group_mean'):
+            return method
+        return 'pad' if is_numpy else 'pad_series'
+
+    method = pattern.get('categorical_method', DEFAULT_CATEGORICAL_METHOD)
+    categorical = isinstance(dtype, pd.CategoricalDtype)
+    if method == 'mode':
+        return 'mode' if categorical else 'mode_series'
+    if method == 'forward':
+        return 'forward' if categorical else 'pad_series'
+    if method == 'group_mode':
+        return method
+    return 'none'
+
+
+def _gap_runs(missing, n):
+    """Column, starting row and length of each run of consecutive gaps in a block of columns laid end to end"""
+    # Pad every column so runs can't continue from one column into the next
+    padded = np.zeros((len(missing) // n, n + 2), dtype=np.int8)
+    padded[:, 1:-1] = missing.reshape(-1, n)
+    steps = np.diff(padded, axis=1)
+    column, start = np.divmod(np.flatnonzero(steps == 1), n + 1)
+    end = np.flatnonzero(steps == -1) - column * (n + 1)
+    return column, start, end - start
+
+
+def fill_columns(flat, missing, n, linear=True, carried=None, final=True, max_gap=None, following=None):
+    """
+    Fill, in place, the gaps of a block of columns laid end to end (column-major, n rows each).
+
+    With linear, gaps between two values are interpolated with np.interp's
+    float64 arithmetic, so results are bit-identical to Series.interpolate;
+    otherwise they take the value before them. Gaps at the end of a column
+    take the value before them and gaps at its start the value after them,
+    as ffill().bfill() would; empty columns stay empty.
+
+    carried continues the columns from an earlier block: per column the last
+    value seen, how many rows before this block it was, and whether there was
+    one. following does the same for the first value after the block (how
+    many rows past its last row), closing gaps that run off its end. Unless
+    final, gaps still open at the end of the block are left for a later
+    block. Gaps longer than max_gap rows are forward filled instead
+    (and stay empty before a column's first value). Returns the row of each
+    column from which it must wait for a later block (n when it needn't).
+    """
+    hold = np.full(len(flat) // n, n)
+    column, start, lengths = _gap_runs(missing, n)
+    if len(column) == 0:
+        return hold
+    first = column * n + start
+    has_before = start > 0
+    has_after = start + lengths < n
+    before = flat[np.where(has_before, first - 1, first)]
+    after = flat[np.where(has_after, first + lengths, first)]
+    if linear:
+        before, after = before.astype(np.float64), after.astype(np.float64)
+
+    # Rows of a run's gap that came before this block
+    shift = np.zeros(len(column), dtype=np.int64)
+    if carried is not None:
+        values, distances, present = carried
+        leading = ~has_before
+        shift[leading] = distances[column[leading]] - 1
+        carry = leading & present[column]
+        before[carry] = values[column[carry]]
+        has_before = has_before | carry
+    # Rows of a run's gap that come after this block
+    tail = np.zeros(len(column), dtype=np.int64)
+    if following is not None:
+        values, distances, present = following
+        trailing = ~has_after
+        tail[trailing] = distances[column[trailing]] - 1
+        close = trailing & present[column]
+        after[close] = values[column[close]]
+        has_after = has_after | close
+    span = lengths + shift + tail
+    long = span > max_gap if max_gap is not None else np.zeros(len(column), dtype=bool)
+
+    if not final:
+        # Open gaps wait for the value that closes them, unless a forward fill settles them
+        wait = ~has_after & ~long & (linear | ~has_before)
+        hold[column[wait]] = start[wait]
+
+    fill = np.where(has_before, before, np.where(has_after & ~long, after, flat[first]))
+    values = np.repeat(fill, lengths)
+    inside = has_before & has_after & ~long
+    if linear and inside.any():
+        # Each gap's distance from the value before it
+        offset = np.flatnonzero(missing) - np.repeat(first - 1 - shift, lengths)
+        inside_gaps = np.repeat(inside, lengths)
+        with np.errstate(invalid='ignore'):
+            slope = (after - before) / (span + 1)
+            values = np.where(inside_gaps, np.repeat(slope, lengths) * offset + np.repeat(before, lengths), values)
+            if not np.isfinite(slope[inside]).all():
+                # Like np.interp, retry a NaN caused by infinities from the right-hand neighbour
+                retry = np.flatnonzero(inside_gaps & np.isnan(values))
+                run = np.repeat(np.arange(len(column)), lengths)[retry]
+                values[retry] = slope[run] * (offset[retry] - span[run] - 1) + after[run]
+                values[retry] = np.where(np.isnan(values[retry]) & (before[run] == after[run]), after[run],
+                                         values[retry])
+    flat[missing] = values
+    return hold
+
+
+class ImputationPlan:
+    """
+    Strategy for every column of one schema (column names and dtypes), compiled once and reused per chunk.
+
+    stats, when given, supplies whole-file fill values through
+    fill_value(col, 'mode' | 'mean' | 'median'); without it (or for columns
+    it doesn't know) each chunk's own statistics are used; likewise for the
+    per-group tables of the group strategies (stats.group_table(keys)).
+    """
+
+    def __init__(self, columns, dtypes, dataset_patterns=None, stats=None):
+        self.stats = stats
+        self.columns = {}
+        # Key columns of each grouped column
+        self.group_keys = {}
+        codes = code_columns(columns, dataset_patterns)
+        for col, dtype in zip(columns, dtypes):
+            strategy = column_strategy(col, dtype, dataset_patterns, col in codes)
+            if strategy in GROUP_STRATEGIES:
+                keys = tuple(column_pattern(col, dataset_patterns).get('group_by') or ())
+                if keys and col not in keys and all(key in columns for key in keys):
+                    self.group_keys[col] = keys
+                else:
+                    # Without usable key columns the whole file is one group
+                    categorical = isinstance(dtype, pd.CategoricalDtype)
+                    strategy = 'mean' if strategy == 'group_mean' else 'mode' if categorical else 'mode_series'
+            self.columns.setdefault(strategy, []).append(col)
+        # Interpolated numeric columns are handled in blocks of one dtype
+        self.linear_blocks = {}
+        self.pad_blocks = {}
+        dtype_of = dict(zip(columns, dtypes))
+        for strategy, blocks in (('linear', self.linear_blocks), ('pad', self.pad_blocks)):
+            for col in self.columns.get(strategy, []):
+                blocks.setdefault(dtype_of[col], []).append(col)
+
+    def __repr__(self):
+        return 'ImputationPlan(' + ', '.join(f'{strategy}={len(cols)}' for strategy, cols in self.columns.items()) + ')'
+
+    @property
+    def groups(self):
+        """Grouped columns by their key columns"""
+        groups = {}
+        for col, keys in self.group_keys.items():
+            groups.setdefault(keys, []).append(col)
+        return groups
+
+    def apply(self, df, record, strategies=None):
+        """Impute df in place, calling record(strategy, seconds, cells filled) per strategy"""
+        # Groups are joined on the key columns as read, before any of them is filled
+        key_frame = None
+        if self.group_keys:
+            key_frame = df[list(dict.fromkeys(key for keys in self.groups for key in keys))].copy()
+        for strategy in GROUP_STRATEGIES + BLOCK_STRATEGIES + SERIES_STRATEGIES:
+            if strategy not in self.columns or (strategies is not None and strategy not in strategies):
+                continue
+            start = time.perf_counter()
+            if strategy in SERIES_STRATEGIES:
+                cells = self._series(df, strategy)
+            elif strategy in GROUP_STRATEGIES:
+                cells = self._group_fill(df, strategy, key_frame)
+            else:
+                cells = getattr(self, '_' + strategy)(df)
+            record(strategy, time.perf_counter() - start, cells)
+        return df
+
+    def fill_value(self, col, statistic):
+        return self.stats.fill_value(col, statistic) if self.stats is not None else None
+
+    def _numeric_blocks(self, df, blocks, linear):
+        cells = 0
+        n = len(df)
+        width = max(1, BLOCK_CELLS // max(n, 1))
+        for cols in blocks.values():
+            for first in range(0, len(cols), width):
+                block = cols[first:first + width]
+                # Columns end to end in their own dtype; float32 results are rounded as pandas rounds them
+                flat = df[block].to_numpy().T.flatten()
+                missing = np.isnan(flat)
+                gaps = missing.reshape(len(block), n).any(axis=1)
+                if not gaps.any():
+                    continue
+                cells += int(missing.sum())
+                fill_columns(flat, missing, n, linear)
+                filled = flat.reshape(len(block), n).T
+                # Only columns with gaps are written back
+                df[[col for col, gap in zip(block, gaps) if gap]] = filled[:, gaps]
+        return cells
+
+    def _linear(self, df):
+        return self._numeric_blocks(df, self.linear_blocks, True)
+
+    def _pad(self, df):
+        return self._numeric_blocks(df, self.pad_blocks, False)
+
+    def _mode(self, df):
+        """Fill each categorical column's gaps with its most frequent category, working on the codes"""
+        cells = 0
+        for col in self.columns['mode']:
+            values = df[col].array
+            codes = values.codes
+            missing = codes < 0
+            if not missing.any():
+                continue
+            cells += int(missing.sum())
+            categories = values.categories
+            mode_value = self.fill_value(col, 'mode')
+            if mode_value is not None:
+                if mode_value not in categories:
+                    categories = categories.append(pd.Index([mode_value]))
+                fill_code = categories.get_loc(mode_value)
+            elif missing.all():
+                if UNKNOWN_CATEGORY not in categories:
+                    categories = categories.append(pd.Index([UNKNOWN_CATEGORY]))
+                fill_code = categories.get_loc(UNKNOWN_CATEGORY)
+            else:
+                # argmax takes the lowest code among ties, as Series.mode()[0] does
+                fill_code = np.bincount(codes[~missing], minlength=len(categories)).argmax()
+            df[col] = pd.Categorical.from_codes(np.where(missing, fill_code, codes), categories=categories,
+                                                ordered=values.ordered)
+        return cells
+
+    def _forward(self, df):
+        """Pad each categorical column from its neighbours, working on the codes"""
+        cells = 0
+        for col in self.columns['forward']:
+            values = df[col].array
+            missing = values.codes < 0
+            if not missing.any():
+                continue
+            cells += int(missing.sum())
+            codes = values.codes.copy()
+            fill_columns(codes, missing, len(codes), linear=False)
+            df[col] = pd.Categorical.from_codes(codes, dtype=values.dtype)
+        return cells
+
+    def _group_fill(self, df, strategy, key_frame):
+        """Fill gaps from their group's row of a lookup table, then from the whole column"""
+        cells = 0
+        cols = self.columns[strategy]
+        for keys, grouped in self.groups.items():
+            gaps = [col for col in grouped if col in cols and df[col].isna().any()]
+            if not gaps:
+                continue
+            table = self.stats.group_table(keys) if self.stats is not None else None
+            if table is None:
+                # No first pass: the chunk's own groups
+                from global_impute import GroupStats
+                table = GroupStats.from_frame(df.assign(**{key: key_frame[key] for key in keys}), keys, gaps)
+            fills = table.fill_values(key_frame, gaps)
+            for col in gaps:
+                series = df[col]
+                cells += int(series.isna().sum())
+                fill = pd.Series(fills[col], index=df.index)
+                if isinstance(series.dtype, pd.CategoricalDtype):
+                    # Set the codes directly, as _mode does
+                    values = series.array
+                    # Widened: the new categories may not fit the chunk's int8 codes
+                    codes = values.codes.astype(np.int32)
+                    take = (codes < 0) & fill.notna().to_numpy()
+                    categories = values.categories
+                    new = [value for value in pd.unique(fills[col][take]) if value not in categories]
+                    if new:
+                        categories = categories.append(pd.Index(new))
+                    codes[take] = categories.get_indexer(fills[col][take])
+                    series = pd.Series(pd.Categorical.from_codes(codes, categories=categories, ordered=values.ordered),
+                                       index=df.index, name=col)
+                    series = fill_with_mode(series, self.fill_value(col, 'mode'))
+                elif strategy == 'group_mode':
+                    series = fill_with_mode(series.fillna(fill), self.fill_value(col, 'mode'))
+                else:
+                    series = series.fillna(fill.astype(series.dtype))
+                    value = self.fill_value(col, 'mean')
+                    series = series.fillna(series.mean() if value is None else value)
+                df[col] = series
+        return cells
+
+    def _series(self, df, strategy):
+        """Column-at-a-time pandas fallback for dtypes and methods without a block implementation"""
+        cells = 0
+        for col in self.columns[strategy]:
+            # Always applied, even without gaps: pandas may change the dtype (Int32 interpolates to Float64)
+            series = df[col]
+            cells += int(series.isna().sum())
+            if strategy == 'mode_series':
+                df[col] = fill_with_mode(series, self.fill_value(col, 'mode'))
+            elif strategy in ('mean', 'median'):
+                value = self.fill_value(col, strategy)
+                df[col] = series.fillna(getattr(series, strategy)() if value is None else value)
+            elif strategy == 'pad_series':
+                df[col] = series.ffill().bfill()
+            elif strategy == 'polynomial':
+                df[col] = series.interpolate(method='polynomial', order=2, limit_direction='both').ffill().bfill()
+            else:
+                method = 'linear' if strategy == 'linear_series' else strategy
+                df[col] = series.interpolate(method=method, limit_direction='both').ffill().bfill()
+        return cells
+
+
+class Imputer:
+    """
+    Fill missing values chunk by chunk with compiled per-column plans.
+
+    Numeric columns are interpolated a block of columns at a time in one
+    ndarray pass, categoricals are filled through their codes, and only
+    columns that actually have gaps are touched. A plan is compiled the
+    first time a schema is seen, so the per-column dtype and pattern checks
+    aren't repeated on every chunk. Time and cells filled are accumulated
+    per strategy; call the imputer on a chunk to impute it. stats gives
+    whole-file mode, mean and median fill values (see global_impute.py).
+    """
+
+    def __init__(self, dataset_patterns=None, stats=None):
+        self.dataset_patterns = dataset_patterns
+        self.fill_stats = stats
+        self.plans = {}
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def plan_for(self, df):
+        # Categories differ from chunk to chunk, but strategies only depend on a column being categorical
+        signature = (tuple(df.columns),
+                     tuple('category' if isinstance(dtype, pd.CategoricalDtype) else dtype for dtype in df.dtypes))
+        plan = self.plans.get(signature)
+        if plan is None:
+            plan = ImputationPlan(df.columns, df.dtypes, self.dataset_patterns, self.fill_stats)
+            with self._lock:
+                self.plans[signature] = plan
+        return plan
+
+    def _record(self, strategy, seconds, cells):
+        with self._lock:
+            stats = self.stats.setdefault(strategy, {'seconds': 0.0, 'cells': 0, 'chunks': 0})
+            stats['seconds'] += seconds
+            stats['cells'] += cells
+            stats['chunks'] += 1
+
+    def __call__(self, df):
+        return self.plan_for(df).apply(df, self._record)
+
+    def summary(self):
+        """One line of time and cells filled per strategy"""
+        return ', '.join(f"{strategy} {stats['seconds']:.2f}s/{stats['cells']:,} cells"
+                         for strategy, stats in sorted(self.stats.items(), key=lambda item: -item[1]['seconds']))
+
+    def log_summary(self, label):
+        if self.stats:
+            logging.info(f"{label} imputation: {self.summary()}")
+
+
+class StreamingImputer:
+    """
+    Impute a stream of chunks exactly as if the whole file were imputed at once.
+
+    Interpolated and forward-filled columns carry their last value, and how
+    many rows back it was, into the next chunk. Rows whose gaps are still
+    open at the end of a chunk are held back until the value that closes
+    them arrives, so results don't depend on chunk size. Gaps longer than
+    max_pending rows are forward filled rather than held, which bounds the
+    rows held back. Mode fills and the pandas fallbacks still see each
+    chunk as it was read, unless stats gives them whole-file values. Call it
+    on each chunk for the rows that are ready, then flush() for the rest;
+    state() is what a resumed run needs to continue.
+    """
+
+    def __init__(self, dataset_patterns=None, max_pending=DEFAULT_MAX_PENDING, state=None, stats=None):
+        self.imputer = Imputer(dataset_patterns, stats)
+        self.max_pending = max_pending
+        self.pending = None
+        # Rows returned so far, and per column [last value, rows since it, whether there was one]
+        self.rows = state['rows'] if state else 0
+        self.carried = {col: list(value) for col, value in state['carried'].items()} if state else {}
+
+    @property
+    def stats(self):
+        return self.imputer.stats
+
+    def summary(self):
+        return self.imputer.summary()
+
+    def log_summary(self, label):
+        self.imputer.log_summary(label)
+
+    def state(self):
+        """JSON-serializable snapshot of the values carried into the next chunk"""
+        return {'rows': self.rows, 'carried': {col: list(value) for col, value in self.carried.items()}}
+
+    def __call__(self, chunk):
+        plan = self.imputer.plan_for(chunk)
+        # Mode fills and the pandas fallbacks don't depend on neighbouring rows; they see each chunk as read
+        plan.apply(chunk, self.imputer._record,
+                   [strategy for strategy in plan.columns if strategy not in STREAMED_STRATEGIES])
+        frame = chunk if self.pending is None else concat_chunks(self.pending, chunk)
+        return self._impute(frame, plan, final=False)
+
+    def flush(self, following=None):
+        """
+        Impute the rows still held back; None if there are none.
+
+        following closes gaps that run past the last row when the stream is
+        only part of a file: per column [first value after it, how many rows
+        after its last row, whether there is one], as carried state is kept.
+        """
+        frame, self.pending = self.pending, None
+        if frame is None:
+            return None
+        return self._impute(frame, self.imputer.plan_for(frame), final=True, following=following)
+
+    def _carried(self, cols, dtype, source=None):
+        """Carried (or following) values, distances and presence for a block of columns"""
+        # Columns not seen yet have been empty since the first row
+        empty = [None, self.rows + 1, False]
+        source = self.carried if source is None else source
+        state = [source.get(col, empty) for col in cols]
+        return (np.array([value for value, _, _ in state], dtype=dtype),
+                np.array([distance for _, distance, _ in state], dtype=np.int64),
+                np.array([present for _, _, present in state], dtype=bool))
+
+    def _carry(self, cols, missing, ready, value_at):
+        """Advance the carried state of a block of columns past its first `ready` rows"""
+        if ready == 0:
+            return
+        present = ~missing[:, :ready]
+        seen = present.any(axis=1)
+        last = ready - 1 - present[:, ::-1].argmax(axis=1)
+        for i, col in enumerate(cols):
+            if seen[i]:
+                self.carried[col] = [value_at(i, last[i]), int(ready - last[i]), True]
+            else:
+                self.carried.setdefault(col, [None, self.rows + 1, False])[1] += ready
+
+    def _impute(self, frame, plan, final, following=None):
+        """Fill the streamed columns of frame and return the rows that are ready"""
+        n = len(frame)
+        if n == 0:
+            return frame
+        blocks = []
+        seconds = dict.fromkeys(STREAMED_STRATEGIES, 0.0)
+        ready = n
+
+        # Fill the streamed columns over the whole frame, finding how many rows can be released
+        width = max(1, BLOCK_CELLS // n)
+        for strategy, groups in (('linear', plan.linear_blocks), ('pad', plan.pad_blocks)):
+            for cols in groups.values():
+                for first in range(0, len(cols), width):
+                    start = time.perf_counter()
+                    block = cols[first:first + width]
+                    flat = frame[block].to_numpy().T.flatten()
+                    missing = np.isnan(flat)
+                    hold = fill_columns(flat, missing, n, strategy == 'linear', self._carried(block, np.float64),
+                                        final, self.max_pending,
+                                        self._carried(block, np.float64, following) if following else None)
+                    ready = min(ready, int(hold.min()))
+                    blocks.append((strategy, block, flat.reshape(len(block), n), missing.reshape(len(block), n)))
+                    seconds[strategy] += time.perf_counter() - start
+
+        for col in plan.columns.get('forward', []):
+            start = time.perf_counter()
+            values = frame[col].array
+            categories = values.categories
+            value, distance, present = self.carried.get(col, [None, self.rows + 1, False])
+            next_value, next_distance, next_present = (following or {}).get(col, [None, 1, False])
+            # Categories differ between chunks, so the carried category is kept as a value
+            for known, category in ((present, value), (next_present, next_value)):
+                if known and category not in categories:
+                    categories = categories.append(pd.Index([category]))
+            codes = values.codes.astype(np.int64)
+            missing = codes < 0
+            carried = (np.array([categories.get_loc(value) if present else -1]), np.array([distance]),
+                       np.array([present]))
+            closing = (np.array([categories.get_loc(next_value) if next_present else -1]),
+                       np.array([next_distance]), np.array([next_present])) if following else None
+            hold = fill_columns(codes, missing, n, False, carried, final, self.max_pending, closing)
+            ready = min(ready, int(hold.min()))
+            blocks.append(('forward', [col], (codes, categories, values.ordered), missing[None, :]))
+            seconds['forward'] += time.perf_counter() - start
+
+        # Rows from `ready` on wait, unfilled, for the next chunk
+        self.pending = frame.iloc[ready:] if ready < n else None
+        if ready < n:
+            frame = frame.iloc[:ready].copy()
+        cells = dict.fromkeys(STREAMED_STRATEGIES, 0)
+        for strategy, cols, values, missing in blocks:
+            start = time.perf_counter()
+            gaps = missing[:, :ready].any(axis=1)
+            cells[strategy] += int(missing[:, :ready].sum())
+            if strategy == 'forward':
+                codes, categories, ordered = values
+                if gaps.any():
+                    frame[cols[0]] = pd.Categorical.from_codes(codes[:ready], categories=categories, ordered=ordered)
+                self._carry(cols, missing, ready, lambda i, row: _python_value(categories[codes[row]]))
+            else:
+                if gaps.any():
+                    frame[[col for col, gap in zip(cols, gaps) if gap]] = values[gaps, :ready].T
+                self._carry(cols, missing, ready, lambda i, row: float(values[i, row]))
+            seconds[strategy] += time.perf_counter() - start
+        for strategy in STREAMED_STRATEGIES:
+            if plan.columns.get(strategy):
+                self.imputer._record(strategy, seconds[strategy], cells[strategy])
+
+        self.rows += ready
+        return frame
+
+
+def _python_value(value):
+    """Plain Python value of a numpy scalar, so carried state can be saved as JSON"""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def concat_chunks(first, second):
+    """Concatenate two chunks, keeping categorical columns categorical when their categories differ"""
+    first, second = first.copy(deep=False), second.copy(deep=False)
+    for col in first.columns:
+        a, b = first[col].dtype, second[col].dtype
+        if isinstance(a, pd.CategoricalDtype) and isinstance(b, pd.CategoricalDtype) and a != b:
+            categories = a.categories.union(b.categories)
+            first[col] = first[col].cat.set_categories(categories)
+            second[col] = second[col].cat.set_categories(categories)
+    return pd.concat([first, second])
@@ -1,3 +1,5 @@
+import argparse
+import io
 import pandas as pd
 import csv
 from tempfile import NamedTemporaryFile
@@ -6,6 +8,12 @@ import os
 from tqdm import tqdm
 import time
 
+from hcup_spec import file_columns
+from output_formats import sidecar_header_path
+from row_counts import count_lines
+
+HEADER_MODES = ['stream', 'sidecar', 'rows']
+
 def get_existing_columns(filename):
     """Get list of existing column names from CSV file"""
     with open(filename, 'r', newline='') as csvfile:
@@ -39,7 +47,7 @@ def add_columns_to_csv(input_file, new_column_names, chunk_size=1000):
                 
                 # Process all rows
                 rows_processed = 0
-                total_rows = sum(1 for _ in open(input_file))
+                total_rows = count_lines(input_file)
                
                 with tqdm(total=total_rows, desc="Processing rows") as pbar:
                     for row in reader:
@@ -73,8 +81,78 @@ def add_columns_to_csv(input_file, new_column_names, chunk_size=1000):
         print("No changes were made to the original file.")
         raise
 
+def format_header_line(column_names, newline='\n'):
+    """Render column names as a single CSV header line"""
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator=newline).writerow(column_names)
+    return buffer.getvalue()
+
+def detect_newline(filename, sample_size=1024 * 1024):
+    """Return the line terminator used by the first line of a file"""
+    with open(filename, 'rb') as f:
+        sample = f.read(sample_size)
+    end = sample.find(b'\n')
+    return '\r\n' if end > 0 and sample[end - 1:end] == b'\r' else '\n'
+
+def attach_header(input_file, column_names, buffer_size=16 * 1024 * 1024):
+    """
+    Prepend a header line using a streamed block copy.
+    Rows are never parsed or counted, and the original file is only replaced once the copy is complete.
+    """
+    header_line = format_header_line(column_names, detect_newline(input_file))
+    file_size = os.path.getsize(input_file)
+
+    # Write next to the original so the final rename never crosses drives
+    directory = os.path.dirname(os.path.abspath(input_file))
+    temp_file = NamedTemporaryFile(mode='wb', delete=False, dir=directory, suffix='.tmp')
+
+    try:
+        with open(input_file, 'rb') as source, temp_file:
+            temp_file.write(header_line.encode())
+            with tqdm(total=file_size, unit='B', unit_scale=True, desc="Copying") as pbar:
+                while True:
+                    block = source.read(buffer_size)
+                    if not block:
+                        break
+                    temp_file.write(block)
+                    pbar.update(len(block))
+
+        os.replace(temp_file.name, input_file)
+        print("\nFile updated successfully with new column headers")
+
+    finally:
+        if os.path.exists(temp_file.name):
+            os.unlink(temp_file.name)
+
+def write_sidecar_header(input_file, column_names):
+    """Record column names in a sidecar header file so the data file is never rewritten"""
+    sidecar = sidecar_header_path(input_file)
+    with open(sidecar, 'w', newline='') as f:
+        f.write(format_header_line(column_names))
+    print(f"\nHeader written to sidecar file: {sidecar}")
+    return sidecar
+
+def add_header(input_file, column_names, mode='stream'):
+    """Attach column names to a headerless CSV using the chosen mode"""
+    if mode == 'stream':
+        return attach_header(input_file, column_names)
+    if mode == 'sidecar':
+        return write_sidecar_header(input_file, column_names)
+    if mode == 'rows':
+        return add_columns_to_csv(input_file, column_names)
+    raise ValueError(f"Unknown header mode '{mode}'; expected one of {HEADER_MODES}")
+
 # Example usage
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Attach column headers to a headerless HCUP CSV")
+    parser.add_argument('--mode', choices=HEADER_MODES, default='stream',
+                        help="stream: block-copy with header prepended; sidecar: write a .header file; "
+                             "rows: legacy per-row rewrite")
+    # Column names come from the FileSpecifications registry, or the <FAMILY>_Columns list for spec-less
+    # files; --from-spec is still accepted so older commands keep working
+    parser.add_argument('--from-spec', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
     # Option 1: Use forward slashes
     
     input_file = "data/NRD_2019/NRD_2019_Severity.CSV"
@@ -95,45 +173,10 @@ if __name__ == "__main__":
     # OR Option 3: Use raw string with 'r' prefix
     # input_file = r"data\NRD_2019\NRD_2019_CORE\NRD_2019_Core.CSV"
 
-    column_names = [
-        'KEY_NRD',           # HCUP record identifier
-        'HOSP_NRD',          # NRD hospital identifier
-        'APRDRG',            # All Patient Refined DRG
-        'APRDRG_Risk_Mortality',  # All Patient Refined DRG: Risk of Mortality Subclass
-        'APRDRG_Severity',   # All Patient Refined DRG: Severity of Illness Subclass
-        'CM_AIDS',           # AHRQ comorbidity measure: Acquired immune deficiency syndrome
-        'CM_ALCOHOL',        # AHRQ comorbidity measure: Alcohol abuse
-        'CM_ANEMDEF',        # AHRQ comorbidity measure: Deficiency anemias
-        'CM_ARTH',           # AHRQ comorbidity measure: Rheumatoid arthritis/collagen vascular diseases
-        'CM_BLDLOSS',        # AHRQ comorbidity measure: Chronic blood loss anemia
-        'CM_CHF',            # AHRQ comorbidity measure: Congestive heart failure
-        'CM_CHRNLUNG',       # AHRQ comorbidity measure: Chronic pulmonary disease
-        'CM_COAG',           # AHRQ comorbidity measure: Coagulopathy
-        'CM_DEPRESS',        # AHRQ comorbidity measure: Depression
-        'CM_DM',             # AHRQ comorbidity measure: Diabetes, uncomplicated
-        'CM_DMCX',           # AHRQ comorbidity measure: Diabetes with chronic complications
-        'CM_DRUG',           # AHRQ comorbidity measure: Drug abuse
-        'CM_HTN_C',          # AHRQ comorbidity measure: Hypertension
-        'CM_HYPOTHY',        # AHRQ comorbidity measure: Hypothyroidism
-        'CM_LIVER',          # AHRQ comorbidity measure: Liver disease
-        'CM_LYMPH',          # AHRQ comorbidity measure: Lymphoma
-        'CM_LYTES',          # AHRQ comorbidity measure: Fluid and electrolyte disorders
-        'CM_METS',           # AHRQ comorbidity measure: Metastatic cancer
-        'CM_NEURO',          # AHRQ comorbidity measure: Other neurological disorders
-        'CM_OBESE',          # AHRQ comorbidity measure: Obesity
-        'CM_PARA',           # AHRQ comorbidity measure: Paralysis
-        'CM_PERIVASC',       # AHRQ comorbidity measure: Peripheral vascular disorders
-        'CM_PSYCH',          # AHRQ comorbidity measure: Psychoses
-        'CM_PULMCIRC',       # AHRQ comorbidity measure: Pulmonary circulation disorders
-        'CM_RENLFAIL',       # AHRQ comorbidity measure: Renal failure
-        'CM_TUMOR',          # AHRQ comorbidity measure: Solid tumor without metastasis
-        'CM_ULCER',          # AHRQ comorbidity measure: Peptic ulcer disease excluding bleeding
-        'CM_VALVE',          # AHRQ comorbidity measure: Valvular disease
-        'CM_WGHTLOSS',       # AHRQ comorbidity measure: Weight loss
-        'HOSP_DIVISION',     # Census Division of hospital
-]
-   
     try:
-        add_columns_to_csv(input_file, column_names)
+        column_names = file_columns(input_file)
+        if column_names is None:
+            raise KeyError(f"No spec file or column list for {input_file}")
+        add_header(input_file, column_names, args.mode)
     except Exception as e:
         print(f"Program terminated with error: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,126 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_MEMORY_BUDGET = '2GB'
+MIN_CHUNK_ROWS = 1000
+MAX_CHUNK_ROWS = 1000000
+# Rows buffered before a write even when the budget allows more, so checkpoints stay frequent
+MAX_BUFFER_ROWS = 1000000
+# Estimated in-memory bytes for a string value until a real chunk has been measured
+OBJECT_BYTES = 64
+
+_UNITS = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2,
+          'G': 1024 ** 3, 'GB': 1024 ** 3, 'T': 1024 ** 4, 'TB': 1024 ** 4}
+
+
+def parse_memory_budget(budget):
+    """Bytes in a budget such as 4GB, 512MB or a plain byte count"""
+    if isinstance(budget, (int, float)):
+        return int(budget)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?B?)\s*', str(budget).upper())
+    if not match:
+        raise ValueError(f"Can't parse memory budget '{budget}'; use e.g. 512MB or 4GB")
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def frame_bytes(df):
+    """Memory held by a DataFrame, counting the strings behind object columns"""
+    return int(df.memory_usage(deep=True, index=False).sum())
+
+
+def estimate_row_bytes(columns, dtypes=None):
+    """Bytes per row implied by column dtypes, used until the first chunk has been measured"""
+    dtypes = dtypes or {}
+    total = 0
+    for col in columns:
+        dtype = dtypes.get(col)
+        if dtype == 'category':
+            total += 2  # int8/int16 codes; categories are shared across rows
+        elif dtype is None or dtype in ('str', 'object', object, str):
+            total += OBJECT_BYTES
+        else:
+            dtype = pd.api.types.pandas_dtype(dtype)
+            # Nullable integers carry a mask byte per value
+            total += dtype.itemsize + (0 if isinstance(dtype, np.dtype) else 1)
+    return max(total, 1)
+
+
+def chunk_rows(chunk_size):
+    """Rows for the next chunk from a fixed size or a ChunkSizer"""
+    return int(chunk_size()) if callable(chunk_size) else int(chunk_size)
+
+
+class ChunkSizer:
+    """
+    Rows per chunk that keep a run inside a memory budget.
+
+    Half the budget goes to the chunks in flight at once (being parsed,
+    queued, imputed and written), the other half to the batch buffered
+    before a write. Rows per chunk start from a dtype estimate and are
+    re-derived from the measured bytes per row after every chunk, so a
+    935-column file gets short chunks and a 14-column file long ones.
+    Call the sizer for the next chunk's row count.
+    """
+
+    def __init__(self, budget=DEFAULT_MEMORY_BUDGET, row_bytes=OBJECT_BYTES, in_flight=1,
+                 min_rows=MIN_CHUNK_ROWS, max_rows=MAX_CHUNK_ROWS):
+        self.budget = parse_memory_budget(budget)
+        self.row_bytes = max(row_bytes, 1)
+        self.chunk_bytes = self.budget / 2 / max(in_flight, 1)
+        # pd.concat briefly holds both the buffered chunks and their concatenation
+        self.buffer_bytes = self.budget / 4
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+
+    def __call__(self):
+        return int(np.clip(self.chunk_bytes / self.row_bytes, self.min_rows, self.max_rows))
+
+    def observe_bytes(self, rows, nbytes):
+        """Update bytes per row from a chunk that has been read"""
+        if not rows:
+            return
+        measured = nbytes / rows
+        # Grow straight away so wide stretches can't overshoot; shrink gradually
+        self.row_bytes = measured if measured > self.row_bytes else (self.row_bytes + measured) / 2
+
+    def observe(self, df):
+        self.observe_bytes(len(df), frame_bytes(df))
+
+    def track(self, frames):
+        """Pass chunks through, measuring each one"""
+        for df in frames:
+            self.observe(df)
+            yield df
+
+    def buffer(self):
+        """Write buffer bounded by this sizer's share of the budget"""
+        return ChunkBuffer(self.buffer_bytes)
+
+
+class ChunkBuffer:
+    """Chunks waiting to be written together, flushed once they reach a byte limit"""
+
+    def __init__(self, max_bytes, max_rows=MAX_BUFFER_ROWS):
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.chunks = []
+        self.nbytes = 0
+        self.rows = 0
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add(self, df):
+        """Buffer a chunk; True once the buffer should be flushed"""
+        self.chunks.append(df)
+        self.nbytes += frame_bytes(df)
+        self.rows += len(df)
+        return self.nbytes >= self.max_bytes or self.rows >= self.max_rows
+
+    def drain(self):
+        """Concatenate and clear the buffered chunks"""
+        df = pd.concat(self.chunks, ignore_index=True)
+        self.chunks, self.nbytes, self.rows = [], 0, 0
+        return df
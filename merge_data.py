@@ -1,3 +1,4 @@
+import argparse
 import pandas as pd
 import os
 from tqdm import tqdm
@@ -6,6 +7,15 @@ import logging
 from datetime import datetime
 import gc  # For garbage collection
 
+from compression import COMPRESSION_CHOICES, strip_compression
+from hcup_spec import lookup_dtypes
+from row_counts import count_rows
+from stage_cache import run_cached, stage_code_files
+from memory_budget import DEFAULT_MEMORY_BUDGET, MAX_BUFFER_ROWS, ChunkSizer, estimate_row_bytes, frame_bytes
+from staged_executor import chunks_in_flight, run_staged
+from output_formats import (ChunkWriter, OUTPUT_FORMATS, output_path_for, read_csv_chunks, read_frames, frame_columns,
+                            path_size)
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO,
@@ -17,32 +27,31 @@ logging.basicConfig(
 )
 
 def get_file_size(file_path):
-    """Get file size in GB"""
-    return os.path.getsize(file_path) / (1024 * 1024 * 1024)
+    """Get file (or Parquet dataset) size in GB"""
+    return path_size(file_path) / (1024 * 1024 * 1024)
 
 def add_prefix_to_columns(df, prefix):
     """Add prefix to column names"""
     return df.add_prefix(f"{prefix}_")
 
-def read_csv_with_prefix(file_path, prefix):
+def read_csv_with_prefix(file_path, prefix, memory_budget=DEFAULT_MEMORY_BUDGET):
     """Read CSV file and add prefix to columns"""
     try:
         # Get file size
         file_size = get_file_size(file_path)
         logging.info(f"\nReading {file_path} (Size: {file_size:.2f} GB)")
         
-        # Determine optimal chunk size based on file size
-        chunk_size = min(100000, max(10000, int(100000 * (2 / file_size))))
+        # Size chunks from the measured width of the rows
+        sizer = ChunkSizer(memory_budget, estimate_row_bytes(frame_columns(file_path)))
         
         # Count total rows for progress bar
-        total_rows = sum(1 for _ in pd.read_csv(file_path, chunksize=chunk_size))
-        total_rows *= chunk_size
+        total_rows = count_rows(file_path)
         
         chunks = []
         processed_rows = 0
         
         with tqdm(total=total_rows, desc="Reading", unit="rows") as pbar:
-            for chunk in pd.read_csv(file_path, chunksize=chunk_size):
+            for chunk in sizer.track(read_csv_chunks(file_path, sizer)):
                 # Add prefix to columns
                 chunk = add_prefix_to_columns(chunk, prefix)
                 chunks.append(chunk)
@@ -51,7 +60,7 @@ def read_csv_with_prefix(file_path, prefix):
                 pbar.update(len(chunk))
                 
                 # Periodically concat and clear chunks to manage memory
-                if len(chunks) * chunk_size > 1000000:  # Combine every million rows
+                if sum(len(c) for c in chunks) > MAX_BUFFER_ROWS:  # Combine every million rows
                     chunks = [pd.concat(chunks, ignore_index=True)]
         
         final_df = pd.concat(chunks, ignore_index=True)
@@ -75,35 +84,38 @@ def get_processed_files(base_dir):
         dataset_dir = os.path.join(base_dir, f'{dataset}_2019')
         if os.path.exists(dataset_dir):
             for file in os.listdir(dataset_dir):
-                if file.startswith('processed_') and file.endswith('.CSV'):
+                if file.startswith('processed_') and strip_compression(os.path.join(dataset_dir, file)).endswith('.CSV'):
                     full_path = os.path.join(dataset_dir, file)
                     csv_files[full_path] = dataset
     
     return csv_files
 
-def get_row_count(file_path, chunk_size=10000):
-    """Get total number of rows in a CSV file"""
-    total_rows = 0
-    for chunk in pd.read_csv(file_path, chunksize=chunk_size, usecols=[0]):
-        total_rows += len(chunk)
-    return total_rows
-
-def merge_and_save_chunks(file_paths, output_file, chunk_size=10000):
-    """Merge files chunk by chunk and save directly to output"""
+def merge_and_save_chunks(file_paths, output_file, memory_budget=DEFAULT_MEMORY_BUDGET, output_format='csv',
+                          partition_cols=None, compression=None, compression_level=None, queue_depth=4):
+    """Merge files chunk by chunk and save directly to output (CSV, compressed CSV or partitioned Parquet)"""
     try:
         # Get total rows from first file (assuming it's one of the main files)
         logging.info("Counting total rows...")
-        total_rows = get_row_count(file_paths[0])
+        total_rows = count_rows(file_paths[0])
         logging.info(f"Total rows to process: {total_rows:,}")
 
         # Initialize progress bar
         with tqdm(total=total_rows, desc="Merging", unit="rows") as pbar:
             # Initialize file readers
-            readers = [pd.read_csv(f, chunksize=chunk_size, low_memory=False) for f in file_paths]
-            first_chunk = True
-
-            while True:
-                try:
+            # Spec dtypes keep each file's chunks compact; imputed integer columns may hold fractions
+            columns = [frame_columns(f) for f in file_paths]
+            dtypes = [lookup_dtypes(c, float_numeric=True) for c in columns]
+            # Files are read in step, so one sizer covers the combined width of a merged row. It only
+            # changes between steps, which keeps every file's chunk the same length
+            sizer = ChunkSizer(memory_budget, sum(estimate_row_bytes(c, d) for c, d in zip(columns, dtypes)),
+                               chunks_in_flight(queue_depth))
+            readers = [read_frames(f, chunk_size=sizer, dtype=dtypes[i], low_memory=False)
+                       for i, f in enumerate(file_paths)]
+            writer = ChunkWriter(output_file, output_format, partition_cols, compression, compression_level)
+
+            def aligned_chunks():
+                """Read one chunk from every file (runs on the prefetch thread)"""
+                while True:
                     # Read chunks from all files
                     chunks = []
                     for i, reader in enumerate(readers):
@@ -111,31 +123,41 @@ def merge_and_save_chunks(file_paths, output_file, chunk_size=10000):
                             chunk = next(reader)
                             chunks.append(chunk)
                         except StopIteration:
+                            # The first (largest) file drives the merge; stop once it is exhausted
+                            if i == 0:
+                                return
                             # If a file is shorter, reset its reader
-                            readers[i] = pd.read_csv(file_paths[i], chunksize=chunk_size, low_memory=False)
+                            readers[i] = read_frames(file_paths[i], chunk_size=sizer, dtype=dtypes[i],
+                                                     low_memory=False)
                             chunk = next(readers[i])
                             chunks.append(chunk)
+                    sizer.observe_bytes(len(chunks[0]), sum(frame_bytes(chunk) for chunk in chunks))
+                    yield chunks
 
-                    # Merge chunks
-                    merged_chunk = pd.concat(chunks, axis=1)
+            def merge_chunks(chunks):
+                """Merge chunks"""
+                merged_chunk = pd.concat(chunks, axis=1)
+                if output_format == 'parquet':
+                    # Parquet needs unique names; shared keys such as HOSP_NIS keep their first copy
+                    merged_chunk = merged_chunk.loc[:, ~merged_chunk.columns.duplicated()]
+                return merged_chunk
 
-                    # Save merged chunk
-                    if first_chunk:
-                        merged_chunk.to_csv(output_file, index=False, mode='w')
-                        first_chunk = False
-                    else:
-                        merged_chunk.to_csv(output_file, index=False, mode='a', header=False)
+            def save_chunk(merged_chunk):
+                """Save merged chunk (runs on the writer thread, in order)"""
+                writer.write(merged_chunk)
 
-                    # Update progress
-                    pbar.update(len(merged_chunk))
+                # Update progress
+                pbar.update(len(merged_chunk))
 
-                    # Clear memory
-                    del chunks
-                    del merged_chunk
-                    gc.collect()
+                # Clear memory
+                del merged_chunk
+                gc.collect()
 
-                except StopIteration:
-                    break
+            # Reading the next chunks, merging and writing the previous merge overlap
+            run_staged(aligned_chunks(), merge_chunks, save_chunk, queue_depth=queue_depth,
+                       label=os.path.basename(output_file))
+
+            writer.close()
 
         return True
 
@@ -143,17 +165,22 @@ def merge_and_save_chunks(file_paths, output_file, chunk_size=10000):
         logging.error(f"Error during merge: {str(e)}", exc_info=True)
         return False
 
-def main():
+def main(output_format='csv', partition_cols=None, use_cache=True, compression=None, compression_level=None,
+         memory_budget=DEFAULT_MEMORY_BUDGET):
     processed_dir = 'processed_data'
-    output_file = 'combined_data.csv'
-    chunk_size = 10000  # Smaller chunk size for better memory management
+    output_file = output_path_for('combined_data.csv', output_format, compression)
 
-    # Get all processed CSV files
+    # Get all processed CSV files and Parquet datasets
     all_files = []
     for root, dirs, files in os.walk(processed_dir):
         for file in files:
-            if file.startswith('processed_') and file.endswith('.CSV'):
+            # Compressed parts (processed_*.CSV.gz / .zst) are read through their codec
+            if file.startswith('processed_') and strip_compression(os.path.join(root, file)).endswith('.CSV'):
                 all_files.append(os.path.join(root, file))
+        for directory in list(dirs):
+            if directory.startswith('processed_') and directory.endswith('.parquet'):
+                all_files.append(os.path.join(root, directory))
+                dirs.remove(directory)
 
     if not all_files:
         logging.error("No processed CSV files found!")
@@ -164,13 +191,22 @@ def main():
         logging.info(f"- {file}")
 
     # Sort files so larger files come first
-    all_files.sort(key=lambda x: os.path.getsize(x), reverse=True)
+    all_files.sort(key=lambda x: path_size(x), reverse=True)
 
     logging.info("\nStarting merge operation...")
-    success = merge_and_save_chunks(all_files, output_file, chunk_size)
+    run = lambda: merge_and_save_chunks(all_files, output_file, memory_budget, output_format, partition_cols,
+                                        compression, compression_level)
+    if use_cache:
+        success = run_cached('merge', all_files, [output_file], run,
+                             params={'memory_budget': memory_budget, 'format': output_format,
+                                     'partition_cols': partition_cols, 'compression': compression,
+                                     'compression_level': compression_level},
+                             code_files=stage_code_files('merge'))
+    else:
+        success = run()
 
     if success:
-        final_size = os.path.getsize(output_file) / (1024 * 1024 * 1024)  # Size in GB
+        final_size = path_size(output_file) / (1024 * 1024 * 1024)  # Size in GB
         logging.info(f"\nMerge completed successfully!")
         logging.info(f"Combined data saved to: {output_file}")
         logging.info(f"Final file size: {final_size:.2f} GB")
@@ -178,4 +214,16 @@ def main():
         logging.error("Merge operation failed!")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Merge processed HCUP files")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help="Output format")
+    parser.add_argument('--partition-by', nargs='*', default=None, help="Columns to partition Parquet output by")
+    parser.add_argument('--no-cache', action='store_true', help="Re-run even if inputs and parameters are unchanged")
+    parser.add_argument('--compression', choices=COMPRESSION_CHOICES, default=None,
+                        help="Output codec (CSV gets a .gz/.zst extension; Parquet defaults to zstd)")
+    parser.add_argument('--compression-level', type=int, default=None, help="Codec compression level")
+    parser.add_argument('--memory-budget', default=DEFAULT_MEMORY_BUDGET,
+                        help="Memory to size chunks against, e.g. 512MB or 8GB")
+    args = parser.parse_args()
+
+    main(args.format, args.partition_by, use_cache=not args.no_cache, compression=args.compression,
+         compression_level=args.compression_level, memory_budget=args.memory_budget) 
\ No newline at end of file
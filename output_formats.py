@@ -0,0 +1,435 @@
+import csv
+import json
+import os
+import shutil
+import pandas as pd
+
+from compression import (compress_bytes, compression_of, csv_compression_options, open_input, open_text,
+                         strip_compression, with_codec_extension)
+from filters import FILTER_COMPARE, filter_columns, filter_mask, filter_value, normalize_filters
+from hcup_spec import restore_integers
+from memory_budget import chunk_rows
+
+# pyarrow is only needed for Parquet output
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+
+def require_pyarrow():
+    """Fail with an install hint when Parquet support is requested without pyarrow"""
+    if pa is None:
+        raise ImportError("Parquet output requires pyarrow. Please run: pip install pyarrow")
+
+
+def is_parquet(path):
+    """True for a Parquet file or a directory holding a Parquet dataset"""
+    return os.path.isdir(path) or path.lower().endswith('.parquet')
+
+
+def path_size(path):
+    """Size in bytes of a file, or of every file under a dataset directory"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, file))
+               for root, _, files in os.walk(path) for file in files)
+
+
+def parquet_row_count(path):
+    """Row count of a Parquet dataset from its footers, without reading any data"""
+    require_pyarrow()
+    return ds.dataset(path, format='parquet', partitioning='hive').count_rows()
+
+
+def output_path_for(path, output_format, compression=None):
+    """Swap a file's extension for the one matching output_format (plus .gz/.zst for compressed CSV)"""
+    base = os.path.splitext(strip_compression(path))[0]
+    if output_format == 'parquet':
+        return f"{base}.parquet"
+    return with_codec_extension(f"{base}.csv", compression)
+
+
+class ChunkWriter:
+    """Append DataFrame chunks to a CSV file or a partitioned Parquet dataset"""
+
+    def __init__(self, output_path, output_format='csv', partition_cols=None,
+                 compression=None, compression_level=None, part_prefix='', overwrite=True):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format '{output_format}'; expected one of {OUTPUT_FORMATS}")
+        if output_format == 'parquet':
+            require_pyarrow()
+
+        self.output_path = output_path
+        self.output_format = output_format
+        self.partition_cols = partition_cols or []
+        # Parquet codec; 'none' writes uncompressed files
+        self.compression = compression or 'zstd'
+        self.compression_level = compression_level
+        # Parallel writers sharing one dataset use distinct prefixes and leave existing parts alone
+        self.part_prefix = part_prefix
+        self.overwrite = overwrite
+        self.schema = None
+        # Set once an integer column pinned by an earlier chunk had to be stored as float
+        self.widened = False
+        self.n_chunks = 0
+        self.rows_written = 0
+        # CSV codec comes from the extension (.csv.gz, .csv.zst); compression_level applies to either format
+        self.csv_compression = csv_compression_options(output_path, compression_level) if output_format == 'csv' else None
+        # (data row, byte offset) at each CSV chunk start, saved as a row index sidecar on close;
+        # compressed files can't be seeked into, so they get none
+        self.row_offsets = [] if output_format == 'csv' and self.csv_compression is None else None
+
+    def write(self, df):
+        """Write one chunk; the first CSV chunk carries the header"""
+        # Whole-valued integer spec fields are written as ints in either format
+        df = restore_integers(df)
+        if self.output_format == 'csv':
+            if self.row_offsets is not None and len(df):
+                offset = (len(df.head(0).to_csv(index=False).encode()) if self.n_chunks == 0
+                          else os.path.getsize(self.output_path))
+                self.row_offsets.append((self.rows_written, offset))
+            # Each compressed chunk is a complete gzip member / zstd frame, so appends stay readable
+            df.to_csv(self.output_path, index=False, mode='w' if self.n_chunks == 0 else 'a',
+                      header=self.n_chunks == 0, compression=self.csv_compression)
+        else:
+            self._write_parquet(df)
+
+        self.n_chunks += 1
+        self.rows_written += len(df)
+
+    def write_lines(self, data, n_rows, header=b''):
+        """Append already formatted CSV lines (bytes); header is the column line written before the first block"""
+        if self.output_format != 'csv':
+            raise ValueError("Pre-formatted lines can only be written to CSV output")
+        if self.n_chunks == 0:
+            data = header + data
+        if self.row_offsets is not None and n_rows:
+            offset = len(header) if self.n_chunks == 0 else os.path.getsize(self.output_path)
+            self.row_offsets.append((self.rows_written, offset))
+        with open(self.output_path, 'wb' if self.n_chunks == 0 else 'ab') as f:
+            f.write(compress_bytes(data, self.output_path, self.compression_level))
+
+        self.n_chunks += 1
+        self.rows_written += n_rows
+
+    def _write_parquet(self, df):
+        """Write a chunk as its own row group files, one per partition"""
+        # Partition keys come back from directory names, which pandas can read as plain ints but not nullable ones
+        keys = {col: df[col].astype(df[col].dtype.numpy_dtype) for col in self.partition_cols
+                if col in df.columns and isinstance(df[col].dtype, pd.api.extensions.ExtensionDtype)
+                and df[col].dtype.kind in 'iu' and not df[col].hasnans}
+        if keys:
+            df = df.assign(**keys)
+        if self.schema is not None:
+            # A column pinned as int that holds imputed fractions now is stored as float from here on
+            fractional = {col for col in df.columns if df[col].ndim == 1 and df[col].dtype.kind == 'f'
+                          and self.schema.get_field_index(col) >= 0
+                          and pa.types.is_integer(self.schema.field(col).type)}
+            if fractional:
+                self.schema = _as_float(self.schema, fractional)
+                self.widened = True
+        # Pin the schema from the first chunk so all-null chunks keep their column types
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        if self.schema is None:
+            # Categories are sized to the first chunk; int32 indices leave room for the codes later chunks add
+            self.schema = pa.schema([field.with_type(pa.dictionary(pa.int32(), field.type.value_type))
+                                     if pa.types.is_dictionary(field.type) else field for field in table.schema],
+                                    metadata=table.schema.metadata)
+            table = table.cast(self.schema)
+
+        if self.n_chunks == 0 and self.overwrite:
+            # Start fresh like CSV mode='w' does
+            clear_output(self.output_path)
+
+        pq.write_to_dataset(
+            table,
+            root_path=self.output_path,
+            # Files without a partition column (e.g. NRD has no DQTR) are written unpartitioned
+            partition_cols=[col for col in self.partition_cols if col in table.column_names] or None,
+            basename_template=f'{self.part_prefix}part-{self.n_chunks:05d}-{{i}}.parquet',
+            compression=self.compression,
+            compression_level=self.compression_level,
+            write_statistics=True,
+            existing_data_behavior='overwrite_or_ignore',
+        )
+
+    def close(self):
+        """Save the CSV row index gathered while writing; nothing else is held open between chunks
+
+        A Parquet column widened to float part way through is rewritten as float in the earlier files too.
+        Parallel writers sharing a dataset leave that to whoever joins them (see unify_parquet_schema).
+        """
+        if self.widened and self.overwrite:
+            unify_parquet_schema(self.output_path, self.compression, self.compression_level)
+            self.widened = False
+        if self.row_offsets and os.path.exists(self.output_path):
+            from row_index import save_row_index
+            save_row_index(self.output_path, {
+                'stride': None,
+                'rows': [row for row, _ in self.row_offsets],
+                'offsets': [offset for _, offset in self.row_offsets],
+                'n_rows': self.rows_written,
+                'size': os.path.getsize(self.output_path),
+            })
+            self.row_offsets = None
+        return self.rows_written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _as_float(schema, names):
+    """A Parquet schema with the named columns stored as float64, pandas metadata included"""
+    for name in names:
+        i = schema.get_field_index(name)
+        if i >= 0:
+            schema = schema.set(i, schema.field(i).with_type(pa.float64()))
+    metadata = schema.metadata or {}
+    if b'pandas' in metadata:
+        # Otherwise to_pandas would restore the columns as nullable ints and fail on their fractions
+        pandas_metadata = json.loads(metadata[b'pandas'])
+        for column in pandas_metadata['columns']:
+            if column['name'] in names:
+                column.update(pandas_type='float64', numpy_type='float64', metadata=None)
+        schema = schema.with_metadata({**metadata, b'pandas': json.dumps(pandas_metadata).encode()})
+    return schema
+
+
+def unify_parquet_schema(path, compression='zstd', compression_level=None):
+    """
+    Give every file of a Parquet dataset the same column types.
+
+    Integer spec fields are written as ints while their values are whole,
+    so a column with imputed fractions in only some chunks, or in only some
+    parallel ranges, is float in some files and int in the others. The int
+    files are rewritten as float; only their footers are read otherwise.
+    """
+    require_pyarrow()
+    files = [os.path.join(root, file) for root, _, names in os.walk(path) for file in names
+             if file.endswith('.parquet')]
+    schemas = {file: pq.read_schema(file) for file in files}
+    floats = {field.name for schema in schemas.values() for field in schema if pa.types.is_floating(field.type)}
+    for file, schema in schemas.items():
+        widen = {field.name for field in schema if field.name in floats and pa.types.is_integer(field.type)}
+        if widen:
+            table = pq.ParquetFile(file).read().cast(_as_float(schema, widen))
+            pq.write_table(table, file, compression=compression, compression_level=compression_level)
+
+
+def clear_output(path):
+    """Remove an existing CSV file or Parquet dataset directory"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def sidecar_header_path(path):
+    """Path of the optional header file that names the columns of a headerless CSV"""
+    return path + '.header'
+
+
+def read_sidecar_header(path):
+    """Column names from a CSV's sidecar header file, or None if it has none"""
+    sidecar = sidecar_header_path(path)
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar, 'r', newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def frame_columns(path):
+    """Column names of a CSV file (from its header) or a Parquet dataset (from its schema)"""
+    if is_parquet(path):
+        require_pyarrow()
+        return ds.dataset(path, format='parquet', partitioning='hive').schema.names
+    sidecar_columns = read_sidecar_header(path)
+    if sidecar_columns is not None:
+        return sidecar_columns
+    with open_text(path) as f:
+        return next(csv.reader(f), [])
+
+
+def dedupe_columns(columns):
+    """Column names as read_csv labels a header, with repeats renamed NAME.1, NAME.2, ..."""
+    seen = {}
+    names = []
+    for col in columns:
+        count = seen.get(col, 0)
+        seen[col] = count + 1
+        names.append(f'{col}.{count}' if count else col)
+    return names
+
+
+def _arrow_filter(filters, schema):
+    """pyarrow dataset expression for the filters, with values cast to each column's type"""
+    expression = None
+    for conjunction in normalize_filters(filters) or []:
+        conjunction_expression = None
+        for col, op, value in conjunction:
+            if schema.get_field_index(col) < 0:
+                raise KeyError(f"Filter column {col} not in the data")
+            field_type = schema.field(col).type
+            text = pa.types.is_string(field_type) or pa.types.is_large_string(field_type) or \
+                pa.types.is_dictionary(field_type)
+            value = filter_value(value, text)
+
+            field = ds.field(col)
+            if op == 'in':
+                term = field.isin(value)
+            elif op == 'not in':
+                term = ~field.isin(value)
+            else:
+                term = FILTER_COMPARE[op](field, value)
+            # Nulls never match, as in filter_mask
+            term = term & field.is_valid()
+            conjunction_expression = term if conjunction_expression is None else conjunction_expression & term
+        expression = conjunction_expression if expression is None else expression | conjunction_expression
+    return expression
+
+
+def _parquet_chunks(path, columns, chunk_size, filters=None):
+    """Yield Arrow tables of exactly chunk_size rows (the last may be shorter) from a dataset"""
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    # Row groups whose statistics (and partitions whose keys) can't match are never read
+    expression = _arrow_filter(filters, dataset.schema) if filters else None
+    pending = []
+    pending_rows = 0
+
+    # Dataset fragments produce uneven batches; regroup them so chunks line up like read_csv's
+    for batch in dataset.to_batches(columns=columns, filter=expression, batch_size=chunk_rows(chunk_size)):
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= chunk_rows(chunk_size):
+            rows = chunk_rows(chunk_size)
+            table = pa.Table.from_batches(pending)
+            yield table.slice(0, rows)
+            rest = table.slice(rows)
+            pending = rest.to_batches()
+            pending_rows = rest.num_rows
+
+    if pending_rows:
+        yield pa.Table.from_batches(pending)
+
+
+def read_line_blocks(path, block_size=16 * 1024 * 1024):
+    """
+    Yield (first data row, [raw line bytes]) blocks of a possibly compressed CSV without parsing it.
+
+    Lets a stage carry columns it doesn't touch through to its output
+    verbatim. HCUP CSVs never embed newlines in quoted fields, so one line is one row.
+    """
+    row = 0
+    with open_input(path) as f:
+        if read_sidecar_header(path) is None:
+            f.readline()
+        while True:
+            lines = f.readlines(block_size)
+            if not lines:
+                return
+            yield row, lines
+            row += len(lines)
+
+
+def read_csv_chunks(source, chunk_size=100000, **read_csv_kwargs):
+    """read_csv in chunks, asking chunk_size (rows or a ChunkSizer) for the size of each chunk"""
+    with pd.read_csv(source, iterator=True, **read_csv_kwargs) as reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(chunk_rows(chunk_size))
+            except StopIteration:
+                return
+            yield chunk
+
+
+def read_frames(path, columns=None, chunk_size=100000, dtype=None, skip_rows=0, filters=None, **read_csv_kwargs):
+    """Yield DataFrame chunks from a CSV file or a Parquet dataset, loading only the given columns
+
+    chunk_size is a row count or a ChunkSizer consulted before every chunk.
+    skip_rows drops that many leading data rows, e.g. to resume after a checkpoint.
+    filters keeps only matching rows (see filters.py). Parquet skips row groups by their
+    statistics and numbers rows after filtering; CSV chunks keep their file row numbers,
+    and skip_rows counts file rows.
+    """
+    filters = normalize_filters(filters)
+    if is_parquet(path):
+        require_pyarrow()
+        start = 0
+        for table in _parquet_chunks(path, columns, chunk_size, filters):
+            if start + table.num_rows <= skip_rows:
+                start += table.num_rows
+                continue
+            if start < skip_rows:
+                table = table.slice(skip_rows - start)
+                start = skip_rows
+            df = table.to_pandas()
+            # Continue the row index across chunks the way read_csv does
+            df.index = pd.RangeIndex(start, start + len(df))
+            start += len(df)
+
+            for col, col_dtype in (dtype or {}).items():
+                if col not in df.columns:
+                    continue
+                try:
+                    df[col] = df[col].astype(col_dtype)
+                except (TypeError, ValueError):
+                    # Partition keys come back as strings and may not fit the spec dtype
+                    try:
+                        df[col] = pd.to_numeric(df[col])
+                    except (TypeError, ValueError):
+                        pass
+            yield df
+        return
+
+    if filters is None:
+        yield from _csv_frames(path, columns, chunk_size, dtype, skip_rows, **read_csv_kwargs)
+        return
+
+    # CSV has no statistics to skip by: parse the predicate columns too and drop rejected rows per chunk
+    extra = [] if columns is None else [col for col in filter_columns(filters) if col not in columns]
+    for chunk in _csv_frames(path, None if columns is None else columns + extra, chunk_size, dtype, skip_rows,
+                             **read_csv_kwargs):
+        chunk = chunk[filter_mask(chunk, filters)]
+        if extra:
+            chunk = chunk.drop(columns=extra)
+        if len(chunk):
+            yield chunk
+
+
+def _csv_frames(path, columns, chunk_size, dtype, skip_rows, **read_csv_kwargs):
+    """read_frames for a plain or compressed CSV"""
+    # Headerless files named by a sidecar header are read without rewriting them
+    sidecar_columns = read_sidecar_header(path)
+    if sidecar_columns is not None and 'names' not in read_csv_kwargs:
+        read_csv_kwargs = dict(read_csv_kwargs, names=sidecar_columns, header=None)
+
+    if compression_of(path):
+        # Stream compressed input through a decompression thread; it can't be seeked into
+        if skip_rows:
+            first = 0 if read_csv_kwargs.get('header', 'infer') is None else 1
+            read_csv_kwargs = dict(read_csv_kwargs, skiprows=range(first, first + skip_rows))
+        with open_input(path) as f:
+            for chunk in read_csv_chunks(f, chunk_size, usecols=columns, dtype=dtype, **read_csv_kwargs):
+                # Number rows from the top of the file, not from the first row read
+                chunk.index += skip_rows
+                yield chunk
+        return
+
+    if skip_rows:
+        # Seek straight to the row through the row index instead of parsing the skipped rows
+        from row_index import read_row_range
+        names = read_csv_kwargs.pop('names', None) or frame_columns(path)
+        read_csv_kwargs.pop('header', None)
+        yield from read_row_range(path, skip_rows, None, chunk_size, columns=names, usecols=columns,
+                                  dtype=dtype, **read_csv_kwargs)
+        return
+
+    yield from read_csv_chunks(path, chunk_size, usecols=columns, dtype=dtype, **read_csv_kwargs)
@@ -1,3 +1,4 @@
+import argparse
 import pandas as pd
 import os
 from tqdm import tqdm
@@ -5,6 +6,19 @@ import sys
 import logging
 from datetime import datetime
 
+from hcup_spec import lookup_dtypes
+from column_profile import load_profile
+from imputation import DEFAULT_MAX_PENDING, Imputer, StreamingImputer, parse_patterns
+from checkpoint import Checkpoint
+from global_impute import can_parallelize, impute_file_parallel, load_fill_stats
+from compression import COMPRESSION_CHOICES
+from row_counts import count_rows
+from stage_cache import run_cached, stage_code_files
+from filters import parse_filters
+from memory_budget import DEFAULT_MEMORY_BUDGET, ChunkSizer, estimate_row_bytes
+from staged_executor import chunks_in_flight, run_staged
+from output_formats import ChunkWriter, OUTPUT_FORMATS, output_path_for, read_frames, frame_columns, path_size
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO,
@@ -15,31 +29,42 @@ logging.basicConfig(
     ]
 )
 
+# Dataset-specific patterns, which process_merged_file's dataset_patterns add to or override
+DEFAULT_DATASET_PATTERNS = {
+    'NRD': {'numeric_method': 'linear', 'categorical_method': 'mode'},
+    'NIS': {'numeric_method': 'linear', 'categorical_method': 'mode'},
+    'KID': {'numeric_method': 'linear', 'categorical_method': 'mode'},
+    'NEDS': {'numeric_method': 'linear', 'categorical_method': 'mode'}
+}
+
 def get_file_size(file_path):
-    """Get file size in GB"""
-    return os.path.getsize(file_path) / (1024 * 1024 * 1024)
-
-def count_rows(file_path, chunk_size=100000):
-    """Count total rows in CSV file"""
-    total_rows = 0
-    for chunk in pd.read_csv(file_path, chunksize=chunk_size, usecols=[0]):
-        total_rows += len(chunk)
-    return total_rows
-
-def analyze_columns(df):
-    """Analyze columns and their missing value patterns"""
-    missing_stats = df.isnull().sum()
-    total_rows = len(df)
+    """Get file (or Parquet dataset) size in GB"""
+    return path_size(file_path) / (1024 * 1024 * 1024)
+
+def analyze_columns(profile):
+    """Log the missing values and HCUP sentinel codes of each column from a whole-file column profile"""
+    missing_stats = pd.Series({col: summary['nulls'] for col, summary in profile['columns'].items()}, dtype='int64')
+    total_rows = profile['rows']
     
     logging.info("\nColumn Analysis:")
-    for col in df.columns:
-        missing_count = missing_stats[col]
+    for col, summary in profile['columns'].items():
+        missing_count = summary['nulls']
         if missing_count > 0:
             missing_percentage = (missing_count / total_rows) * 100
             logging.info(f"Column '{col}': {missing_count:,} missing values ({missing_percentage:.2f}%)")
+        if summary['sentinels']:
+            codes = ', '.join(f"{code} ({sentinel['kind']}) x{sentinel['count']:,}"
+                              for code, sentinel in summary['sentinels'].items())
+            logging.info(f"Column '{col}': sentinel codes {codes}")
     
     return missing_stats
 
+def fill_stats_profile(stats):
+    """The missing-value counts the fill-value pass already gathered, shaped like a column profile"""
+    columns = {col: {'nulls': column.missing, 'sentinels': {}} for col, column in stats.columns.items()}
+    rows = max((column.present + column.missing for column in stats.columns.values()), default=0)
+    return {'rows': rows, 'columns': columns}
+
 def handle_missing_values(df, dataset_patterns=None):
     """Handle missing values in the dataframe using advanced interpolation
     
@@ -47,109 +72,128 @@ def handle_missing_values(df, dataset_patterns=None):
         df: pandas DataFrame
         dataset_patterns: dict of column prefixes and their specific handling methods
     """
-    # Separate numeric and non-numeric columns
-    numeric_columns = df.select_dtypes(include=['int64', 'float64']).columns
-    non_numeric_columns = df.select_dtypes(exclude=['int64', 'float64']).columns
-    
-    # Process numeric columns
-    for col in numeric_columns:
-        # Check if column belongs to a specific dataset
-        prefix = col.split('_')[0] if '_' in col else ''
-        
-        if dataset_patterns and prefix in dataset_patterns:
-            # Apply dataset-specific handling
-            method = dataset_patterns[prefix].get('numeric_method', 'linear')
-            if method == 'linear':
-                df[col] = df[col].interpolate(method='linear', limit_direction='both')
-            elif method == 'time':
-                df[col] = df[col].interpolate(method='time', limit_direction='both')
-            elif method == 'polynomial':
-                df[col] = df[col].interpolate(method='polynomial', order=2, limit_direction='both')
-        else:
-            # Default handling
-            df[col] = df[col].interpolate(method='linear', limit_direction='both')
-        
-        # Fill any remaining NaN at edges
-        df[col] = df[col].fillna(method='ffill').fillna(method='bfill')
-    
-    # Process non-numeric columns
-    for col in non_numeric_columns:
-        prefix = col.split('_')[0] if '_' in col else ''
-        
-        if dataset_patterns and prefix in dataset_patterns:
-            # Apply dataset-specific handling
-            method = dataset_patterns[prefix].get('categorical_method', 'mode')
-            if method == 'mode':
-                mode_value = df[col].mode()[0] if not df[col].mode().empty else 'Unknown'
-                df[col] = df[col].fillna(mode_value)
-            elif method == 'forward':
-                df[col] = df[col].fillna(method='ffill').fillna(method='bfill')
-        else:
-            # Default to mode for categorical columns
-            mode_value = df[col].mode()[0] if not df[col].mode().empty else 'Unknown'
-            df[col] = df[col].fillna(mode_value)
-    
-    return df
+    return Imputer(dataset_patterns)(df)
 
-def process_merged_file(input_file, output_file):
-    """Process the merged CSV file with interpolation"""
+def process_merged_file(input_file, output_file, output_format='csv', partition_cols=None, resume=True,
+                        compression=None, compression_level=None, queue_depth=4, memory_budget=DEFAULT_MEMORY_BUDGET,
+                        filters=None, max_pending=DEFAULT_MAX_PENDING, workers=1, global_stats=True,
+                        dataset_patterns=None, profile=False):
+    """Process the merged CSV file or Parquet dataset with interpolation
+
+    Args:
+        input_file: merged CSV file or Parquet dataset directory
+        output_file: CSV file or Parquet dataset directory to write
+        output_format: 'csv' or 'parquet'
+        partition_cols: columns to partition Parquet output by, e.g. ['DQTR']
+        resume: continue from the last committed chunk of an interrupted run
+        compression: Parquet codec; CSV output is compressed according to its .gz/.zst extension
+        compression_level: codec compression level
+        queue_depth: chunks buffered between the read, impute and write threads
+        memory_budget: memory that chunks in flight and the write buffer must fit in, e.g. '4GB'
+        filters: only impute and write matching rows, e.g. [('HOSP_DIVISION', '==', 3)]
+        max_pending: longest gap, in rows, that rows are held back to interpolate across;
+            longer gaps are forward filled
+        workers: processes imputing ranges of rows side by side (Parquet and compressed inputs need pyarrow)
+        global_stats: fill modes, means and medians from a first pass over the whole file
+            (cached next to it) rather than from each chunk
+        dataset_patterns: imputation methods per column name or prefix, on top of DEFAULT_DATASET_PATTERNS,
+            e.g. {'TOTCHG': {'numeric_method': 'group_mean', 'group_by': ['APRDRG', 'APRDRG_Severity']}}
+        profile: log sentinel codes from a full column profile of the file (an extra pass unless cached)
+            instead of just the missing counts the fill-value pass gathers
+    """
     try:
         # Get file size and estimate total rows
         file_size = get_file_size(input_file)
         logging.info(f"\nProcessing merged file: {input_file} (Size: {file_size:.2f} GB)")
         
-        # Determine optimal chunk size based on file size
-        chunk_size = min(100000, max(10000, int(100000 * (2 / file_size))))
-        
         # Count total rows
         logging.info("Counting total rows...")
-        total_rows = count_rows(input_file, chunk_size)
+        total_rows = count_rows(input_file)
         logging.info(f"Total rows to process: {total_rows:,}")
         
-        # Define dataset-specific patterns
-        dataset_patterns = {
-            'NRD': {'numeric_method': 'linear', 'categorical_method': 'mode'},
-            'NIS': {'numeric_method': 'linear', 'categorical_method': 'mode'},
-            'KID': {'numeric_method': 'linear', 'categorical_method': 'mode'},
-            'NEDS': {'numeric_method': 'linear', 'categorical_method': 'mode'}
-        }
-        
-        # Process in chunks
-        chunks = []
-        processed_rows = 0
-        first_chunk = True
+        dataset_patterns = dict(DEFAULT_DATASET_PATTERNS, **(dataset_patterns or {}))
         
-        with tqdm(total=total_rows, desc="Processing", unit="rows") as pbar:
-            for chunk in pd.read_csv(input_file, chunksize=chunk_size):
-                if first_chunk:
-                    # Analyze first chunk to understand column patterns
-                    logging.info("\nAnalyzing data patterns in first chunk...")
-                    analyze_columns(chunk)
-                    first_chunk = False
-                
-                # Handle missing values
-                chunk = handle_missing_values(chunk, dataset_patterns)
-                chunks.append(chunk)
-                
+        # First pass: whole-file fill values, and the values around each row range for parallel runs
+        parallel = workers > 1 and can_parallelize(input_file)
+        stats = None
+        if global_stats or parallel:
+            stats = load_fill_stats(input_file, workers, memory_budget, filters, dataset_patterns)
+
+        # Missingness of the whole file comes with the fill values; sentinel codes need the column profile
+        if profile:
+            logging.info("\nAnalyzing data patterns...")
+            analyze_columns(load_profile(input_file, workers, memory_budget))
+        elif stats is not None:
+            logging.info("\nAnalyzing data patterns...")
+            analyze_columns(fill_stats_profile(stats))
+
+        if parallel:
+            # Second pass: row ranges imputed side by side, each continuing from the values around it
+            processed_rows, imputer = impute_file_parallel(input_file, output_file, stats, workers, dataset_patterns,
+                                                           global_stats, max_pending, output_format, partition_cols,
+                                                           resume, compression, compression_level, memory_budget,
+                                                           filters)
+        else:
+            # Read with compact spec dtypes; integer columns become floats so they can hold NaN
+            columns = frame_columns(input_file)
+            dtypes = lookup_dtypes(columns, float_numeric=True)
+            # Chunk rows follow the measured width of the rows, so wide files get short chunks
+            sizer = ChunkSizer(memory_budget, estimate_row_bytes(columns, dtypes), chunks_in_flight(queue_depth))
+            writer = ChunkWriter(output_file, output_format, partition_cols, compression, compression_level)
+
+            # Committed chunks survive a crash; a rerun skips them and appends from there
+            checkpoint = Checkpoint(output_file, input_file,
+                                    {'memory_budget': memory_budget, 'format': output_format,
+                                     'partition_cols': partition_cols, 'filters': filters, 'max_pending': max_pending,
+                                     'global_stats': global_stats, 'dataset_patterns': dataset_patterns})
+            if not resume:
+                checkpoint.discard()
+            skip_rows = checkpoint.restore(writer)
+
+            # Values carried across chunks, so results are the same as imputing the whole file at once
+            imputer = StreamingImputer(dataset_patterns, max_pending, checkpoint.carried,
+                                       stats if global_stats else None)
+
+            # Process in chunks
+            buffer = sizer.buffer()
+            processed_rows = skip_rows
+            # Input row to resume from; filters make it run ahead of the rows written
+            position = skip_rows
+
+            def impute(chunk):
+                # Rows come out once the gaps they're in are closed; the carried state goes with them
+                return imputer(chunk), imputer.state()
+
+            def collect(item):
+                # Runs on the writer thread, in input order
+                nonlocal processed_rows, position
+                chunk, carried = item
                 processed_rows += len(chunk)
                 pbar.update(len(chunk))
-                
-                # Periodically save and clear chunks
-                if len(chunks) * chunk_size > 1000000:  # Save every million rows
-                    interim_df = pd.concat(chunks, ignore_index=True)
-                    if processed_rows == len(interim_df):  # First batch
-                        interim_df.to_csv(output_file, index=False, mode='w')
-                    else:
-                        interim_df.to_csv(output_file, index=False, mode='a', header=False)
-                    chunks = []  # Clear chunks from memory
+                if len(chunk):
+                    # Chunks keep their input row numbers through imputation
+                    position = int(chunk.index[-1]) + 1
+
+                # Save once the buffered chunks fill their share of the memory budget
+                if buffer.add(chunk):
+                    writer.write(buffer.drain())
+                    checkpoint.commit(writer, position, carried)
+
+            with tqdm(total=total_rows, initial=skip_rows, desc="Processing", unit="rows") as pbar:
+                # The next chunk is parsed and the previous one written while this one is imputed
+                run_staged(sizer.track(read_frames(input_file, chunk_size=sizer, dtype=dtypes, skip_rows=skip_rows,
+                                                   filters=filters)), impute, collect,
+                           queue_depth=queue_depth, label=os.path.basename(input_file))
+                # Rows still held for gaps that run to the end of the file
+                tail = imputer.flush()
+                if tail is not None:
+                    collect((tail, imputer.state()))
         
-        # Save any remaining chunks
-        if chunks:
-            interim_df = pd.concat(chunks, ignore_index=True)
-            if processed_rows == len(interim_df):
-                interim_df.to_csv(output_file, index=False, mode='w')
-            else:
-                interim_df.to_csv(output_file, index=False, mode='a', header=False)
+            # Save any remaining chunks
+            if buffer:
+                writer.write(buffer.drain())
+            writer.close()
+            checkpoint.complete()
         
         # Verify results
         final_size = get_file_size(output_file)
@@ -157,6 +201,7 @@ def process_merged_file(input_file, output_file):
         logging.info(f"Original size: {file_size:.2f} GB")
         logging.info(f"Final size: {final_size:.2f} GB")
         logging.info(f"Total rows processed: {processed_rows:,}")
+        imputer.log_summary(os.path.basename(input_file))
         
         return True
         
@@ -164,9 +209,13 @@ def process_merged_file(input_file, output_file):
         logging.error(f"Error processing merged file: {str(e)}", exc_info=True)
         return False
 
-def main():
-    input_file = 'combined_data.csv'
-    output_file = 'final_interpolated_data.csv'
+def main(output_format='csv', partition_cols=None, use_cache=True, compression=None, compression_level=None,
+         memory_budget=DEFAULT_MEMORY_BUDGET, filters=None, max_pending=DEFAULT_MAX_PENDING, workers=1,
+         global_stats=True, dataset_patterns=None, profile=False):
+    # Pick up whichever format merge_data.py produced
+    candidates = ['combined_data.parquet', 'combined_data.csv', 'combined_data.csv.gz', 'combined_data.csv.zst']
+    input_file = next((path for path in candidates if os.path.exists(path)), 'combined_data.csv')
+    output_file = output_path_for('final_interpolated_data.csv', output_format, compression)
     
     if not os.path.exists(input_file):
         logging.error(f"Merged file not found: {input_file}")
@@ -174,7 +223,22 @@ def main():
         return
     
     logging.info("Starting post-merge interpolation...")
-    success = process_merged_file(input_file, output_file)
+    run = lambda: process_merged_file(input_file, output_file, output_format, partition_cols,
+                                      compression=compression, compression_level=compression_level,
+                                      memory_budget=memory_budget, filters=filters, max_pending=max_pending,
+                                      workers=workers, global_stats=global_stats,
+                                      dataset_patterns=dataset_patterns, profile=profile)
+    if use_cache:
+        success = run_cached('post_merge_interpolate', [input_file], [output_file], run,
+                             params={'format': output_format, 'partition_cols': partition_cols,
+                                     'compression': compression, 'compression_level': compression_level,
+                                     # Whole-file stats make the output independent of chunk sizes; per-chunk stats don't
+                                     'memory_budget': None if global_stats else memory_budget,
+                                     'filters': filters, 'max_pending': max_pending,
+                                     'global_stats': global_stats, 'dataset_patterns': dataset_patterns},
+                             code_files=stage_code_files('post_merge_interpolate'))
+    else:
+        success = run()
     
     if success:
         logging.info(f"\nInterpolation completed successfully!")
@@ -183,4 +247,34 @@ def main():
         logging.error("Interpolation failed. Check the logs for details.")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Impute missing values in the merged HCUP file")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help="Output format")
+    parser.add_argument('--partition-by', nargs='*', default=None, help="Columns to partition Parquet output by")
+    parser.add_argument('--no-cache', action='store_true', help="Re-run even if inputs and parameters are unchanged")
+    parser.add_argument('--compression', choices=COMPRESSION_CHOICES, default=None,
+                        help="Output codec (CSV gets a .gz/.zst extension; Parquet defaults to zstd)")
+    parser.add_argument('--compression-level', type=int, default=None, help="Codec compression level")
+    parser.add_argument('--memory-budget', default=DEFAULT_MEMORY_BUDGET,
+                        help="Memory to size chunks against, e.g. 512MB or 8GB")
+    parser.add_argument('--filter', action='append', default=None, dest='filters',
+                        help="Keep only matching rows, e.g. 'HOSP_DIVISION == 3' or 'DQTR in 1,2' "
+                             "(repeat to AND several)")
+    parser.add_argument('--max-pending', type=int, default=DEFAULT_MAX_PENDING,
+                        help="Longest gap, in rows, to hold rows back for so it's interpolated exactly "
+                             "across chunks; longer gaps are forward filled")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Processes imputing ranges of rows side by side")
+    parser.add_argument('--local-stats', action='store_true',
+                        help="Fill modes, means and medians from each chunk instead of the whole file")
+    parser.add_argument('--patterns', type=parse_patterns, default=None,
+                        help="Imputation methods per column name or prefix, as JSON or a JSON file, e.g. "
+                             "'{\"TOTCHG\": {\"numeric_method\": \"group_mean\", \"group_by\": [\"APRDRG\"]}}'")
+    parser.add_argument('--profile', action='store_true',
+                        help="Log sentinel codes from a full column profile of the merged file (an extra pass "
+                             "unless cached)")
+    args = parser.parse_args()
+
+    main(args.format, args.partition_by, use_cache=not args.no_cache, compression=args.compression,
+         compression_level=args.compression_level, memory_budget=args.memory_budget,
+         filters=parse_filters(args.filters), max_pending=args.max_pending, workers=args.workers,
+         global_stats=not args.local_stats, dataset_patterns=args.patterns, profile=args.profile) 
\ No newline at end of file
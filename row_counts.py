@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+
+from asc_reader import count_asc_records
+from compression import compression_of, open_input, strip_compression
+from hcup_spec import schema_for_file
+from output_formats import is_parquet, parquet_row_count, read_sidecar_header
+from stage_cache import file_fingerprint
+
+ROW_COUNT_CACHE_FILE = '.hcup_row_counts.json'
+
+
+def count_lines(file_path, block_size=16 * 1024 * 1024):
+    """Count lines by scanning raw bytes for newlines; a final line without one still counts"""
+    lines = 0
+    last = b'\n'
+    with open_input(file_path) as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    return lines + (last != b'\n')
+
+
+def _cache_path(file_path):
+    return os.path.join(os.path.dirname(os.path.abspath(file_path.rstrip('/\\'))), ROW_COUNT_CACHE_FILE)
+
+
+def _load_cache(file_path):
+    try:
+        with open(_cache_path(file_path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_count(file_path, fingerprint, rows):
+    """Persist a count next to the file; written via rename so concurrent readers never see half a file"""
+    cache = _load_cache(file_path)
+    cache[os.path.basename(file_path.rstrip('/\\'))] = {'fingerprint': fingerprint, 'rows': rows}
+    cache_path = _cache_path(file_path)
+    temp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        # A read-only data folder only costs us the cache
+        logging.debug(f"Could not save row count cache for {file_path}: {e}")
+
+
+def _count(file_path):
+    """Row count without parsing any values"""
+    if is_parquet(file_path):
+        return parquet_row_count(file_path)
+
+    if strip_compression(file_path).upper().endswith('.ASC'):
+        schema = schema_for_file(file_path)
+        # A compressed file's record count would need a full decompression; trust the spec
+        if schema and compression_of(file_path) and schema['header'].get('n_observations'):
+            return schema['header']['n_observations']
+        if schema and schema['header'].get('record_length'):
+            return count_asc_records(file_path, schema['header']['record_length'])
+        if schema and schema['header'].get('n_observations'):
+            return schema['header']['n_observations']
+        return count_lines(file_path)
+
+    # HCUP CSVs never embed newlines in quoted fields, so one line is one row
+    lines = count_lines(file_path)
+    has_header = read_sidecar_header(file_path) is None
+    return max(lines - 1, 0) if has_header else lines
+
+
+def count_rows(file_path):
+    """
+    Data rows in a CSV, fixed-width ASC file or Parquet dataset.
+
+    Counts are cached next to the file keyed by its size and mtime, so a file
+    is only scanned once no matter how many stages size a progress bar from it.
+    """
+    fingerprint = file_fingerprint(file_path)
+    cached = _load_cache(file_path).get(os.path.basename(file_path.rstrip('/\\')))
+    if cached and cached['fingerprint'] == fingerprint:
+        return cached['rows']
+
+    rows = _count(file_path)
+    _save_count(file_path, fingerprint, rows)
+    return rows
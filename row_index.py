@@ -0,0 +1,135 @@
+import bisect
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from output_formats import dedupe_columns, frame_columns, read_csv_chunks, read_sidecar_header
+from stage_cache import file_fingerprint
+
+ROW_INDEX_STRIDE = 100000  # rows between indexed offsets
+
+
+def row_index_path(csv_path):
+    """Sidecar file holding sparse row byte offsets for a CSV"""
+    return csv_path + '.rowidx'
+
+
+def build_row_index(csv_path, stride=ROW_INDEX_STRIDE, block_size=16 * 1024 * 1024):
+    """
+    Scan a CSV once and record the byte offset of every stride-th data row.
+
+    Returns {'rows': [...], 'offsets': [...], 'n_rows': ..., 'size': ...}
+    where offsets[i] is where data row rows[i] starts.
+    """
+    # Data starts after the header line unless the names live in a sidecar header
+    skip_header = read_sidecar_header(csv_path) is None
+    rows, offsets = [], []
+    row = -1 if skip_header else 0
+    if not skip_header:
+        rows.append(0)
+        offsets.append(0)
+
+    position = 0
+    last = b'\n'
+    with open(csv_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            # Row that starts right after each newline in this block
+            line_ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+            next_rows = row + 1 + np.arange(len(line_ends))
+            marks = np.flatnonzero(next_rows % stride == 0)
+            rows.extend(int(r) for r in next_rows[marks])
+            offsets.extend(int(position + end + 1) for end in line_ends[marks])
+            row += len(line_ends)
+            position += len(block)
+            last = block[-1:]
+
+    # A row beginning exactly at EOF is not a row
+    while offsets and offsets[-1] >= position:
+        rows.pop()
+        offsets.pop()
+
+    # A final line without a newline is still a row
+    n_rows = max(row + (last != b'\n'), 0)
+    return {'stride': stride, 'rows': rows, 'offsets': offsets, 'n_rows': n_rows, 'size': position}
+
+
+def save_row_index(csv_path, index):
+    """Write the index sidecar, tagged with the CSV's fingerprint so stale indexes are ignored"""
+    index = dict(index, fingerprint=file_fingerprint(csv_path))
+    temp_path = row_index_path(csv_path) + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(temp_path, row_index_path(csv_path))
+    return index
+
+
+def load_row_index(csv_path, build=True, stride=ROW_INDEX_STRIDE):
+    """Return the row index for a CSV, (re)building it with one scan if missing or stale"""
+    sidecar = row_index_path(csv_path)
+    if os.path.exists(sidecar):
+        try:
+            with open(sidecar, 'r') as f:
+                index = json.load(f)
+            if index.get('fingerprint') == file_fingerprint(csv_path):
+                return index
+        except (OSError, ValueError):
+            pass
+
+    if not build:
+        return None
+    logging.info(f"Building row index for {csv_path}")
+    return save_row_index(csv_path, build_row_index(csv_path, stride))
+
+
+def locate_row(index, row):
+    """Nearest indexed (row, byte offset) at or before a data row"""
+    i = bisect.bisect_right(index['rows'], row) - 1
+    if i < 0:
+        raise ValueError(f"Row {row} is before the first indexed row")
+    return index['rows'][i], index['offsets'][i]
+
+
+def split_row_ranges(index, n_parts):
+    """Split a file into about n_parts (start, stop) row ranges that begin on indexed offsets"""
+    starts = sorted(set(index['rows'][::max(1, len(index['rows']) // max(n_parts, 1))]))
+    stops = starts[1:] + [index['n_rows']]
+    return [(start, stop) for start, stop in zip(starts, stops) if start < stop]
+
+
+def read_row_range(csv_path, start=0, stop=None, chunk_size=100000, index=None, columns=None,
+                   usecols=None, **read_csv_kwargs):
+    """
+    Yield DataFrame chunks for data rows [start, stop) by seeking to the nearest indexed offset.
+
+    Chunks carry the file's row numbers as their index, like read_csv chunks do.
+    """
+    index = index or load_row_index(csv_path)
+    stop = index['n_rows'] if stop is None else min(stop, index['n_rows'])
+    if start >= stop:
+        return
+
+    base_row, offset = locate_row(index, start)
+    # Merged files repeat key columns; name them as read_csv does from the header
+    names = dedupe_columns(columns or frame_columns(csv_path))
+
+    with open(csv_path, 'rb') as f:
+        f.seek(offset)
+        reader = read_csv_chunks(f, chunk_size, header=None, names=names, usecols=usecols,
+                                 skiprows=start - base_row, nrows=stop - start, **read_csv_kwargs)
+        first = start
+        for chunk in reader:
+            chunk.index = pd.RangeIndex(first, first + len(chunk))
+            first += len(chunk)
+            yield chunk
+
+
+def sample_rows(csv_path, rows, columns=None, index=None):
+    """Fetch specific data rows without reading the file from the top"""
+    index = index or load_row_index(csv_path)
+    columns = columns or frame_columns(csv_path)
+    frames = [next(read_row_range(csv_path, row, row + 1, 1, index, columns), None) for row in sorted(rows)]
+    frames = [frame for frame in frames if frame is not None]
+    return pd.concat(frames) if frames else pd.DataFrame(columns=columns)
@@ -0,0 +1,313 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from compression import COMPRESSION_CHOICES, open_text, strip_compression
+from hcup_spec import file_columns, schema_for_file
+from imputation import parse_patterns
+from memory_budget import DEFAULT_MEMORY_BUDGET, parse_memory_budget
+from output_formats import OUTPUT_FORMATS, output_path_for, path_size
+from stage_cache import run_cached, stage_code_files
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler(f'pipeline_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'),
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+
+FAMILIES = ['NIS', 'KID', 'NRD', 'NEDS']
+CHARGE_COLUMNS = ['LOS', 'APRDRG', 'PAY1', 'TOTCHG']
+
+
+class Stage:
+    """One node of the pipeline graph: a function call with declared inputs, outputs and dependencies"""
+
+    def __init__(self, name, kind, func, kwargs, inputs, outputs, deps=(), params=None):
+        self.name = name
+        self.kind = kind
+        self.func = func
+        self.kwargs = kwargs
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.params = params or {}
+
+
+def ensure_header(csv_path, columns):
+    """Give a headerless CSV a sidecar header so downstream stages can read it by name"""
+    from main import write_sidecar_header
+
+    with open_text(csv_path) as f:
+        first_field = f.readline().split(',')[0].strip().strip('"')
+    if columns and first_field not in columns:
+        write_sidecar_header(csv_path, columns)
+
+
+# Stage functions run in worker processes; stage modules are imported there so each
+# only sets up its own logging when it is actually used
+
+def convert_stage(asc_path, output_path, output_format='csv', partition_cols=None, compression=None,
+                  compression_level=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Fixed-width ASC to CSV/Parquet using the file's spec layout"""
+    from convert_asc_to_csv import convert_fixed_width_file
+    return convert_fixed_width_file(asc_path, output_path, schema_for_file(asc_path), memory_budget,
+                                    output_format, partition_cols, compression=compression,
+                                    compression_level=compression_level)
+
+
+def interpolate_stage(input_file, output_file, columns=None, output_format='csv', partition_cols=None,
+                      compression=None, compression_level=None, memory_budget=DEFAULT_MEMORY_BUDGET,
+                      dataset_patterns=None):
+    """Impute one source file"""
+    from interpolate_data import process_file
+    if columns and not os.path.isdir(input_file):
+        ensure_header(input_file, columns)
+    return process_file(input_file, output_file, output_format, partition_cols,
+                        compression=compression, compression_level=compression_level, memory_budget=memory_budget,
+                        dataset_patterns=dataset_patterns)
+
+
+def merge_stage(file_paths, output_file, output_format='csv', partition_cols=None, compression=None,
+                compression_level=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Merge a family's imputed files side by side"""
+    from merge_data import merge_and_save_chunks
+    return merge_and_save_chunks(file_paths, output_file, memory_budget, output_format, partition_cols,
+                                 compression, compression_level)
+
+
+def post_merge_stage(input_file, output_file, output_format='csv', partition_cols=None, compression=None,
+                     compression_level=None, memory_budget=DEFAULT_MEMORY_BUDGET, dataset_patterns=None):
+    """Impute gaps introduced by the merge"""
+    from post_merge_interpolate import process_merged_file
+    return process_merged_file(input_file, output_file, output_format, partition_cols,
+                               compression=compression, compression_level=compression_level,
+                               memory_budget=memory_budget, dataset_patterns=dataset_patterns)
+
+
+def charges_stage(input_file, output_file, output_format='csv', partition_cols=None, compression=None,
+                  compression_level=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Model modified total charges"""
+    from generate_modified_charges import generate_modified_charges
+    return generate_modified_charges(input_file, output_file, output_format, partition_cols, compression,
+                                     compression_level, memory_budget)
+
+
+def plan_family(family, year, data_dir, processed_dir, output_format='csv', partition_cols=None, compression=None,
+                compression_level=None, memory_budget=DEFAULT_MEMORY_BUDGET, dataset_patterns=None):
+    """Build the stage graph for one dataset family from the files present in data_dir/<FAMILY>_<year>
+
+    dataset_patterns sets the imputation methods per column name or prefix for both imputation stages.
+    """
+    source_dir = os.path.join(data_dir, f'{family}_{year}')
+    if not os.path.isdir(source_dir):
+        logging.info(f"Skipping {family}: {source_dir} not found")
+        return []
+
+    out_dir = os.path.join(processed_dir, f'{family}_{year}')
+    os.makedirs(out_dir, exist_ok=True)
+    fmt = {'output_format': output_format, 'partition_cols': partition_cols, 'compression': compression,
+           'compression_level': compression_level, 'memory_budget': memory_budget}
+    params = {'format': output_format, 'partition_cols': partition_cols, 'compression': compression,
+              'compression_level': compression_level}
+    # Imputation fills from whole-file stats, so its output is the same for any chunk size; the merge pairs
+    # up chunks positionally, so files of different lengths line up differently as the budget changes
+    chunked = dict(params, memory_budget=memory_budget)
+    imputed = dict(params, dataset_patterns=dataset_patterns)
+    stages = []
+    sources = {}  # STEM -> (stem, path to impute, size for ordering, upstream stage)
+
+    files = sorted(os.listdir(source_dir))
+    # Sources may still be in their .gz/.zst/.zip archives; they are streamed, never extracted
+    for file in files:
+        stem, ext = os.path.splitext(os.path.basename(strip_compression(os.path.join(source_dir, file))))
+        if ext.upper() != '.ASC':
+            continue
+        asc_path = os.path.join(source_dir, file)
+        if schema_for_file(asc_path) is None:
+            logging.warning(f"No FileSpecifications layout for {file}; convert it with convert_asc_to_csv.py")
+            continue
+        output_path = output_path_for(os.path.join(source_dir, stem + '.csv'), output_format, compression)
+        name = f'{family}:convert:{stem}'
+        stages.append(Stage(name, 'convert', convert_stage, dict(asc_path=asc_path, output_path=output_path, **fmt),
+                            [asc_path], [output_path], params=params))
+        sources[stem.upper()] = (stem, output_path, os.path.getsize(asc_path), name)
+
+    for file in files:
+        stem, ext = os.path.splitext(os.path.basename(strip_compression(os.path.join(source_dir, file))))
+        if ext.lower() != '.csv' or stem.upper() in sources:
+            continue
+        csv_path = os.path.join(source_dir, file)
+        sources[stem.upper()] = (stem, csv_path, os.path.getsize(csv_path), None)
+
+    if not sources:
+        logging.info(f"Skipping {family}: no ASC or CSV files in {source_dir}")
+        return []
+
+    processed = []
+    for stem, input_path, size, dep in sorted(sources.values(), key=lambda source: source[2], reverse=True):
+        output_path = output_path_for(os.path.join(out_dir, f'processed_{stem}.csv'), output_format, compression)
+        columns = file_columns(stem) if dep is None else None
+        stages.append(Stage(f'{family}:interpolate:{stem}', 'interpolate', interpolate_stage,
+                            dict(input_file=input_path, output_file=output_path, columns=columns,
+                                 dataset_patterns=dataset_patterns, **fmt),
+                            [input_path], [output_path], [dep] if dep else [], imputed))
+        processed.append((output_path, f'{family}:interpolate:{stem}'))
+
+    # Largest file first: it drives the merge
+    merged = output_path_for(os.path.join(out_dir, f'combined_{family}_{year}.csv'), output_format, compression)
+    stages.append(Stage(f'{family}:merge', 'merge', merge_stage,
+                        dict(file_paths=[path for path, _ in processed], output_file=merged, **fmt),
+                        [path for path, _ in processed], [merged], [name for _, name in processed], chunked))
+
+    final = output_path_for(os.path.join(out_dir, f'final_{family}_{year}.csv'), output_format, compression)
+    stages.append(Stage(f'{family}:post_merge_interpolate', 'post_merge_interpolate', post_merge_stage,
+                        dict(input_file=merged, output_file=final, dataset_patterns=dataset_patterns, **fmt),
+                        [merged], [final], [f'{family}:merge'], imputed))
+
+    # Charges need LOS, APRDRG, PAY1 and TOTCHG, which may come from different source files
+    merged_columns = {column for stem, _, _, _ in sources.values() for column in file_columns(stem) or []}
+    if all(column in merged_columns for column in CHARGE_COLUMNS):
+        charges = output_path_for(os.path.join(out_dir, f'modified_charges_{family}_{year}.csv'), output_format,
+                                  compression)
+        stages.append(Stage(f'{family}:modified_charges', 'modified_charges', charges_stage,
+                            dict(input_file=final, output_file=charges, **fmt),
+                            [final], [charges], [f'{family}:post_merge_interpolate'], params))
+
+    return stages
+
+
+def plan_pipeline(families=FAMILIES, year=2019, data_dir='data', processed_dir='processed_data',
+                  output_format='csv', partition_cols=None, compression=None, compression_level=None,
+                  memory_budget=DEFAULT_MEMORY_BUDGET, dataset_patterns=None):
+    """Stage graph for every requested dataset family; memory_budget is what each stage may use"""
+    stages = []
+    for family in families:
+        stages.extend(plan_family(family, year, data_dir, processed_dir, output_format, partition_cols,
+                                  compression, compression_level, memory_budget, dataset_patterns))
+    return stages
+
+
+def execute_stage(stage, use_cache=True):
+    """Run one stage in a worker process, through the stage cache unless disabled"""
+    start_time = time.time()
+    run = lambda: stage.func(**stage.kwargs)
+    if use_cache:
+        result = run_cached(stage.kind, stage.inputs, stage.outputs, run, stage.params,
+                            code_files=stage_code_files(stage.kind))
+    else:
+        result = run()
+
+    # Stage functions report failure by returning False rather than raising
+    if result is False:
+        raise RuntimeError(f"Stage {stage.name} failed; see its log for details")
+    return time.time() - start_time
+
+
+def _branch_size(stage):
+    """Bytes feeding a stage; bigger branches are started first so they don't finish last"""
+    return sum(path_size(path) for path in stage.inputs if os.path.exists(path))
+
+
+def run_pipeline(stages, workers=4, use_cache=True):
+    """
+    Run a stage graph, starting each stage as soon as its dependencies finish.
+
+    Independent branches (e.g. converting NEDS while imputing NRD) run
+    concurrently in up to `workers` processes. A failed stage skips everything
+    downstream of it while other branches carry on. Returns {stage name: status}.
+    """
+    pending = {stage.name: stage for stage in stages}
+    status = {}
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            # Anything downstream of a failure can never run
+            blocked = [name for name, stage in pending.items()
+                       if any(status.get(dep) in ('failed', 'skipped') for dep in stage.deps)]
+            for name in blocked:
+                logging.error(f"Skipping {name}: an upstream stage failed")
+                status[name] = 'skipped'
+                del pending[name]
+            if blocked:
+                continue
+
+            ready = [stage for stage in pending.values() if all(status.get(dep) == 'done' for dep in stage.deps)]
+            for stage in sorted(ready, key=_branch_size, reverse=True)[:workers - len(running)]:
+                logging.info(f"Starting {stage.name}")
+                running[executor.submit(execute_stage, stage, use_cache)] = stage
+                del pending[stage.name]
+
+            if not running:
+                # Dependencies that are not part of the plan
+                for name in pending:
+                    logging.error(f"Skipping {name}: unknown dependency")
+                    status[name] = 'skipped'
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    elapsed = future.result()
+                    status[stage.name] = 'done'
+                    logging.info(f"Finished {stage.name} in {elapsed:.1f}s")
+                except Exception as e:
+                    status[stage.name] = 'failed'
+                    logging.error(f"{stage.name} failed: {str(e)}")
+
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the HCUP pipeline for every dataset family")
+    parser.add_argument('--families', nargs='*', default=FAMILIES, choices=FAMILIES, help="Dataset families to run")
+    parser.add_argument('--year', type=int, default=2019, help="Data year")
+    parser.add_argument('--data-dir', default='data', help="Folder holding <FAMILY>_<year> source folders")
+    parser.add_argument('--processed-dir', default='processed_data', help="Folder for stage outputs")
+    parser.add_argument('--workers', type=int, default=4, help="Stages to run at once")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help="Output format")
+    parser.add_argument('--partition-by', nargs='*', default=None, help="Columns to partition Parquet output by")
+    parser.add_argument('--no-cache', action='store_true', help="Re-run stages even if inputs are unchanged")
+    parser.add_argument('--compression', choices=COMPRESSION_CHOICES, default=None,
+                        help="Output codec (CSV gets a .gz/.zst extension; Parquet defaults to zstd)")
+    parser.add_argument('--compression-level', type=int, default=None, help="Codec compression level")
+    parser.add_argument('--memory-budget', default=DEFAULT_MEMORY_BUDGET,
+                        help="Memory for the whole run, shared by the stages running at once, e.g. 16GB")
+    parser.add_argument('--patterns', type=parse_patterns, default=None,
+                        help="Imputation methods per column name or prefix, as JSON or a JSON file, e.g. "
+                             "'{\"TOTCHG\": {\"numeric_method\": \"group_mean\", \"group_by\": [\"APRDRG\"]}}'")
+    parser.add_argument('--dry-run', action='store_true', help="Print the stage graph without running it")
+    args = parser.parse_args()
+
+    # Up to `workers` stages run at once; each gets an equal slice of the budget
+    stage_budget = parse_memory_budget(args.memory_budget) // max(args.workers, 1)
+    stages = plan_pipeline(args.families, args.year, args.data_dir, args.processed_dir,
+                           args.format, args.partition_by, args.compression, args.compression_level, stage_budget,
+                           args.patterns)
+    if not stages:
+        logging.error("Nothing to run")
+        return
+
+    if args.dry_run:
+        for stage in stages:
+            print(f"{stage.name}  <- {', '.join(stage.deps) or '(source)'}")
+        return
+
+    start_time = time.time()
+    status = run_pipeline(stages, args.workers, not args.no_cache)
+    logging.info(f"\nPipeline finished in {time.time() - start_time:.1f}s")
+    for name, state in status.items():
+        logging.info(f"{state:>8}  {name}")
+
+
+if __name__ == "__main__":
+    main()
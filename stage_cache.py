@@ -0,0 +1,220 @@
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import time
+
+from hcup_spec import load_registry
+from output_formats import clear_output, path_size
+
+CACHE_DIR = '.stage_cache'
+DEFAULT_MAX_BYTES = 200 * 1024 ** 3  # 200 GB of local disk for cached stage outputs
+
+# Modules whose code decides each stage's output: the stage script and the engine it runs.
+# Editing any of them invalidates that stage, whether it ran from its script or from run_pipeline.
+_IO_MODULES = ['hcup_spec', 'filters', 'output_formats', 'compression']
+_IMPUTE_MODULES = ['imputation', 'global_impute', 'staged_executor', 'row_index', 'convert_asc_to_csv'] + _IO_MODULES
+STAGE_CODE_MODULES = {
+    'convert': ['convert_asc_to_csv', 'asc_reader'] + _IO_MODULES,
+    'interpolate': ['interpolate_data'] + _IMPUTE_MODULES,
+    'merge': ['merge_data', 'staged_executor'] + _IO_MODULES,
+    'post_merge_interpolate': ['post_merge_interpolate'] + _IMPUTE_MODULES,
+    'modified_charges': ['generate_modified_charges'] + _IO_MODULES,
+}
+
+
+def _iter_files(path):
+    """Files making up an output: the file itself, or every file under a dataset directory"""
+    if os.path.isdir(path):
+        for root, _, files in sorted(os.walk(path)):
+            for file in sorted(files):
+                yield os.path.join(root, file)
+    elif os.path.exists(path):
+        yield path
+
+
+def file_fingerprint(path, content_hash=False, block_size=16 * 1024 * 1024):
+    """
+    Fingerprint a file or dataset directory.
+
+    By default uses size and modification time, which is instant on multi-GB
+    files; content_hash=True hashes the bytes instead, which survives copies
+    and touch but reads the whole input.
+    """
+    digest = hashlib.sha256()
+    for file in _iter_files(path):
+        stat = os.stat(file)
+        digest.update(os.path.relpath(file, path).encode() if file != path else b'')
+        if content_hash:
+            with open(file, 'rb') as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    digest.update(block)
+        else:
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def spec_version():
+    """Identity of the registered FileSpecifications files, so spec edits invalidate stages"""
+    return sorted(schema['spec_key'] for schema in load_registry().values())
+
+
+def stage_code_files(stage):
+    """Source files of the modules a stage kind's output depends on"""
+    return [importlib.util.find_spec(name).origin for name in STAGE_CODE_MODULES[stage]]
+
+
+def stage_key(stage, inputs, params=None, code_files=None, content_hash=False):
+    """Cache key for a stage run: its inputs, parameters, code and the spec version"""
+    payload = {
+        'stage': stage,
+        'inputs': {os.path.basename(p.rstrip('/\\')): file_fingerprint(p, content_hash) for p in inputs},
+        'params': params or {},
+        # Source files are always hashed by content so editing a stage invalidates only that stage
+        'code': [file_fingerprint(p, content_hash=True) for p in code_files or []],
+        'spec': spec_version(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+def _link_or_copy(source, target):
+    """Hard-link when source and target share a drive, otherwise copy"""
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _place(source, target):
+    """Materialize a file or dataset directory at target"""
+    clear_output(target)
+    if os.path.isdir(source):
+        for file in _iter_files(source):
+            _link_or_copy(file, os.path.join(target, os.path.relpath(file, source)))
+    else:
+        _link_or_copy(source, target)
+
+
+def _detach(path):
+    """Remove an output that shares storage with a cache entry before a stage rewrites it"""
+    if any(os.stat(file).st_nlink > 1 for file in _iter_files(path)):
+        clear_output(path)
+
+
+class StageCache:
+    """On-disk cache of stage outputs keyed by a fingerprint of the stage's inputs and parameters"""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, content_hash=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+
+    def _entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def _manifest_path(self, stage, key):
+        return os.path.join(self._entry_dir(stage, key), 'manifest.json')
+
+    def lookup(self, stage, key, outputs):
+        """Restore outputs for a cached key; returns the entry's manifest on a hit, else None"""
+        manifest_path = self._manifest_path(stage, key)
+        if not os.path.exists(manifest_path):
+            return None
+
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+        entry_dir = self._entry_dir(stage, key)
+        for i, output in enumerate(outputs):
+            stored = os.path.join(entry_dir, f'output_{i}')
+            if not os.path.exists(stored):
+                return None
+            # Skip the copy when the output on disk is already the cached one
+            if os.path.exists(output) and file_fingerprint(output) == manifest['outputs'][i]:
+                continue
+            _place(stored, output)
+            manifest['outputs'][i] = file_fingerprint(output)
+
+        manifest['last_used'] = time.time()
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        return manifest
+
+    def store(self, stage, key, outputs, params=None, result=None):
+        """Save a stage's outputs under its key and evict old entries beyond the size budget"""
+        entry_dir = self._entry_dir(stage, key)
+        clear_output(entry_dir)
+        os.makedirs(entry_dir)
+
+        for i, output in enumerate(outputs):
+            _place(output, os.path.join(entry_dir, f'output_{i}'))
+
+        manifest = {
+            'stage': stage,
+            'outputs': [file_fingerprint(output) for output in outputs],
+            'paths': [os.path.abspath(output) for output in outputs],
+            'params': params or {},
+            'result': result,
+            'size': sum(path_size(output) for output in outputs),
+            'created': time.time(),
+            'last_used': time.time(),
+        }
+        with open(self._manifest_path(stage, key), 'w') as f:
+            json.dump(manifest, f, default=str)
+
+        self.evict()
+
+    def entries(self):
+        """All cache entries as (manifest, entry_dir) pairs"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        found = []
+        for stage in os.listdir(self.cache_dir):
+            stage_dir = os.path.join(self.cache_dir, stage)
+            for key in os.listdir(stage_dir) if os.path.isdir(stage_dir) else []:
+                manifest_path = os.path.join(stage_dir, key, 'manifest.json')
+                if os.path.exists(manifest_path):
+                    with open(manifest_path, 'r') as f:
+                        found.append((json.load(f), os.path.join(stage_dir, key)))
+        return found
+
+    def evict(self, max_bytes=None):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.entries(), key=lambda entry: entry[0]['last_used'])
+        total = sum(manifest['size'] for manifest, _ in entries)
+
+        while entries and total > max_bytes:
+            manifest, entry_dir = entries.pop(0)
+            shutil.rmtree(entry_dir)
+            total -= manifest['size']
+            logging.info(f"Evicted cached {manifest['stage']} output ({manifest['size'] / 1024 ** 3:.2f} GB)")
+
+    def run(self, stage, inputs, outputs, func, params=None, code_files=None):
+        """
+        Run func() unless a cached result exists for the same inputs, params and code.
+
+        func should return a truthy value on success; only successful runs are cached,
+        and a JSON-serializable return value is handed back again on later hits.
+        """
+        key = stage_key(stage, inputs, params, code_files, self.content_hash)
+        manifest = self.lookup(stage, key, outputs)
+        if manifest is not None:
+            logging.info(f"Stage '{stage}' unchanged; reusing cached output ({key})")
+            return manifest.get('result', True)
+
+        for output in outputs:
+            _detach(output)
+
+        result = func()
+        if result and all(os.path.exists(output) for output in outputs):
+            self.store(stage, key, outputs, params, result)
+        return result
+
+
+def run_cached(stage, inputs, outputs, func, params=None, code_files=None, cache=None):
+    """Run a pipeline stage through the default stage cache"""
+    return (cache or StageCache()).run(stage, inputs, outputs, func, params, code_files)
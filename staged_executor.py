@@ -0,0 +1,207 @@
+import logging
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class StageStats:
+    """Time one pipeline stage spent working, starved for input and blocked on a full output queue"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def as_dict(self):
+        return {'items': self.items, 'busy_s': round(self.busy, 3), 'starved_s': round(self.starved, 3),
+                'blocked_s': round(self.blocked, 3)}
+
+
+class QueueStats:
+    """Depth of a queue sampled every time an item is taken from it"""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+
+    def sample(self, depth):
+        self.samples += 1
+        self.total += depth
+        self.max = max(self.max, depth)
+
+    def as_dict(self):
+        return {'capacity': self.maxsize, 'max_depth': self.max,
+                'mean_depth': round(self.total / self.samples, 2) if self.samples else 0}
+
+
+def chunks_in_flight(queue_depth=4, workers=1):
+    """Most chunks a StagedExecutor holds at once: both queues full, one per worker, one being read and written"""
+    return 2 * queue_depth + workers + 2
+
+
+class StagedExecutor:
+    """
+    Overlap reading, transforming and writing of chunks.
+
+    A prefetch thread pulls items from `source`, `workers` threads apply
+    `transform`, and a writer thread hands results to `sink` in their
+    original order. Bounded queues between the stages cap memory at roughly
+    2 * queue_depth + workers chunks, so throughput approaches the slowest
+    stage rather than the sum of all three.
+    """
+
+    def __init__(self, source, transform, sink, workers=1, queue_depth=4):
+        self.source = source
+        self.transform = transform
+        self.sink = sink
+        self.workers = max(1, workers)
+        self.read_queue = queue.Queue(maxsize=queue_depth)
+        self.write_queue = queue.Queue(maxsize=queue_depth)
+        self.read_queue_stats = QueueStats('read', queue_depth)
+        self.write_queue_stats = QueueStats('write', queue_depth)
+        self.stats = {name: StageStats(name) for name in ('read', 'transform', 'write')}
+        self._stop = threading.Event()
+        self._errors = []
+        self._lock = threading.Lock()
+
+    def _put(self, q, item, stats):
+        """Put with a timeout loop so a failed stage elsewhere can't leave us blocked forever"""
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        with self._lock:
+            stats.blocked += time.perf_counter() - start
+
+    def _get(self, q, q_stats, stats):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        else:
+            return _DONE
+        with self._lock:
+            stats.starved += time.perf_counter() - start
+            q_stats.sample(q.qsize())
+        return item
+
+    def _fail(self, error):
+        self._errors.append(error)
+        self._stop.set()
+
+    def _read(self):
+        stats = self.stats['read']
+        try:
+            iterator = iter(self.source)
+            seq = 0
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                item = next(iterator, _DONE)
+                stats.busy += time.perf_counter() - start
+                if item is _DONE:
+                    break
+                stats.items += 1
+                self._put(self.read_queue, (seq, item), stats)
+                seq += 1
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.workers):
+                self._put(self.read_queue, _DONE, stats)
+
+    def _transform(self):
+        stats = self.stats['transform']
+        try:
+            while True:
+                entry = self._get(self.read_queue, self.read_queue_stats, stats)
+                if entry is _DONE:
+                    break
+                seq, item = entry
+                start = time.perf_counter()
+                result = self.transform(item)
+                with self._lock:
+                    stats.busy += time.perf_counter() - start
+                    stats.items += 1
+                self._put(self.write_queue, (seq, result), stats)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(self.write_queue, _DONE, stats)
+
+    def _write(self):
+        stats = self.stats['write']
+        pending = {}
+        next_seq = 0
+        finished_workers = 0
+        try:
+            while finished_workers < self.workers:
+                entry = self._get(self.write_queue, self.write_queue_stats, stats)
+                if entry is _DONE:
+                    finished_workers += 1
+                    if self._stop.is_set():
+                        break
+                    continue
+                seq, result = entry
+                pending[seq] = result
+
+                # Workers may finish out of order; write strictly in source order
+                while next_seq in pending:
+                    start = time.perf_counter()
+                    self.sink(pending.pop(next_seq))
+                    stats.busy += time.perf_counter() - start
+                    stats.items += 1
+                    next_seq += 1
+        except Exception as e:
+            self._fail(e)
+
+    def run(self):
+        """Run all stages to completion; re-raises the first error from any stage"""
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._read, name='prefetch', daemon=True)]
+        threads += [threading.Thread(target=self._transform, name=f'transform-{i}', daemon=True)
+                    for i in range(self.workers)]
+        threads.append(threading.Thread(target=self._write, name='writer', daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.elapsed = time.perf_counter() - start
+        if self._errors:
+            raise self._errors[0]
+        return self.metrics()
+
+    def metrics(self):
+        """Per-stage busy/starved/blocked seconds and queue depths"""
+        stages = {name: stats.as_dict() for name, stats in self.stats.items()}
+        bottleneck = max(stages, key=lambda name: stages[name]['busy_s'])
+        return {
+            'elapsed_s': round(getattr(self, 'elapsed', 0.0), 3),
+            'bottleneck': bottleneck,
+            'stages': stages,
+            'queues': {'read': self.read_queue_stats.as_dict(), 'write': self.write_queue_stats.as_dict()},
+        }
+
+
+def run_staged(source, transform, sink, workers=1, queue_depth=4, label='pipeline'):
+    """Run source -> transform -> sink with overlapped stages and log where time went"""
+    metrics = StagedExecutor(source, transform, sink, workers, queue_depth).run()
+    stages = ', '.join(f"{name} {s['busy_s']:.1f}s busy/{s['starved_s']:.1f}s starved/{s['blocked_s']:.1f}s blocked"
+                       for name, s in metrics['stages'].items())
+    logging.info(f"{label}: {metrics['elapsed_s']:.1f}s total, bottleneck {metrics['bottleneck']} ({stages}); "
+                 f"queue depth max read {metrics['queues']['read']['max_depth']}, "
+                 f"write {metrics['queues']['write']['max_depth']}")
+    return metrics
@@ -0,0 +1,367 @@
+import argparse
+import functools
+import os
+import re
+import zlib
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from compression import compress_bytes
+from hcup_spec import compile_schema, fallback_columns, load_registry, lookup_fields, narrowest_dtype
+from output_formats import ChunkWriter
+
+SPACE = ord(' ')
+GENERATE_CHUNK_ROWS = 100000
+# The 2019 NIS has about 7.08M discharges from 4,568 hospitals
+DISCHARGES_PER_HOSPITAL = 1550
+DEFAULT_MISSING_RATE = 0.05
+# HCUP codes missing (9), invalid (8), inconsistent (6) and not-applicable (5) values with a run of the digit
+# filling the field: -9, -99, -999.99
+SENTINEL_DIGITS = '9865'
+# Of the missing numeric values, the share coded with a sentinel rather than left blank
+SENTINEL_SHARE = 0.7
+
+# Uniform integer ranges for fields whose codes are well known
+FIELD_RANGES = {
+    'AGE': (0, 90), 'AMONTH': (1, 12), 'DQTR': (1, 4), 'PAY1': (1, 6), 'PAY2': (1, 6), 'RACE': (1, 6),
+    'ZIPINC_QRTL': (1, 4), 'APRDRG': (1, 956), 'DRG': (1, 999), 'DRG_NoPOA': (1, 999), 'MDC': (0, 25),
+    'MDC_NoPOA': (0, 25), 'DRGVER': (36, 37), 'I10_NDX': (1, 40), 'I10_NPR': (0, 25), 'DISPUNIFORM': (1, 7),
+    'APRDRG_Risk_Mortality': (0, 4), 'APRDRG_Severity': (0, 4), 'HOSP_DIVISION': (1, 9), 'HOSP_REGION': (1, 4),
+    'HOSP_BEDSIZE': (1, 3), 'H_CONTRL': (1, 3), 'HOSP_LOCTEACH': (1, 3), 'HOSP_URCAT4': (1, 4),
+    'HOSP_UR_TEACH': (0, 2), 'TRAN_IN': (0, 2), 'TRAN_OUT': (0, 2), 'PL_NCHS': (1, 6),
+}
+# Log-normal (mu, sigma) for skewed amounts and counts
+FIELD_LOGNORMAL = {
+    'LOS': (1.2, 0.9), 'TOTCHG': (10.4, 1.0), 'DISCWT': (1.6, 0.05), 'N_DISC_U': (11.0, 1.0),
+    'N_HOSP_U': (5.0, 0.8), 'S_DISC_U': (9.5, 1.0), 'S_HOSP_U': (3.5, 0.8), 'TOTAL_DISC': (7.4, 1.0),
+}
+
+
+def parse_rows(text):
+    """Row count from text such as 50000, 1M, 7M or 2.5K"""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMB]?)\s*', str(text).upper())
+    if not match:
+        raise ValueError(f"Can't parse row count '{text}'; use e.g. 1M or 500K")
+    return int(float(match.group(1)) * {'': 1, 'K': 10 ** 3, 'M': 10 ** 6, 'B': 10 ** 9}[match.group(2)])
+
+
+def _seed(*parts):
+    """Stable RNG seed from ints and strings, so a column draws the same values in every file"""
+    return [part if isinstance(part, int) else zlib.crc32(part.encode()) for part in parts]
+
+
+def _max_value(field):
+    """Largest value that fits the field, leaving room for a sign and decimal point"""
+    digits = field['width'] - 1 - (field['decimals'] + 1 if field['decimals'] else 0)
+    return 10 ** max(digits, 1) - 1
+
+
+def sentinel_values(field):
+    """The field's numeric sentinel codes as encode_numeric writes them (empty when the field can't hold one)"""
+    whole = field['width'] - 1 - (field['decimals'] + 1 if field['decimals'] else 0)
+    # float64 holds 15 significant digits exactly
+    if whole < 1 or whole + field['decimals'] > 15:
+        return []
+    return [-float(digit * whole + ('.' + digit * field['decimals'] if field['decimals'] else ''))
+            for digit in SENTINEL_DIGITS]
+
+
+def _missing_rate(field, base_rate):
+    """Per-field missing rate; later repeats of a field (I10_DX30 vs I10_DX1) are mostly empty"""
+    repeat = re.search(r'(\d+)$', field['name'])
+    if repeat and not field['name'].startswith(('KEY_', 'HOSP_')):
+        return 1 - (1 - base_rate) * 0.92 ** (int(repeat.group(1)) - 1)
+    rng = np.random.default_rng(_seed(field['name']))
+    return min(base_rate * rng.uniform(0, 2), 0.9)
+
+
+@functools.lru_cache(maxsize=None)
+def _vocabulary(name, width):
+    """
+    Distinct codes for a Char field as space-padded (n, width) bytes and their text.
+
+    ICD-10 style (a letter then digits) for diagnoses and procedures, a fixed
+    version string for *_VERSION fields.
+    """
+    rng = np.random.default_rng(_seed('vocabulary', name))
+    size = min(50 * width, 5000)
+    if name.upper().endswith('VERSION'):
+        codes = np.frombuffer(b'v2019.1'[:width].ljust(width), np.uint8).reshape(1, width)
+    else:
+        letters = np.frombuffer(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', np.uint8)
+        digits = np.frombuffer(b'0123456789', np.uint8)
+        lengths = rng.integers(min(3, width), width + 1, size)
+        codes = np.full((size, width), SPACE, np.uint8)
+        codes[:, 0] = rng.choice(letters, size)
+        for pos in range(1, width):
+            pool = digits if pos < 3 else np.concatenate([letters, digits])
+            codes[lengths > pos, pos] = rng.choice(pool, int((lengths > pos).sum()))
+        codes = np.unique(codes, axis=0)
+    text = [bytes(code).decode('ascii').strip() for code in codes]
+    return codes, text
+
+
+def _zipf_choice(rng, n_values, size):
+    """Indices skewed towards the first few values, like most categorical codes"""
+    cdf = np.cumsum(1 / np.arange(1, n_values + 1))
+    return np.minimum(np.searchsorted(cdf, rng.random(size) * cdf[-1]), n_values - 1)
+
+
+def field_values(field, rows, first_row, rng, n_hospitals, year, is_hospital_file):
+    """Raw values for one Num field: floats, with NaN where the field will be blank"""
+    name = field['name']
+    if name.startswith('KEY_'):
+        return np.arange(first_row, first_row + rows, dtype=np.float64) + 10 ** (field['width'] - 2)
+    if 'hospital number' in field.get('label', '').lower():
+        if is_hospital_file:
+            return np.arange(first_row + 1, first_row + rows + 1, dtype=np.float64)
+        return rng.integers(1, n_hospitals + 1, rows).astype(np.float64)
+    if name == 'YEAR':
+        return np.full(rows, float(year))
+
+    if name in FIELD_RANGES:
+        low, high = FIELD_RANGES[name]
+        values = rng.integers(low, high + 1, rows).astype(np.float64)
+    elif name in FIELD_LOGNORMAL or field['decimals'] or field['width'] >= 6:
+        mu, sigma = FIELD_LOGNORMAL.get(name, (np.log(max(_max_value(field), 2)) / 2, 1.0))
+        values = rng.lognormal(mu, sigma, rows)
+        values = np.round(values, field['decimals']) if field['decimals'] else np.floor(values)
+    elif (field['width'] == 1 or 'indicator' in field.get('label', '').lower()
+          or re.match(r'(CM|CMR|DXCCSR|PRCCSR)_', name)):
+        values = (rng.random(rows) < 0.1).astype(np.float64)
+    else:
+        values = _zipf_choice(rng, min(_max_value(field) + 1, 20), rows).astype(np.float64)
+    return np.minimum(values, _max_value(field))
+
+
+def encode_numeric(values, width, decimals):
+    """
+    Right-justified fixed-width text for numbers (NaN -> blank).
+
+    Returned column-major, as a (width, rows) uint8 array, so every
+    character position is written contiguously.
+    """
+    present = ~np.isnan(values)
+    scaled = np.round(np.abs(np.where(present, values, 0)) * 10 ** decimals).astype(np.int64)
+    out = np.full((width, len(values)), SPACE, np.uint8)
+    # Position of the leftmost digit written so far, for placing a minus sign
+    lead = np.full(len(values), width, np.int64)
+
+    position = width - 1
+    for k in range(width - (1 if decimals else 0)):
+        if decimals and k == decimals:
+            out[position] = np.where(present, ord('.'), SPACE)
+            position -= 1
+        visible = present & ((k <= decimals) | (scaled >= 10 ** k))
+        if not visible.any():
+            break
+        out[position] = np.where(visible, 48 + (scaled // 10 ** k) % 10, SPACE)
+        lead[visible] = position
+        position -= 1
+
+    negative = np.flatnonzero(present & (values < 0))
+    out[lead[negative] - 1, negative] = ord('-')
+    return out
+
+
+def schema_from_columns(name, columns, year=2019):
+    """
+    A layout for a file that has a column list but no spec file (e.g. NIS_2019_Severity).
+
+    Fields known from any registered spec keep their width and type; the
+    rest are four-digit numbers.
+    """
+    known = lookup_fields(columns)
+    fields = []
+    start = 1
+    for col in columns:
+        field = dict(known.get(col) or {'name': col, 'width': 4, 'decimals': 0, 'type': 'Num', 'label': ''})
+        field.update(start=start, end=start + field['width'] - 1)
+        field['dtype'] = narrowest_dtype(field)
+        fields.append(field)
+        start += field['width']
+    header = {'file_name': name, 'record_length': start - 1, 'year': str(year), 'n_observations': 0}
+    return compile_schema(header, fields)
+
+
+def dataset_schema(name, spec_dir=None):
+    """Layout for a file name such as NIS_2019_Core: its spec if registered, else see fallback_columns"""
+    registry = load_registry(spec_dir)
+    if name.upper() in registry:
+        return registry[name.upper()]
+
+    columns = fallback_columns(name)
+    if columns is None:
+        raise KeyError(f"No spec file or column list for {name}; known specs: {sorted(registry)}")
+    year = (name.split('_') + [''])[1]
+    return schema_from_columns(name, columns, int(year) if year.isdigit() else 2019)
+
+
+def generate_columns(schema, rows, first_row=0, seed=0, missing_rate=DEFAULT_MISSING_RATE, n_hospitals=None):
+    """
+    Synthetic values for every field of a spec.
+
+    Num fields come back as floats (NaN for blanks, negative HCUP sentinels
+    for coded missing values); Char fields as indices into the field's
+    vocabulary, -1 where blank. Values are drawn per column from an RNG keyed
+    on the seed, the chunk's first row and the column name, so a column such
+    as KEY_NIS or HOSP_NIS holds the same values in every file of a dataset
+    generated with the same seed.
+    """
+    header = schema['header']
+    is_hospital_file = 'HOSPITAL' in (schema['name'] or '').upper()
+    n_hospitals = n_hospitals or max(1, header.get('n_observations', 0) // DISCHARGES_PER_HOSPITAL)
+    year = int(header.get('year') or 2019)
+
+    columns = {}
+    for field in schema['fields']:
+        rng = np.random.default_rng(_seed(seed, first_row, field['name']))
+        # Record and hospital identifiers are never missing
+        key = (field['name'].startswith('KEY_') or field['name'] == 'YEAR'
+               or 'hospital number' in field.get('label', '').lower())
+        missing = np.zeros(rows, bool) if key else rng.random(rows) < _missing_rate(field, missing_rate)
+
+        if field['type'] == 'Num':
+            values = field_values(field, rows, first_row, rng, n_hospitals, year, is_hospital_file)
+            codes = sentinel_values(field)
+            if missing.any():
+                sentinel = missing & (rng.random(rows) < SENTINEL_SHARE) & bool(codes)
+                values[missing] = np.nan
+                values[sentinel] = rng.choice(codes, int(np.sum(sentinel)))
+        else:
+            _, text = _vocabulary(field['name'], field['width'])
+            values = _zipf_choice(rng, len(text), rows)
+            values[missing] = -1
+        columns[field['name']] = values
+    return columns
+
+
+def encode_records(schema, columns, newline=b'\r\n'):
+    """Fixed-width records for generated columns, as a (rows, stride) uint8 array"""
+    rows = len(next(iter(columns.values())))
+    stride = schema['header']['record_length'] + len(newline)
+    # Filled one character position at a time, then transposed into records
+    positions = np.full((stride, rows), SPACE, np.uint8)
+    if newline:
+        positions[-len(newline):] = np.frombuffer(newline, np.uint8)[:, None]
+
+    for field in schema['fields']:
+        values = columns[field['name']]
+        if field['type'] == 'Num':
+            block = encode_numeric(values, field['width'], field['decimals'])
+        else:
+            codes, _ = _vocabulary(field['name'], field['width'])
+            # Index -1 picks the blank code appended after the others
+            block = np.hstack([codes.T, np.full((field['width'], 1), SPACE, np.uint8)])[:, values]
+        positions[field['start'] - 1:field['end']] = block
+    return np.ascontiguousarray(positions.T)
+
+
+def columns_frame(schema, columns, keep_sentinels=False):
+    """Generated columns as the DataFrame the ASC reader would decode from their records
+
+    Sentinel codes decode to nulls, as the reader does, unless keep_sentinels is set.
+    """
+    frame = {}
+    for field in schema['fields']:
+        values = columns[field['name']]
+        dtype = field.get('dtype')
+        if field['type'] == 'Num' and not keep_sentinels:
+            # Generated values are never negative, so anything below zero is a sentinel code
+            values = np.where(values < 0, np.nan, values)
+        if field['type'] != 'Num':
+            _, text = _vocabulary(field['name'], field['width'])
+            frame[field['name']] = pd.Categorical.from_codes(values, text)
+        elif dtype.startswith('int'):
+            blank = np.isnan(values)
+            frame[field['name']] = pd.arrays.IntegerArray(np.where(blank, 0, values).astype(dtype), blank)
+        else:
+            frame[field['name']] = values.astype(dtype)
+    return pd.DataFrame(frame)
+
+
+def generate_records(schema, rows, first_row=0, seed=0, missing_rate=DEFAULT_MISSING_RATE, n_hospitals=None):
+    """Synthetic fixed-width records for a spec, as a (rows, stride) uint8 array"""
+    return encode_records(schema, generate_columns(schema, rows, first_row, seed, missing_rate, n_hospitals))
+
+
+def write_synthetic(schema, rows, asc_path=None, csv_path=None, seed=0, missing_rate=DEFAULT_MISSING_RATE,
+                    n_hospitals=None, chunk_rows=GENERATE_CHUNK_ROWS, keep_sentinels=False):
+    """Write rows of synthetic data as a fixed-width ASC file, a CSV (as the converter would write it), or both
+
+    Like the converter, the CSV has empty fields for sentinel codes unless keep_sentinels is set.
+    """
+    asc_file = open(asc_path, 'wb') if asc_path else None
+    writer = ChunkWriter(csv_path, 'csv') if csv_path else None
+    try:
+        with tqdm(total=rows, desc=f"Generating {schema['name']}", unit="rows") as pbar:
+            for first_row in range(0, rows, chunk_rows):
+                n = min(chunk_rows, rows - first_row)
+                columns = generate_columns(schema, n, first_row, seed, missing_rate, n_hospitals)
+                if asc_file:
+                    asc_file.write(compress_bytes(encode_records(schema, columns).tobytes(), asc_path))
+                if writer:
+                    writer.write(columns_frame(schema, columns, keep_sentinels))
+                pbar.update(n)
+    finally:
+        if asc_file:
+            asc_file.close()
+        if writer:
+            writer.close()
+
+
+def generate_dataset(out_dir, rows, files=None, formats=('asc', 'csv'), seed=0, missing_rate=DEFAULT_MISSING_RATE,
+                     compression=None, spec_dir=None, keep_sentinels=False):
+    """
+    Generate every file of a synthetic dataset into out_dir.
+
+    Discharge-level files (Core, DX_PR_GRPS, ...) get `rows` records and share
+    their key and hospital columns row for row; the Hospital file gets one
+    record per hospital. CSVs keep sentinel codes only with keep_sentinels.
+    Returns {file name: {format: path}}.
+    """
+    files = files or [schema['name'] or name for name, schema in load_registry(spec_dir).items()]
+    n_hospitals = max(1, rows // DISCHARGES_PER_HOSPITAL)
+    extension = {'gzip': '.gz', 'zstd': '.zst'}.get(compression, '')
+    os.makedirs(out_dir, exist_ok=True)
+
+    written = {}
+    for name in files:
+        schema = dataset_schema(name, spec_dir)
+        stem = schema['name'] or name
+        n_rows = n_hospitals if 'HOSPITAL' in name.upper() else rows
+        paths = {}
+        if 'asc' in formats:
+            paths['asc'] = os.path.join(out_dir, f'{stem}.ASC{extension}')
+        if 'csv' in formats:
+            paths['csv'] = os.path.join(out_dir, f'{stem}.csv{extension}')
+        write_synthetic(schema, n_rows, paths.get('asc'), paths.get('csv'), seed, missing_rate, n_hospitals,
+                        keep_sentinels=keep_sentinels)
+        written[stem] = paths
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic HCUP files from the FileSpecifications_*.TXT specs")
+    parser.add_argument('--rows', default='1M', help="Discharge records per file, e.g. 1M, 7M or 50M")
+    parser.add_argument('--out-dir', default=os.path.join('synthetic_data', 'NIS_2019'), help="Output folder")
+    parser.add_argument('--files', nargs='*', default=None,
+                        help="Files to generate, e.g. NIS_2019_Core NIS_2019_Severity (default: every registered spec); "
+                             "files without a spec take their columns from the <FAMILY>_Columns module")
+    parser.add_argument('--formats', nargs='+', choices=['asc', 'csv'], default=['asc', 'csv'],
+                        help="Write fixed-width ASC files, converted-style CSVs, or both")
+    parser.add_argument('--missing-rate', type=float, default=DEFAULT_MISSING_RATE,
+                        help="Typical share of missing values per field")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=None, help="Compress the outputs")
+    parser.add_argument('--keep-sentinels', action='store_true',
+                        help="Write HCUP missing/invalid codes (-9, -88) to the CSVs instead of empty fields")
+    args = parser.parse_args()
+
+    written = generate_dataset(args.out_dir, parse_rows(args.rows), args.files, args.formats, args.seed,
+                               args.missing_rate, args.compression, keep_sentinels=args.keep_sentinels)
+    for stem, paths in written.items():
+        for path in paths.values():
+            print(f"Wrote {path}")
@@ -0,0 +1,24 @@
+import gzip
+import os
+
+import pandas as pd
+
+
+def test_merges_compressed_processed_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    import merge_data
+
+    dataset_dir = tmp_path / 'processed_data' / 'NIS_2019'
+    dataset_dir.mkdir(parents=True)
+    pd.DataFrame({'KEY_NIS': [1, 2, 3], 'AGE': [40, 51, 62]}).to_csv(dataset_dir / 'processed_Core.CSV', index=False)
+    with gzip.open(dataset_dir / 'processed_Severity.CSV.gz', 'wt') as f:
+        pd.DataFrame({'APRDRG': [190, 720, 139]}).to_csv(f, index=False)
+
+    assert sorted(os.path.basename(path) for path in merge_data.get_processed_files('processed_data')) == [
+        'processed_Core.CSV', 'processed_Severity.CSV.gz']
+
+    merge_data.main(use_cache=False)
+
+    merged = pd.read_csv(tmp_path / 'combined_data.csv')
+    assert sorted(merged.columns) == ['AGE', 'APRDRG', 'KEY_NIS']
+    assert merged.sort_values('KEY_NIS')['APRDRG'].tolist() == [190, 720, 139]